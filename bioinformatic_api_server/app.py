@@ -1,7 +1,8 @@
 from argparse import ArgumentParser
 import logging
+import time
 
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import enable_pretty_logging
 from tornado.web import Application
 
@@ -9,7 +10,10 @@ from handlers.version_handler import VersionHandler
 from handlers.notfound_handler import NotFoundHandler
 from handlers.genome_handler import GenomeHandler
 from handlers.query_handler import QueryEngine
-from config import log_level
+from handlers.search_stream_handler import SearchStreamHandler
+from handlers.federated_search_handler import FederatedSearchHandler
+from service import storage_tier_service, warmup_service
+from config import log_level, compaction_interval_seconds
 
 logger = logging.getLogger(__name__)
 logger.setLevel(log_level)
@@ -32,10 +36,13 @@ def make_app(debug: bool = False) -> Application:
             ("/queryengine/(listgenomes)/?", QueryEngine),
             ("/queryengine/(length)/?", QueryEngine),
             ("/queryengine/(retrieveseq)/?", QueryEngine),
+            ("/queryengine/(cachestats)/?", QueryEngine),
             (
                 "/queryengine/(searchseq)/?",
                 QueryEngine,
             ),
+            ("/queryengine/searchstream/?", SearchStreamHandler),
+            ("/queryengine/federatedsearch/?", FederatedSearchHandler),
         ],
         debug=debug,
         default_handler_class=NotFoundHandler,
@@ -44,16 +51,38 @@ def make_app(debug: bool = False) -> Application:
 
 def main() -> None:
     """Run the API service."""
+    startup_started = time.perf_counter()
     parser = ArgumentParser()
     parser.add_argument("--debug", "-d", action="store_true", help="enable debug mode")
     parser.add_argument(
         "--port", "-p", type=int, default=8080, help="port to listen on"
     )
+    parser.add_argument(
+        "--warm",
+        type=int,
+        default=0,
+        metavar="N",
+        help="preload the register, indexes and file handles of the N most recently used genomes",
+    )
     args = parser.parse_args()
     enable_pretty_logging()
     app = make_app(args.debug)
+    if args.warm:
+        warmup_service.warm_up(args.warm)
     app.listen(args.port)
-    logger.info("Listening on port %d", args.port)
+    logger.info(
+        "Listening on port %d, startup took %.2fs",
+        args.port,
+        time.perf_counter() - startup_started,
+    )
+
+    # Move cold genomes to the compressed tier in the background
+    PeriodicCallback(
+        lambda: IOLoop.current().run_in_executor(
+            None, storage_tier_service.compact_storage
+        ),
+        compaction_interval_seconds * 1000,
+    ).start()
     IOLoop.current().start()
 
 
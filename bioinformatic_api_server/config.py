@@ -4,3 +4,40 @@ log_level = "INFO"
 genome_register = "app_data/genome_register.csv"
 upload_folder = "app_data/uploads"
 genome_register_headers = ["unique_identifier", "upload_path", "upload_name"]
+
+# Streaming search - bases read per window, hits per page
+search_window_size = 1000000
+search_stream_default_limit = 1000
+search_stream_max_limit = 100000
+search_stream_flush_every = 1000
+
+# Storage tiering - genomes idle for cold_after_seconds, or beyond the hot tier
+# budget, are moved to a BGZF compressed cold tier
+cold_folder = "app_data/cold"
+genome_access_log = "app_data/genome_access.json"
+hot_tier_budget_bytes = 10 * 1024**3
+cold_after_seconds = 30 * 24 * 60 * 60
+compaction_interval_seconds = 60 * 60
+
+# Number of processes used to write and index the files of an upload
+registration_workers = 4
+
+# Admission control - queries scanning more bases than heavy_query_cost are
+# heavy. Each class has its own concurrency limit and bounded queue.
+heavy_query_cost = 1000000
+light_query_concurrency = 64
+light_query_queue_size = 256
+heavy_query_concurrency = 4
+heavy_query_queue_size = 16
+admission_retry_after_seconds = 5
+
+# Federated search - processes searching genomes in parallel, hits kept per genome
+federated_search_workers = 4
+federated_search_max_hits = 10
+
+# Block cache for region reads - size of a cached block and of the whole cache
+sequence_block_size = 64 * 1024
+sequence_cache_bytes = 256 * 1024**2
+
+# Open FASTA handles kept for reuse, across all genomes
+fasta_handle_pool_size = 64
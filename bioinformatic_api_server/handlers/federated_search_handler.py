@@ -0,0 +1,115 @@
+import json
+
+import tornado
+
+from handlers.base_handler import BaseView
+from service import (
+    query_handler_service,
+    storage_tier_service,
+    admission_service,
+    federated_search_service,
+)
+from config import federated_search_max_hits
+
+
+class FederatedSearchHandler(BaseView):
+    """Search all registered genomes, streaming NDJSON results per genome."""
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def set_default_headers(self):
+        """Results are sent as newline delimited JSON."""
+        self.set_header("Content-Type", "application/x-ndjson")
+
+    async def get(self):
+        """Write one line per genome as each search completes, then a summary line"""
+
+        query_sequence = self.get_query_argument("query", None)
+        uid_filter = self.get_query_argument("uids", "")
+        any_hit = self.get_query_argument("any_hit", "false").lower() in [
+            "1",
+            "true",
+            "yes",
+        ]
+
+        if not query_sequence:
+            raise tornado.web.HTTPError(
+                status_code=400, reason="query is a required parameter"
+            )
+
+        try:
+            max_hits = int(
+                self.get_query_argument("max_hits", federated_search_max_hits)
+            )
+        except ValueError:
+            raise tornado.web.HTTPError(status_code=400, reason="Invalid max_hits")
+        max_hits = max(1, min(max_hits, federated_search_max_hits))
+
+        unique_identifiers = list(query_handler_service.get_genomes())
+        if uid_filter:
+            requested = [uid.strip() for uid in uid_filter.split(",") if uid.strip()]
+            unknown = set(requested) - set(unique_identifiers)
+            if unknown:
+                raise tornado.web.HTTPError(
+                    status_code=404,
+                    reason=f"Unknown genomes {','.join(sorted(unknown))}",
+                )
+            unique_identifiers = requested
+
+        # Cold genomes are searched in their compressed form, without promoting them
+        genome_paths, missing_genomes = {}, []
+        for unique_identifier in unique_identifiers:
+            fasta_file_path = storage_tier_service.locate_genome_path(unique_identifier)
+            if fasta_file_path:
+                genome_paths[unique_identifier] = fasta_file_path
+            else:
+                missing_genomes.append(unique_identifier)
+
+        try:
+            async with admission_service.get_admission_controller().admit(
+                admission_service.HEAVY
+            ):
+                await self.write_results(
+                    genome_paths, missing_genomes, query_sequence, max_hits, any_hit
+                )
+        except admission_service.AdmissionRejected as e:
+            self.set_header("Retry-After", str(e.retry_after))
+            self.send_response(str(e), status=503)
+
+    async def write_results(
+        self, genome_paths, missing_genomes, query_sequence, max_hits, any_hit
+    ):
+        """Write and flush each genome result as soon as it is available"""
+        # Registered genomes whose files are in neither tier get an error line,
+        # in the same form as genomes that failed to be searched
+        for unique_identifier in missing_genomes:
+            self.write(
+                json.dumps(
+                    {
+                        "unique_identifier": unique_identifier,
+                        "error": "Genome file not found",
+                    }
+                )
+                + "\n"
+            )
+
+        searched_genomes, genomes_with_hits = 0, 0
+        async for result in federated_search_service.federated_search(
+            genome_paths, query_sequence, max_hits, any_hit
+        ):
+            searched_genomes += 1
+            genomes_with_hits += bool(result.get("contains_query"))
+            self.write(json.dumps(result) + "\n")
+            await self.flush()
+
+        self.write(
+            json.dumps(
+                {
+                    "searched_genomes": searched_genomes,
+                    "genomes_with_hits": genomes_with_hits,
+                    "missing_genomes": missing_genomes,
+                    "complete": searched_genomes == len(genome_paths),
+                }
+            )
+            + "\n"
+        )
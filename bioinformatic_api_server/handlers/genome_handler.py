@@ -7,9 +7,11 @@ class GenomeHandler(BaseView):
 
     SUPPORTED_METHODS = ("POST",)
 
-    def post(self):
+    async def post(self):
         """Receives FASTA files to register them"""
-        unique_filenames = genome_handler_sevice.register_genome(
+        unique_filenames = await genome_handler_sevice.register_genome(
             self.request.files.items()
         )
-        self.send_response(unique_filenames)
+        # Partial failures are reported per file, the request only fails if no file was registered
+        status = 200 if unique_filenames["uploaded_files"] else 400
+        self.send_response(unique_filenames, status=status)
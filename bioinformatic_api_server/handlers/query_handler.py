@@ -1,8 +1,12 @@
-import os
+from tornado.ioloop import IOLoop
 
 from handlers.base_handler import BaseView
-from service import query_handler_service
-from config import upload_folder
+from service import (
+    query_handler_service,
+    storage_tier_service,
+    admission_service,
+    block_cache_service,
+)
 
 
 class QueryEngine(BaseView):
@@ -10,34 +14,104 @@ class QueryEngine(BaseView):
 
     SUPPORTED_METHODS = "GET"
 
-    def get(self, query_type):
+    async def get(self, query_type):
         """Routes requests based on query_type parsed from url"""
 
         unique_identifier = self.get_query_argument("uid", None)
         sequence_header_region = self.get_query_argument("sequence_region", "")
         query_sequence = self.get_query_argument("query", None)
 
-        fasta_file_name = f"{unique_identifier}.fa"
-        fasta_file_path = os.path.join(upload_folder, fasta_file_name)
-
         if query_type == "listgenomes":
             genome_data = query_handler_service.get_genomes()
             if genome_data:
                 self.send_response(genome_data)
             return
 
+        if query_type == "cachestats":
+            self.send_response(block_cache_service.get_block_cache().stats())
+            return
+
         if (
             query_type in ["length", "retrieveseq", "searchseq"]
             and unique_identifier is None
         ):
             raise ValueError("unique_identifier is a required parameter")
 
+        # Genomes in the cold tier are transparently promoted on access, which
+        # decompresses them, so it runs on the default executor. The genome is
+        # kept in the hot tier until the query is done with it.
+        unique_identifier = unique_identifier.strip("/")
+        fasta_file_path = await IOLoop.current().run_in_executor(
+            None, storage_tier_service.acquire_genome_path, unique_identifier
+        )
+        try:
+            await self.admit_query(
+                query_type, fasta_file_path, sequence_header_region, query_sequence
+            )
+        finally:
+            storage_tier_service.release_genome(unique_identifier)
+
+    async def admit_query(
+        self, query_type, fasta_file_path, sequence_header_region, query_sequence
+    ):
+        """Run a query once its query class admits it"""
+
+        # Heavy queries get their own concurrency limit and queue, so that
+        # cheap queries are not stuck behind them
+        query_class = admission_service.classify_query(
+            admission_service.estimate_query_cost(
+                fasta_file_path, query_type, sequence_header_region, query_sequence
+            )
+        )
+        try:
+            async with admission_service.get_admission_controller().admit(query_class):
+                await self.run_query(
+                    query_type,
+                    query_class,
+                    fasta_file_path,
+                    sequence_header_region,
+                    query_sequence,
+                )
+        except admission_service.AdmissionRejected as e:
+            self.set_header("Retry-After", str(e.retry_after))
+            self.send_response(str(e), status=503)
+
+    async def run_in_query_class(
+        self, query_class, query_function, *args, shared_cache=False
+    ):
+        """
+        Run heavy queries on the process pool, light queries on the thread pool
+
+        Heavy queries reading through the shared block cache run on a thread
+        pool of their own instead, so that their blocks are cached in this
+        process and counted in cachestats.
+        """
+        if query_class == admission_service.HEAVY and shared_cache:
+            query_pool = admission_service.get_heavy_retrieval_pool()
+        elif query_class == admission_service.HEAVY:
+            query_pool = admission_service.get_heavy_query_pool()
+        else:
+            query_pool = admission_service.get_light_query_pool()
+        return await IOLoop.current().run_in_executor(query_pool, query_function, *args)
+
+    async def run_query(
+        self,
+        query_type,
+        query_class,
+        fasta_file_path,
+        sequence_header_region,
+        query_sequence,
+    ):
+        """Run a query and send its result"""
+
         if query_type == "length":
             try:
-                unique_identifier = unique_identifier.strip("/")
                 sequence_header_region = sequence_header_region.strip("/")
-                length_data = query_handler_service.get_length(
-                    fasta_file_path, sequence_header_region
+                length_data = await self.run_in_query_class(
+                    query_class,
+                    query_handler_service.get_length,
+                    fasta_file_path,
+                    sequence_header_region,
                 )
                 if length_data:
                     self.send_response(length_data)
@@ -50,8 +124,12 @@ class QueryEngine(BaseView):
 
         if query_type == "retrieveseq":
             try:
-                sequence_info = query_handler_service.retrieveseq(
-                    fasta_file_path, sequence_header_region
+                sequence_info = await self.run_in_query_class(
+                    query_class,
+                    query_handler_service.retrieveseq,
+                    fasta_file_path,
+                    sequence_header_region,
+                    shared_cache=True,
                 )
                 if sequence_info:
                     self.send_response(sequence_info)
@@ -61,8 +139,12 @@ class QueryEngine(BaseView):
 
         if query_type == "searchseq":
             try:
-                searchseq_info = query_handler_service.searchseq(
-                    fasta_file_path, sequence_header_region, query_sequence
+                searchseq_info = await self.run_in_query_class(
+                    query_class,
+                    query_handler_service.searchseq,
+                    fasta_file_path,
+                    sequence_header_region,
+                    query_sequence,
                 )
                 self.send_response(searchseq_info)
                 return
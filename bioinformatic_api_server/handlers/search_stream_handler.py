@@ -0,0 +1,105 @@
+import os
+import json
+
+import tornado
+from tornado.ioloop import IOLoop
+
+from handlers.base_handler import BaseView
+from service import query_handler_service, storage_tier_service, admission_service
+from config import (
+    search_stream_default_limit,
+    search_stream_max_limit,
+    search_stream_flush_every,
+)
+
+
+class SearchStreamHandler(BaseView):
+    """Stream all search hits as NDJSON, one page at a time."""
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def set_default_headers(self):
+        """Hits are sent as newline delimited JSON."""
+        self.set_header("Content-Type", "application/x-ndjson")
+
+    async def get(self):
+        """Write up to `limit` hits followed by the cursor for the next page"""
+
+        unique_identifier = self.get_query_argument("uid", None)
+        sequence_header_region = self.get_query_argument("sequence_region", "")
+        query_sequence = self.get_query_argument("query", None)
+        cursor = self.get_query_argument("cursor", None)
+
+        if unique_identifier is None or not query_sequence:
+            raise tornado.web.HTTPError(
+                status_code=400, reason="uid and query are required parameters"
+            )
+
+        try:
+            limit = int(self.get_query_argument("limit", search_stream_default_limit))
+        except ValueError:
+            raise tornado.web.HTTPError(status_code=400, reason="Invalid limit")
+        limit = max(1, min(limit, search_stream_max_limit))
+
+        # Promoting a cold genome decompresses it, off the IOLoop
+        unique_identifier = unique_identifier.strip("/")
+        fasta_file_path = await IOLoop.current().run_in_executor(
+            None, storage_tier_service.acquire_genome_path, unique_identifier
+        )
+        try:
+            if not os.path.isfile(fasta_file_path):
+                raise tornado.web.HTTPError(status_code=404, reason="Unknown genome")
+
+            # Pages can scan whole genomes, they are admitted as heavy queries
+            async with admission_service.get_admission_controller().admit(
+                admission_service.HEAVY
+            ):
+                await self.write_hits(
+                    fasta_file_path,
+                    sequence_header_region,
+                    query_sequence,
+                    limit,
+                    cursor,
+                )
+        except admission_service.AdmissionRejected as e:
+            self.set_header("Retry-After", str(e.retry_after))
+            self.send_response(str(e), status=503)
+        finally:
+            storage_tier_service.release_genome(unique_identifier)
+
+    async def write_hits(
+        self, fasta_file_path, sequence_header_region, query_sequence, limit, cursor
+    ):
+        """Write a page of hits, search_stream_flush_every hits at a time
+
+        Each batch is searched on the heavy query pool, like other heavy
+        queries, resuming from the cursor of the previous batch. Scanning the
+        regions between sparse hits then neither blocks the IOLoop nor competes
+        with light queries for it.
+        """
+        heavy_query_pool = admission_service.get_heavy_query_pool()
+        remaining = limit
+        while True:
+            try:
+                hit_lines, cursor = await IOLoop.current().run_in_executor(
+                    heavy_query_pool,
+                    query_handler_service.collect_search_hits,
+                    fasta_file_path,
+                    sequence_header_region,
+                    query_sequence,
+                    min(remaining, search_stream_flush_every),
+                    cursor,
+                )
+            except ValueError as e:
+                # Errors in the request surface on the first batch, before anything is sent
+                if remaining < limit:
+                    raise
+                raise tornado.web.HTTPError(status_code=400, reason=str(e))
+
+            self.write("".join(hit_lines))
+            remaining -= len(hit_lines)
+            if cursor is None or not remaining:
+                break
+            await self.flush()
+
+        self.write(json.dumps({"next_cursor": cursor}) + "\n")
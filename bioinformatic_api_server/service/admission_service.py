@@ -0,0 +1,231 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from config import (
+    heavy_query_cost,
+    light_query_concurrency,
+    light_query_queue_size,
+    heavy_query_concurrency,
+    heavy_query_queue_size,
+    admission_retry_after_seconds,
+    log_level,
+)
+from service.query_handler_service import read_index_file, parse_sequence_region
+
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+LIGHT = "light"
+HEAVY = "heavy"
+
+_admission_controller = None
+_heavy_query_pool = None
+_light_query_pool = None
+_heavy_retrieval_pool = None
+
+
+class AdmissionRejected(Exception):
+    """Raised when the queue of a query class is full."""
+
+    def __init__(self, query_class, retry_after):
+        super().__init__(f"Too many {query_class} queries, retry after {retry_after}s")
+        self.query_class = query_class
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limit concurrent queries per class, with a bounded queue for each class
+
+    Light and heavy queries never wait for each other. Once the queue of a
+    class is full, new queries of that class are rejected right away.
+    """
+
+    def __init__(self, class_limits, retry_after=admission_retry_after_seconds):
+        """
+        Parameters
+        ----------
+        class_limits
+            Dictionary of query class to (concurrency limit, queue size)
+        retry_after
+            Seconds a rejected client should wait before retrying
+
+        """
+        self.retry_after = retry_after
+        self._semaphores = {
+            query_class: asyncio.Semaphore(concurrency)
+            for query_class, (concurrency, _) in class_limits.items()
+        }
+        self._queue_sizes = {
+            query_class: queue_size
+            for query_class, (_, queue_size) in class_limits.items()
+        }
+        self._waiting = {query_class: 0 for query_class in class_limits}
+
+    @asynccontextmanager
+    async def admit(self, query_class):
+        """Wait for a slot in query_class, or raise AdmissionRejected if the queue is full"""
+        semaphore = self._semaphores[query_class]
+        if semaphore.locked():
+            if self._waiting[query_class] >= self._queue_sizes[query_class]:
+                raise AdmissionRejected(query_class, self.retry_after)
+
+        self._waiting[query_class] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting[query_class] -= 1
+
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+def get_admission_controller():
+    """
+    Function to get the admission controller shared by all handlers
+
+    Returns
+    -------
+    AdmissionController
+        Controller with the limits from config, created on first use
+
+    """
+    global _admission_controller
+
+    if _admission_controller is None:
+        _admission_controller = AdmissionController(
+            {
+                LIGHT: (light_query_concurrency, light_query_queue_size),
+                HEAVY: (heavy_query_concurrency, heavy_query_queue_size),
+            }
+        )
+    return _admission_controller
+
+
+def get_heavy_query_pool():
+    """
+    Function to get the process pool heavy queries are run on
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        Pool with one worker per concurrent heavy query, created on first use
+
+    """
+    global _heavy_query_pool
+
+    if _heavy_query_pool is None:
+        _heavy_query_pool = ProcessPoolExecutor(max_workers=heavy_query_concurrency)
+    return _heavy_query_pool
+
+
+def get_heavy_retrieval_pool():
+    """
+    Function to get the thread pool heavy sequence retrievals are run on
+
+    Retrievals read through the block cache of this process, which the heavy
+    query pool workers do not share.
+
+    Returns
+    -------
+    ThreadPoolExecutor
+        Pool with one thread per concurrent heavy query, created on first use
+
+    """
+    global _heavy_retrieval_pool
+
+    if _heavy_retrieval_pool is None:
+        _heavy_retrieval_pool = ThreadPoolExecutor(
+            max_workers=heavy_query_concurrency, thread_name_prefix="heavy_retrieval"
+        )
+    return _heavy_retrieval_pool
+
+
+def get_light_query_pool():
+    """
+    Function to get the thread pool light queries are run on
+
+    Light queries still read index and FASTA files, running them on the IOLoop
+    would stall every other request while they wait on disk.
+
+    Returns
+    -------
+    ThreadPoolExecutor
+        Pool with one thread per concurrent light query, created on first use
+
+    """
+    global _light_query_pool
+
+    if _light_query_pool is None:
+        _light_query_pool = ThreadPoolExecutor(
+            max_workers=light_query_concurrency, thread_name_prefix="light_query"
+        )
+    return _light_query_pool
+
+
+def estimate_query_cost(
+    fasta_file_path, query_type, sequence_header_region, query_sequence=None
+):
+    """
+    Function to estimate the number of bases a query has to process
+
+    Parameters
+    ----------
+    fasta_file_path
+        FASTA file being queried
+    query_type
+        listgenomes, length, retrieveseq, searchseq or searchstream
+    sequence_header_region
+        Sequence_name:start-stop, Sequence_name alone, or empty for all sequences
+    query_sequence
+        Query sequence of searches
+
+    Returns
+    -------
+    int
+        Estimated cost of the query
+
+    """
+    if query_type in ["listgenomes", "length"]:
+        return 0
+
+    try:
+        length_dictionary = read_index_file(fasta_file_path)
+        if sequence_header_region:
+            _, start, end = parse_sequence_region(
+                sequence_header_region, length_dictionary
+            )
+            region_size = end - start + 1
+        else:
+            region_size = sum(int(length) for length in length_dictionary.values())
+    except (OSError, ValueError):
+        # Unknown genomes and regions fail fast in the query itself
+        return 0
+
+    if query_type == "retrieveseq":
+        return region_size
+
+    # Number of positions the query is compared at, on both strands
+    return 2 * max(region_size - len(query_sequence or "") + 1, 0)
+
+
+def classify_query(query_cost):
+    """
+    Function to assign a query to the light or heavy class
+
+    Parameters
+    ----------
+    query_cost
+        Cost from estimate_query_cost
+
+    Returns
+    -------
+    str
+        LIGHT or HEAVY
+
+    """
+    return HEAVY if query_cost >= heavy_query_cost else LIGHT
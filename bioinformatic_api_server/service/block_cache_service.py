@@ -0,0 +1,143 @@
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from config import sequence_block_size, sequence_cache_bytes, log_level
+from service.handle_pool_service import get_fasta_handle_pool
+
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+_block_cache = None
+
+
+class BlockCache:
+    """
+    Least recently used cache of fixed size, decoded sequence blocks
+
+    Blocks are keyed by (FASTA file, sequence name, block number). Region reads
+    are assembled from cached blocks, so overlapping and repeated reads only
+    touch the FASTA file for blocks that are not cached yet.
+    """
+
+    def __init__(self, max_bytes=sequence_cache_bytes, block_size=sequence_block_size):
+        """
+        Parameters
+        ----------
+        max_bytes
+            Total number of bases kept in the cache
+        block_size
+            Number of bases per block
+
+        """
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, fasta_file_path, sequence_name, start, end):
+        """
+        Read a region of a sequence through the cache
+
+        Parameters
+        ----------
+        fasta_file_path
+            Indexed FASTA file
+        sequence_name
+            Sequence to read from
+        start
+            0-based start of the region
+        end
+            0-based, exclusive end of the region
+
+        Returns
+        -------
+        str
+            Sequence of the region
+
+        """
+        first_block = start // self.block_size
+        last_block = max(end - 1, start) // self.block_size
+
+        blocks = []
+        fasta = None
+        with ExitStack() as fasta_handle:
+            for block_number in range(first_block, last_block + 1):
+                key = (fasta_file_path, sequence_name, block_number)
+                block = self._get(key)
+                if block is None:
+                    if fasta is None:
+                        fasta = fasta_handle.enter_context(
+                            get_fasta_handle_pool().handle(fasta_file_path)
+                        )
+                    block = fasta.fetch(
+                        sequence_name,
+                        block_number * self.block_size,
+                        (block_number + 1) * self.block_size,
+                    )
+                    self._put(key, block)
+                blocks.append(block)
+
+        offset = first_block * self.block_size
+        return "".join(blocks)[start - offset : end - offset]
+
+    def stats(self):
+        """
+        Cache counters
+
+        Returns
+        -------
+        dict
+            Hits, misses, number of cached blocks and cached bytes
+
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "blocks": len(self._blocks),
+                "cached_bytes": self._cached_bytes,
+                "max_bytes": self.max_bytes,
+                "block_size": self.block_size,
+            }
+
+    def _get(self, key):
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._blocks.move_to_end(key)
+            return block
+
+    def _put(self, key, block):
+        with self._lock:
+            if key in self._blocks or len(block) > self.max_bytes:
+                return
+            self._blocks[key] = block
+            self._cached_bytes += len(block)
+            while self._cached_bytes > self.max_bytes:
+                _, evicted_block = self._blocks.popitem(last=False)
+                self._cached_bytes -= len(evicted_block)
+
+
+def get_block_cache():
+    """
+    Function to get the block cache shared by all requests
+
+    Returns
+    -------
+    BlockCache
+        Cache with the sizes from config, created on first use
+
+    """
+    global _block_cache
+
+    if _block_cache is None:
+        _block_cache = BlockCache()
+    return _block_cache
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+from config import federated_search_workers, log_level
+from service.query_handler_service import iter_search_hits
+
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+_federated_search_pool = None
+
+
+def get_federated_search_pool():
+    """
+    Function to get the process pool genomes are searched on
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        Pool shared by all federated searches, created on first use
+
+    """
+    global _federated_search_pool
+
+    if _federated_search_pool is None:
+        _federated_search_pool = ProcessPoolExecutor(
+            max_workers=federated_search_workers
+        )
+    return _federated_search_pool
+
+
+def search_genome(unique_identifier, fasta_file_path, search_sequence, max_hits):
+    """
+    Function to search all sequences of one genome for a query
+
+    Runs in a worker process, errors are returned rather than raised so that
+    one broken genome does not end the federated search.
+
+    Parameters
+    ----------
+    unique_identifier
+        Unique identifier of the genome
+    fasta_file_path
+        FASTA file of the genome, plain or BGZF compressed
+    search_sequence
+        Query sequence
+    max_hits
+        Stop searching the genome after this many hits
+
+    Returns
+    -------
+    dict
+        Unique identifier, whether the query was found and up to max_hits hits
+
+    """
+    try:
+        hits = list(
+            islice(iter_search_hits(fasta_file_path, "", search_sequence), max_hits)
+        )
+    except Exception as e:
+        return {"unique_identifier": unique_identifier, "error": str(e)}
+
+    return {
+        "unique_identifier": unique_identifier,
+        "contains_query": bool(hits),
+        "hits": hits,
+    }
+
+
+async def federated_search(genome_paths, search_sequence, max_hits, any_hit=False):
+    """
+    Search several genomes in parallel, yielding results as genomes complete
+
+    Parameters
+    ----------
+    genome_paths
+        Dictionary of unique identifiers and FASTA file paths to search
+    search_sequence
+        Query sequence
+    max_hits
+        Maximum number of hits reported per genome
+    any_hit
+        Stop as soon as one genome contains the query
+
+    Yields
+    ------
+    dict
+        Result of search_genome for each genome
+
+    """
+    logging.info(
+        f"Searching {len(genome_paths)} genomes for sequence {search_sequence}"
+    )
+
+    loop = asyncio.get_event_loop()
+    pending = [
+        loop.run_in_executor(
+            get_federated_search_pool(),
+            search_genome,
+            unique_identifier,
+            fasta_file_path,
+            search_sequence,
+            1 if any_hit else max_hits,
+        )
+        for unique_identifier, fasta_file_path in genome_paths.items()
+    ]
+
+    try:
+        for next_result in asyncio.as_completed(pending):
+            result = await next_result
+            yield result
+            if any_hit and result.get("contains_query"):
+                break
+    finally:
+        # Genomes not picked up by a worker yet are skipped
+        for future in pending:
+            future.cancel()
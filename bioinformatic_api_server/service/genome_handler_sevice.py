@@ -1,65 +1,185 @@
+import re
+import asyncio
 import uuid
 from collections import defaultdict
-import pysam
+from concurrent.futures import ProcessPoolExecutor
+import threading
 import os.path
 import logging
 
-from config import genome_register, genome_register_headers, upload_folder, log_level
+from config import (
+    genome_register,
+    genome_register_headers,
+    upload_folder,
+    registration_workers,
+    log_level,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(log_level)
 
+_registration_pool = None
+_register_lock = threading.Lock()
 
-def register_genome(request_file_items):
+
+async def register_genome(
+    request_file_items,
+    register_file=genome_register,
+    upload_directory=upload_folder,
+):
     """
     Function to store, index and register genomes
+
+    Files of one request are written, validated and indexed concurrently on a
+    process pool, while the event loop keeps serving other requests.
+    Successfully processed files are then appended to the genome register in a
+    single write.
+
     Parameters
     ----------
     request_file_items
         Files along with metadata from request
+    register_file
+        Genome register to add the uploaded genomes to
+    upload_directory
+        Folder to store uploaded genomes in
 
     Returns
     -------
-    Dictionary of lists with unique identifier and fasta metadata
+    Dictionary of lists with unique identifier and fasta metadata, and the
+    files that failed to register along with the reason
 
     """
     logging.info("Received request to register fasta files")
-    # TODO FASTA File extension check, file content/format check
+    # TODO FASTA File extension check
     # TODO Separate FASTA index creation - useful for large FASTA files
     # TODO Have a better way to handle genome register - some DB, more metadata, md5 hash
     # TODO Auto create upload folders during startup
 
-    if not os.path.isfile(genome_register):
+    if not os.path.isfile(register_file):
         logging.info("Writing genome register headers")
-        write_content_to_file(genome_register, ",".join(genome_register_headers))
-        write_content_to_file(genome_register, "\n")
+        write_content_to_file(register_file, ",".join(genome_register_headers))
+        write_content_to_file(register_file, "\n")
 
     # Adapted from Tornado docs
-    uploaded_files = defaultdict(list)
+    pending_uploads = []
     for field_names, files in request_file_items:
         for info in files:
-            filename = info["filename"]
-            body = info["body"].decode("utf8")
-
-            logging.info(f"Processing {filename}")
+            logging.info(f"Processing {info['filename']}")
 
             # Determine file name, upload path
             unique_filename = uuid.uuid4().hex
-            upload_path = f"{upload_folder}/{unique_filename}.fa"
-            genome_register_entry = f"{unique_filename},{upload_path},{filename}\n"
+            upload_path = f"{upload_directory}/{unique_filename}.fa"
+            pending_uploads.append(
+                (info["filename"], unique_filename, upload_path, info["body"])
+            )
 
-            write_content_to_file(file_path=upload_path, content=body)
-            write_content_to_file(
-                file_path=genome_register, content=genome_register_entry
+    # Files are written and indexed in parallel, a single file is handled on a
+    # thread to spare the round trip to a worker process
+    loop = asyncio.get_event_loop()
+    executor = get_registration_pool() if len(pending_uploads) > 1 else None
+    errors = await asyncio.gather(
+        *[
+            loop.run_in_executor(executor, store_genome, upload_path, body)
+            for *_, upload_path, body in pending_uploads
+        ]
+    )
+
+    uploaded_files = defaultdict(list)
+    genome_register_entries = ""
+    for (filename, unique_filename, upload_path, _), error in zip(
+        pending_uploads, errors
+    ):
+        if error:
+            logging.info(f"Failed to register {filename} - {error}")
+            uploaded_files["failed_files"].append(
+                {"filename": filename, "error": error}
             )
+            continue
 
-            pysam.faidx(upload_path)
-            uploaded_files["uploaded_files"].append(
-                {"filename": filename, "unique_identifier": unique_filename}
+        genome_register_entries += f"{unique_filename},{upload_path},{filename}\n"
+        uploaded_files["uploaded_files"].append(
+            {"filename": filename, "unique_identifier": unique_filename}
+        )
+
+    if genome_register_entries:
+        with _register_lock:
+            write_content_to_file(
+                file_path=register_file, content=genome_register_entries
             )
     return uploaded_files
 
 
+def get_registration_pool():
+    """
+    Function to get the process pool used to register genomes
+
+    Returns
+    -------
+    ProcessPoolExecutor
+        Pool shared by all registration requests, created on first use
+
+    """
+    global _registration_pool
+
+    if _registration_pool is None:
+        _registration_pool = ProcessPoolExecutor(max_workers=registration_workers)
+    return _registration_pool
+
+
+def store_genome(upload_path, body):
+    """
+    Function to write, validate and index an uploaded genome
+
+    Runs in a worker process or thread. Files that fail are removed again.
+
+    Parameters
+    ----------
+    upload_path
+        Path to store the genome at
+    body
+        Raw contents of the uploaded file
+
+    Returns
+    -------
+    str
+        Reason the file could not be registered, None on success
+
+    """
+    import pysam
+
+    try:
+        content = body.decode("utf8")
+        validate_fasta(content)
+        write_content_to_file(file_path=upload_path, content=content, mode="w")
+        pysam.faidx(upload_path)
+    except Exception as e:
+        for partial_file in [upload_path, f"{upload_path}.fai"]:
+            if os.path.isfile(partial_file):
+                os.remove(partial_file)
+        return str(e) or e.__class__.__name__
+    return None
+
+
+def validate_fasta(content):
+    """
+    Function to check that uploaded content looks like a FASTA file
+
+    Parameters
+    ----------
+    content
+        Contents of the uploaded file
+
+    """
+    lines = content.splitlines()
+    if not lines or not lines[0].startswith(">"):
+        raise ValueError("FASTA file must start with a '>' header line")
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.startswith(">") and not re.fullmatch(r"[A-Za-z*\-]*", line):
+            raise ValueError(f"Invalid sequence characters on line {line_number}")
+
+
 def write_content_to_file(file_path, content, mode="a+"):
     """
     Function to write contents to a file
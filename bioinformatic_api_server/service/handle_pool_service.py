@@ -0,0 +1,113 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import fasta_handle_pool_size, log_level
+
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+_fasta_handle_pool = None
+
+
+class FastaHandlePool:
+    """
+    Reuse open pysam.FastaFile handles across requests
+
+    A handle is used by one caller at a time. Idle handles are kept per FASTA
+    file, the least recently used ones are closed once more than max_handles
+    are idle.
+    """
+
+    def __init__(self, max_handles=fasta_handle_pool_size):
+        """
+        Parameters
+        ----------
+        max_handles
+            Maximum number of idle handles kept open
+
+        """
+        self.max_handles = max_handles
+        self._idle_handles = OrderedDict()
+        self._number_of_idle_handles = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def handle(self, fasta_file_path):
+        """Check out a handle for fasta_file_path, opening one if none is idle"""
+        fasta = None
+        with self._lock:
+            idle_handles = self._idle_handles.get(fasta_file_path)
+            if idle_handles:
+                fasta = idle_handles.pop()
+                self._number_of_idle_handles -= 1
+                self._idle_handles.move_to_end(fasta_file_path)
+
+        if fasta is None:
+            import pysam
+
+            fasta = pysam.FastaFile(fasta_file_path)
+
+        try:
+            yield fasta
+        finally:
+            self._release(fasta_file_path, fasta)
+
+    def warm(self, fasta_file_path):
+        """Open a handle for fasta_file_path and keep it idle in the pool"""
+        with self.handle(fasta_file_path):
+            pass
+
+    def close_handles(self, fasta_file_path):
+        """Close idle handles of a FASTA file, e.g. before it is removed"""
+        with self._lock:
+            idle_handles = self._idle_handles.pop(fasta_file_path, [])
+            self._number_of_idle_handles -= len(idle_handles)
+        for fasta in idle_handles:
+            fasta.close()
+
+    def _release(self, fasta_file_path, fasta):
+        evicted_handles = []
+        with self._lock:
+            self._idle_handles.setdefault(fasta_file_path, []).append(fasta)
+            self._idle_handles.move_to_end(fasta_file_path)
+            self._number_of_idle_handles += 1
+
+            while self._number_of_idle_handles > self.max_handles:
+                oldest_path, oldest_handles = next(iter(self._idle_handles.items()))
+                evicted_handles.append(oldest_handles.pop(0))
+                self._number_of_idle_handles -= 1
+                if not oldest_handles:
+                    del self._idle_handles[oldest_path]
+
+        for evicted_handle in evicted_handles:
+            evicted_handle.close()
+
+
+def get_fasta_handle_pool():
+    """
+    Function to get the handle pool shared by all requests of this process
+
+    Returns
+    -------
+    FastaHandlePool
+        Pool with the size from config, created on first use
+
+    """
+    global _fasta_handle_pool
+
+    if _fasta_handle_pool is None:
+        _fasta_handle_pool = FastaHandlePool()
+    return _fasta_handle_pool
+
+
+def _forget_handles_after_fork():
+    """Worker processes must not share file handles with the parent"""
+    global _fasta_handle_pool
+
+    _fasta_handle_pool = None
+
+
+os.register_at_fork(after_in_child=_forget_handles_after_fork)
@@ -1,15 +1,23 @@
+import os
 import re
 import csv
-import pysam
+import json
+import base64
+import binascii
 import logging
 from io import StringIO
 
-from Bio import SeqIO
-from config import genome_register, log_level
+from config import genome_register, log_level, search_window_size
+from service.utility_service import reverse_complement
+from service.block_cache_service import get_block_cache
+from service.handle_pool_service import get_fasta_handle_pool
 
 logger = logging.getLogger(__name__)
 logger.setLevel(log_level)
 
+# File path -> ((modification time, size), parsed content), see load_cached_file
+_file_cache = {}
+
 
 def get_genomes(genome_file=genome_register):
     """
@@ -28,18 +36,86 @@ def get_genomes(genome_file=genome_register):
     """
     logging.info("Fetching genomes from register")
 
-    data = {}
-    with open(genome_file, "r") as genome_register_fh:
-        genome_entries = csv.DictReader(genome_register_fh)
-        for rows in genome_entries:
-            key = rows["unique_identifier"]
-            data[key] = rows
+    data = dict(load_cached_file(genome_file, parse_genome_register))
 
     logging.info("Returning genomes available in the genome register")
 
     return data
 
 
+def parse_genome_register(genome_register_fh):
+    """
+    Function to parse the genome register
+
+    Parameters
+    ----------
+    genome_register_fh
+        Open genome register
+
+    Returns
+    -------
+    dict
+        A dict of unique genome identifiers, upload path and upload name.
+
+    """
+    data = {}
+    genome_entries = csv.DictReader(genome_register_fh)
+    for rows in genome_entries:
+        key = rows["unique_identifier"]
+        data[key] = rows
+    return data
+
+
+def load_cached_file(file_path, parse_function):
+    """
+    Function to parse a small metadata file, reusing the result until it changes
+
+    Parameters
+    ----------
+    file_path
+        File to read
+    parse_function
+        Function turning the open file into the cached value
+
+    Returns
+    -------
+    Value returned by parse_function. It is shared, callers must not modify it.
+
+    """
+    file_stat = os.stat(file_path)
+    file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+    cached = _file_cache.get(file_path)
+    if cached and cached[0] == file_version:
+        return cached[1]
+
+    with open(file_path, "r") as file_fh:
+        content = parse_function(file_fh)
+    _file_cache[file_path] = (file_version, content)
+    return content
+
+
+def parse_index_file(index_fh):
+    """
+    Function to parse a FASTA index file
+
+    Parameters
+    ----------
+    index_fh
+        Open FASTA index file
+
+    Returns
+    -------
+    dict
+        Sequence names and the remaining columns of the index
+
+    """
+    index_entries = {}
+    for line in index_fh:
+        sequence_name, *columns = line.strip("\n").split("\t")
+        index_entries[sequence_name] = columns
+    return index_entries
+
+
 def get_length(fasta_file_path, sequence_header_region):
     """
     Function to get length of sequence(s) in a fasta file
@@ -91,25 +167,53 @@ def read_index_file(fasta_file_path):
 
     logging.info(f"Reading FASTA index file for {fasta_file_path}")
 
-    index_file = f"{fasta_file_path}.fai"
-    length_dictionary = {}
-    with open(index_file, "r") as index_fh:
-        for line in index_fh:
-            sequence_name, length, *unwanted = line.strip("\n").split("\t")
-            length_dictionary[sequence_name] = length
+    index_entries = load_cached_file(f"{fasta_file_path}.fai", parse_index_file)
+    length_dictionary = {
+        sequence_name: columns[0] for sequence_name, columns in index_entries.items()
+    }
     return length_dictionary
 
 
-def retrieveseq(fasta_file_path, sequence_header_region):
+def read_index_line_bases(fasta_file_path):
+    """
+    Function to read the number of bases per line from a FASTA index file
+
+    Parameters
+    ----------
+    fasta_file_path
+        Path of fasta file whose index needs to be read
+
+    Returns
+    -------
+    dict
+        Dictionary containing sequence names and bases per line
+
+    """
+
+    index_entries = load_cached_file(f"{fasta_file_path}.fai", parse_index_file)
+    line_bases_dictionary = {
+        sequence_name: int(columns[2])
+        for sequence_name, columns in index_entries.items()
+    }
+    return line_bases_dictionary
+
+
+def retrieveseq(fasta_file_path, sequence_header_region, block_cache=None):
     """
     Get subsequence from a fasta file
 
+    Sequences are read through the shared block cache, so repeated and
+    overlapping regions are served from memory. The result is formatted like
+    the output of samtools faidx.
+
     Parameters
     ----------
     fasta_file_path
         FASTA file path to query
     sequence_header_region
         Sequence_name:start-stop, can be Sequence_name alone as well
+    block_cache
+        BlockCache to read through, defaults to the shared cache
 
     Returns
     -------
@@ -123,10 +227,28 @@ def retrieveseq(fasta_file_path, sequence_header_region):
     )
 
     try:
-        sequence_record = pysam.faidx(fasta_file_path, sequence_header_region)
-    except Exception as e:
-        raise f"Failed to retrieve sequence from FASTA file {fasta_file_path} with error {e}"
-    return sequence_record
+        sequence_name, start, end = parse_sequence_region(
+            sequence_header_region, read_index_file(fasta_file_path)
+        )
+    except (OSError, ValueError):
+        # Regions that are not parsed here are left to samtools
+        import pysam
+
+        try:
+            sequence_record = pysam.faidx(fasta_file_path, sequence_header_region)
+        except Exception as e:
+            raise f"Failed to retrieve sequence from FASTA file {fasta_file_path} with error {e}"
+        return sequence_record
+
+    block_cache = block_cache or get_block_cache()
+    sequence = block_cache.fetch(fasta_file_path, sequence_name, start - 1, end)
+
+    line_bases = read_index_line_bases(fasta_file_path)[sequence_name]
+    sequence_lines = [
+        sequence[line_start : line_start + line_bases] + "\n"
+        for line_start in range(0, len(sequence), line_bases)
+    ]
+    return f">{sequence_header_region}\n" + "".join(sequence_lines)
 
 
 # TODO handle with base exception
@@ -156,6 +278,8 @@ def searchseq(fasta_file_path, sequence_header_region, search_sequence):
         f"Searching for sequence {search_sequence} in {fasta_file_path}, region {sequence_header_region}"
     )
 
+    from Bio import SeqIO
+
     query_sequence = retrieveseq(fasta_file_path, sequence_header_region)
 
     # Convert fasta to a SeqIO record and get raw sequence
@@ -225,3 +349,261 @@ def search_seq_both_dir(fasta_sequence_record, search_sequence):
     )
 
     return start_in_forward_dir, start_in_reverse_com_dir
+
+
+def parse_sequence_region(sequence_header_region, length_dictionary):
+    """
+    Split a sequence region into a sequence name and 1-based coordinates
+
+    Parameters
+    ----------
+    sequence_header_region
+        Sequence_name:start-stop, can be Sequence_name alone as well
+    length_dictionary
+        Dictionary containing sequence names and lengths, see read_index_file
+
+    Returns
+    -------
+    tuple
+        Sequence name, start and end (1-based, inclusive)
+
+    """
+
+    matches = re.fullmatch(r"(.+?)(?::(\d+)-(\d+))?", sequence_header_region)
+    if not matches or matches.group(1) not in length_dictionary:
+        raise ValueError(f"Unknown sequence region {sequence_header_region}")
+
+    sequence_name, start, end = matches.groups()
+    sequence_length = int(length_dictionary[sequence_name])
+    start = int(start) if start else 1
+    end = min(int(end), sequence_length) if end else sequence_length
+    if start < 1 or start > end:
+        raise ValueError(
+            f"Invalid coordinates in sequence region {sequence_header_region}"
+        )
+
+    return sequence_name, start, end
+
+
+def encode_search_cursor(sequence_name, offset, strand):
+    """
+    Encode a search position as an opaque, url safe cursor
+
+    Parameters
+    ----------
+    sequence_name
+        Sequence to resume the search in
+    offset
+        0-based position in sequence_name to resume the search from
+    strand
+        "+" or "-"
+
+    Returns
+    -------
+    str
+        Cursor to be handed back by the client to resume the search
+
+    """
+    payload = json.dumps([sequence_name, offset, strand]).encode("utf8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+
+def decode_search_cursor(cursor):
+    """
+    Decode a cursor created by encode_search_cursor
+
+    Parameters
+    ----------
+    cursor
+        Cursor received from the client
+
+    Returns
+    -------
+    tuple
+        Sequence name, 0-based offset and strand
+
+    """
+    try:
+        sequence_name, offset, strand = json.loads(base64.urlsafe_b64decode(cursor))
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid search cursor - {e}")
+
+    if strand not in ("+", "-") or not isinstance(offset, int) or offset < 0:
+        raise ValueError("Invalid search cursor")
+    return sequence_name, offset, strand
+
+
+def iter_search_hits(
+    fasta_file_path,
+    sequence_header_region,
+    search_sequence,
+    cursor=None,
+    window_size=search_window_size,
+):
+    """
+    Lazily find all occurrences of a substring in a FASTA file
+
+    Sequences are read in windows of window_size bases, so memory use does not
+    depend on sequence length or on the number of hits. Hits are produced per
+    sequence, forward strand first, in increasing order of position.
+    Overlapping matches are all reported. Coordinates are 1-based on the
+    forward strand for both strands.
+
+    Parameters
+    ----------
+    fasta_file_path
+         FASTA file path to search
+    sequence_header_region
+        Sequence_name:start-stop, Sequence_name alone, or empty to search all
+        sequences
+    search_sequence
+        Query sequence
+    cursor
+        Optional tuple of (sequence name, 0-based offset, strand) to resume from.
+        The hit at the cursor position itself is included.
+    window_size
+        Number of bases read from the FASTA file at a time
+
+    Yields
+    ------
+    dict
+        Sequence name, strand, start and end of each match
+
+    """
+
+    logging.info(
+        f"Streaming hits for sequence {search_sequence} in {fasta_file_path}, region {sequence_header_region}"
+    )
+
+    search_sequence = search_sequence.upper()
+    length_of_search_sequence = len(search_sequence)
+    if not length_of_search_sequence:
+        raise ValueError("Query sequence can not be empty")
+
+    length_dictionary = read_index_file(fasta_file_path)
+    if sequence_header_region:
+        regions = [parse_sequence_region(sequence_header_region, length_dictionary)]
+    else:
+        regions = [(name, 1, int(length)) for name, length in length_dictionary.items()]
+
+    strand_patterns = [
+        ("+", search_sequence),
+        ("-", reverse_complement(search_sequence)),
+    ]
+
+    if cursor:
+        cursor_sequence, cursor_offset, cursor_strand = cursor
+        region_names = [region[0] for region in regions]
+        if cursor_sequence not in region_names:
+            raise ValueError("Search cursor does not belong to this search")
+        regions = regions[region_names.index(cursor_sequence) :]
+
+    with get_fasta_handle_pool().handle(fasta_file_path) as fasta:
+        for sequence_name, start, end in regions:
+            for strand, pattern in strand_patterns:
+                window_start = start - 1
+                if cursor:
+                    # Resume on the strand and position the cursor was issued for
+                    if strand != cursor_strand:
+                        continue
+                    window_start = max(window_start, cursor_offset)
+                    cursor = None
+
+                # Windows overlap by the query length - 1 so that matches spanning
+                # two windows are found; only matches starting in a window belong to it.
+                while window_start + length_of_search_sequence <= end:
+                    window_end = min(window_start + window_size, end)
+                    fetch_end = min(window_end + length_of_search_sequence - 1, end)
+                    window = fasta.fetch(sequence_name, window_start, fetch_end).upper()
+
+                    position = window.find(pattern)
+                    while position != -1 and window_start + position < window_end:
+                        yield {
+                            "sequence_name": sequence_name,
+                            "strand": strand,
+                            "start": window_start + position + 1,
+                            "end": window_start + position + length_of_search_sequence,
+                        }
+                        position = window.find(pattern, position + 1)
+                    window_start = window_end
+
+
+def stream_search_hits(
+    fasta_file_path, sequence_header_region, search_sequence, limit, cursor=None
+):
+    """
+    Produce a page of search hits as NDJSON lines
+
+    At most limit hits are returned, one JSON object per line. The last line
+    holds the cursor for the next page, which is null once all hits were sent.
+
+    Parameters
+    ----------
+    fasta_file_path
+         FASTA file path to search
+    sequence_header_region
+        Sequence_name:start-stop, Sequence_name alone, or empty to search all
+        sequences
+    search_sequence
+        Query sequence
+    limit
+        Maximum number of hits to return
+    cursor
+        Opaque cursor returned with the previous page, if any
+
+    Yields
+    ------
+    str
+        NDJSON lines
+
+    """
+
+    decoded_cursor = decode_search_cursor(cursor) if cursor else None
+    hits = iter_search_hits(
+        fasta_file_path, sequence_header_region, search_sequence, decoded_cursor
+    )
+
+    next_cursor = None
+    for number_of_hits, hit in enumerate(hits):
+        if number_of_hits == limit:
+            next_cursor = encode_search_cursor(
+                hit["sequence_name"], hit["start"] - 1, hit["strand"]
+            )
+            break
+        yield json.dumps(hit) + "\n"
+
+    yield json.dumps({"next_cursor": next_cursor}) + "\n"
+
+
+def collect_search_hits(
+    fasta_file_path, sequence_header_region, search_sequence, limit, cursor=None
+):
+    """
+    Collect a batch of search hits as NDJSON lines, to be run on an executor
+
+    Parameters
+    ----------
+    fasta_file_path
+         FASTA file path to search
+    sequence_header_region
+        Sequence_name:start-stop, Sequence_name alone, or empty to search all
+        sequences
+    search_sequence
+        Query sequence
+    limit
+        Maximum number of hits to return
+    cursor
+        Opaque cursor returned with the previous batch, if any
+
+    Returns
+    -------
+    tuple
+        NDJSON lines of the hits, and the cursor of the next hit, None once
+        all hits were collected
+
+    """
+
+    *hit_lines, last_line = stream_search_hits(
+        fasta_file_path, sequence_header_region, search_sequence, limit, cursor
+    )
+    return hit_lines, json.loads(last_line)["next_cursor"]
@@ -0,0 +1,408 @@
+import os
+import json
+import time
+import gzip
+import shutil
+import logging
+import threading
+from collections import Counter
+
+from service.handle_pool_service import get_fasta_handle_pool
+from config import (
+    upload_folder,
+    cold_folder,
+    genome_access_log,
+    hot_tier_budget_bytes,
+    cold_after_seconds,
+    log_level,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+# unique identifier -> time of last access, loaded from _last_access_log on first use
+_last_access = None
+_last_access_log = None
+
+# unique identifier -> number of requests reading the genome, see acquire_genome_path
+_readers = Counter()
+
+# Guards moving genomes between tiers, _last_access and _readers, which request
+# handlers update while compaction runs in the executor
+_tier_lock = threading.Lock()
+
+
+def _get_last_access(access_log):
+    # Callers hold _tier_lock
+    global _last_access, _last_access_log
+
+    if _last_access is None or _last_access_log != access_log:
+        _last_access = {}
+        _last_access_log = access_log
+        if os.path.isfile(access_log):
+            with open(access_log, "r") as access_log_fh:
+                _last_access = json.load(access_log_fh)
+    return _last_access
+
+
+def load_access_log(access_log=genome_access_log):
+    """
+    Function to load last access times of genomes
+
+    Parameters
+    ----------
+    access_log
+        JSON file mapping unique identifiers to last access times
+
+    Returns
+    -------
+    dict
+        Copy of the unique identifiers and last access times (seconds since epoch)
+
+    """
+    with _tier_lock:
+        return dict(_get_last_access(access_log))
+
+
+def save_access_log(access_log=genome_access_log):
+    """
+    Function to persist last access times of genomes
+
+    Parameters
+    ----------
+    access_log
+        JSON file to write last access times to
+
+    """
+    with _tier_lock:
+        last_access = dict(_get_last_access(access_log))
+
+    temporary_access_log = f"{access_log}.tmp"
+    with open(temporary_access_log, "w") as access_log_fh:
+        json.dump(last_access, access_log_fh)
+    os.replace(temporary_access_log, access_log)
+
+
+def record_access(unique_identifier, access_time=None, access_log=genome_access_log):
+    """
+    Function to mark a genome as recently used
+
+    Parameters
+    ----------
+    unique_identifier
+        Unique identifier of the genome
+    access_time
+        Time of access, defaults to now
+    access_log
+        JSON file the last access times are persisted to
+
+    """
+    with _tier_lock:
+        _record_access(unique_identifier, access_time, access_log)
+
+
+def _record_access(unique_identifier, access_time=None, access_log=genome_access_log):
+    # Callers hold _tier_lock
+    _get_last_access(access_log)[unique_identifier] = access_time or time.time()
+
+
+def resolve_genome_path(
+    unique_identifier, hot_folder=upload_folder, cold_folder=cold_folder
+):
+    """
+    Function to get the path of an uncompressed, indexed genome
+
+    Genomes found in the cold tier are promoted back to the hot tier first,
+    so callers always receive a plain FASTA file next to its index. The access
+    is recorded under the same lock as compaction, so a genome that was just
+    resolved is not demoted under the caller. Callers that keep reading the
+    genome afterwards should use acquire_genome_path instead.
+
+    Parameters
+    ----------
+    unique_identifier
+        Unique identifier of the genome
+    hot_folder
+        Folder containing uncompressed genomes
+    cold_folder
+        Folder containing BGZF compressed genomes
+
+    Returns
+    -------
+    str
+        Path of the FASTA file in the hot tier
+
+    """
+    return _resolve_genome_path(unique_identifier, hot_folder, cold_folder, False)
+
+
+def acquire_genome_path(
+    unique_identifier, hot_folder=upload_folder, cold_folder=cold_folder
+):
+    """
+    Function to get the path of a genome, and keep it in the hot tier while in use
+
+    Like resolve_genome_path, but the genome also counts as being read until
+    release_genome is called, and compaction does not demote it meanwhile.
+
+    Parameters
+    ----------
+    unique_identifier
+        Unique identifier of the genome
+    hot_folder
+        Folder containing uncompressed genomes
+    cold_folder
+        Folder containing BGZF compressed genomes
+
+    Returns
+    -------
+    str
+        Path of the FASTA file in the hot tier
+
+    """
+    return _resolve_genome_path(unique_identifier, hot_folder, cold_folder, True)
+
+
+def release_genome(unique_identifier):
+    """
+    Function to mark the end of a read started with acquire_genome_path
+
+    Parameters
+    ----------
+    unique_identifier
+        Unique identifier of the genome
+
+    """
+    with _tier_lock:
+        _readers[unique_identifier] -= 1
+        if _readers[unique_identifier] <= 0:
+            del _readers[unique_identifier]
+
+
+def _resolve_genome_path(unique_identifier, hot_folder, cold_folder, reader):
+    hot_path = os.path.join(hot_folder, f"{unique_identifier}.fa")
+    cold_path = os.path.join(cold_folder, f"{unique_identifier}.fa.gz")
+
+    while True:
+        with _tier_lock:
+            if os.path.isfile(hot_path) or not os.path.isfile(cold_path):
+                if reader:
+                    _readers[unique_identifier] += 1
+                if os.path.isfile(hot_path):
+                    _record_access(unique_identifier)
+                return hot_path
+
+        # Decompressing can take a while, other genomes are served meanwhile.
+        # Compaction may demote the genome again before it is recorded, in
+        # which case it is promoted once more.
+        promote_genome(cold_path, hot_path)
+
+
+def locate_genome_path(
+    unique_identifier, hot_folder=upload_folder, cold_folder=cold_folder
+):
+    """
+    Function to get the path of a genome in whichever tier it is stored
+
+    Unlike resolve_genome_path, cold genomes are not promoted. pysam reads BGZF
+    compressed FASTA files directly, which suits one-off scans of many genomes.
+
+    Parameters
+    ----------
+    unique_identifier
+        Unique identifier of the genome
+    hot_folder
+        Folder containing uncompressed genomes
+    cold_folder
+        Folder containing BGZF compressed genomes
+
+    Returns
+    -------
+    str
+        Path of the FASTA file, None if the genome is in neither tier
+
+    """
+    for fasta_file_path in [
+        os.path.join(hot_folder, f"{unique_identifier}.fa"),
+        os.path.join(cold_folder, f"{unique_identifier}.fa.gz"),
+    ]:
+        if os.path.isfile(fasta_file_path):
+            return fasta_file_path
+    return None
+
+
+def promote_genome(cold_path, hot_path):
+    """
+    Function to move a genome from the cold tier to the hot tier
+
+    The genome is decompressed to a temporary file without holding the tier
+    lock, only moving it in place and removing the cold files is done under it.
+
+    Parameters
+    ----------
+    cold_path
+        BGZF compressed FASTA file
+    hot_path
+        Path to write the uncompressed FASTA file to
+
+    """
+    logging.info(f"Promoting {cold_path} to {hot_path}")
+
+    # Concurrent requests may promote the same genome, each into its own file
+    temporary_path = f"{hot_path}.{threading.get_ident()}.tmp"
+    temporary_files = [temporary_path, f"{temporary_path}.fai"]
+    try:
+        with gzip.open(cold_path, "rb") as cold_fh, open(
+            temporary_path, "wb"
+        ) as hot_fh:
+            shutil.copyfileobj(cold_fh, hot_fh)
+
+        # Offsets in the index of a BGZF file refer to the uncompressed data
+        shutil.copyfile(f"{cold_path}.fai", f"{temporary_path}.fai")
+
+        with _tier_lock:
+            # Another request may have promoted the genome first
+            if not os.path.isfile(hot_path):
+                os.replace(f"{temporary_path}.fai", f"{hot_path}.fai")
+                os.replace(temporary_path, hot_path)
+                for cold_file in [cold_path, f"{cold_path}.fai", f"{cold_path}.gzi"]:
+                    os.remove(cold_file)
+    except FileNotFoundError:
+        # The cold files were removed by a request that promoted the genome first
+        logging.info(f"{cold_path} was promoted by another request")
+    finally:
+        for temporary_file in temporary_files:
+            if os.path.isfile(temporary_file):
+                os.remove(temporary_file)
+
+
+def demote_genome(hot_path, cold_path, keep_hot=lambda: False):
+    """
+    Function to move a genome from the hot tier to the cold tier
+
+    The genome is compressed without holding the tier lock, requests keep
+    reading the hot copy meanwhile. Under the lock keep_hot is checked once
+    more, and either the hot or the freshly written cold files are removed.
+
+    Parameters
+    ----------
+    hot_path
+        Uncompressed FASTA file
+    cold_path
+        Path to write the BGZF compressed FASTA file to
+    keep_hot
+        Called under the tier lock, returns True if the genome is in use and
+        should stay in the hot tier
+
+    Returns
+    -------
+    bool
+        True if the genome was demoted
+
+    """
+    import pysam
+
+    logging.info(f"Demoting {hot_path} to {cold_path}")
+
+    # The hot file exists until it is removed below, so no request reads these
+    pysam.tabix_compress(hot_path, cold_path, force=True)
+    pysam.faidx(cold_path)
+
+    with _tier_lock:
+        demoted = not keep_hot()
+        if demoted:
+            # Open handles would keep the removed file on disk
+            get_fasta_handle_pool().close_handles(hot_path)
+            for hot_file in [hot_path, f"{hot_path}.fai"]:
+                os.remove(hot_file)
+
+    if not demoted:
+        logging.info(f"Keeping {hot_path}, it is in use")
+        for cold_file in [cold_path, f"{cold_path}.fai", f"{cold_path}.gzi"]:
+            os.remove(cold_file)
+    return demoted
+
+
+def compact_storage(
+    hot_folder=upload_folder,
+    cold_folder=cold_folder,
+    budget_bytes=hot_tier_budget_bytes,
+    cold_after=cold_after_seconds,
+    access_log=genome_access_log,
+    now=None,
+):
+    """
+    Function to move cold genomes to the compressed tier
+
+    Genomes not accessed for cold_after seconds are demoted. If the hot tier is
+    still larger than budget_bytes, least recently used genomes are demoted
+    until it fits. Genomes that were never accessed count from their upload time.
+    A genome accessed since the candidates were listed, or still being read,
+    is kept.
+
+    Parameters
+    ----------
+    hot_folder
+        Folder containing uncompressed genomes
+    cold_folder
+        Folder containing BGZF compressed genomes
+    budget_bytes
+        Maximum size of the hot tier
+    cold_after
+        Seconds after which an unused genome is considered cold
+    access_log
+        JSON file to persist last access times to
+    now
+        Current time, defaults to now
+
+    Returns
+    -------
+    list
+        Unique identifiers of demoted genomes
+
+    """
+    logging.info("Compacting genome storage")
+
+    now = now or time.time()
+    os.makedirs(cold_folder, exist_ok=True)
+    last_access = load_access_log(access_log)
+
+    hot_genomes = []
+    for file_name in os.listdir(hot_folder):
+        if not file_name.endswith(".fa"):
+            continue
+        unique_identifier = file_name[: -len(".fa")]
+        hot_path = os.path.join(hot_folder, file_name)
+        accessed = last_access.get(unique_identifier, os.path.getmtime(hot_path))
+        hot_genomes.append((accessed, os.path.getsize(hot_path), unique_identifier))
+
+    # Least recently used first
+    hot_genomes.sort()
+    hot_tier_size = sum(size for _, size, _ in hot_genomes)
+
+    demoted = []
+    for accessed, size, unique_identifier in hot_genomes:
+        if now - accessed < cold_after and hot_tier_size <= budget_bytes:
+            continue
+
+        def keep_hot():
+            # A request may have resolved the genome since the snapshot above,
+            # or still be reading it
+            return (
+                _get_last_access(access_log).get(unique_identifier, accessed)
+                != accessed
+                or unique_identifier in _readers
+            )
+
+        if not demote_genome(
+            os.path.join(hot_folder, f"{unique_identifier}.fa"),
+            os.path.join(cold_folder, f"{unique_identifier}.fa.gz"),
+            keep_hot,
+        ):
+            continue
+        hot_tier_size -= size
+        demoted.append(unique_identifier)
+
+    save_access_log(access_log)
+    logging.info(f"Moved {len(demoted)} genomes to the cold tier")
+    return demoted
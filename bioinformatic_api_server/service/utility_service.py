@@ -1,11 +1,11 @@
-from Bio import SeqIO
-from Bio.Seq import Seq
 from typing import Dict
 from io import StringIO
 
 
 def reverse_complement(sequence: str) -> str:
     """Reverse complement a sequence."""
+    from Bio.Seq import Seq
+
     revcomped = Seq(sequence).reverse_complement()
     return str(revcomped)
 
@@ -23,5 +23,7 @@ def parse_genome_data(contents: str) -> Dict[str, str]:
     Dictionary mapping names to sequences.
 
     """
+    from Bio import SeqIO
+
     buffer = StringIO(contents)
     return {record.name: str(record.seq) for record in SeqIO.parse(buffer, "fasta")}
@@ -0,0 +1,61 @@
+import os
+import time
+import logging
+
+from config import upload_folder, log_level
+from service.query_handler_service import get_genomes, read_index_file
+from service.storage_tier_service import load_access_log
+from service.handle_pool_service import get_fasta_handle_pool
+
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+
+def warm_up(number_of_genomes, hot_folder=upload_folder):
+    """
+    Function to preload what the first queries after a restart would load
+
+    Imports pysam and Biopython, reads the genome register, and reads the index
+    and opens a FASTA handle for the most recently used genomes.
+
+    Parameters
+    ----------
+    number_of_genomes
+        Number of most recently used genomes to preload
+    hot_folder
+        Folder containing uncompressed genomes, genomes in the cold tier are skipped
+
+    Returns
+    -------
+    list
+        Unique identifiers of the preloaded genomes
+
+    """
+    logging.info(f"Warming up the {number_of_genomes} most recently used genomes")
+    warm_up_started = time.perf_counter()
+
+    import pysam  # noqa: F401
+    from Bio import SeqIO  # noqa: F401
+
+    last_access = load_access_log()
+    recently_used = sorted(
+        get_genomes(),
+        key=lambda unique_identifier: last_access.get(unique_identifier, 0),
+        reverse=True,
+    )
+
+    warmed_genomes = []
+    for unique_identifier in recently_used:
+        if len(warmed_genomes) == number_of_genomes:
+            break
+        fasta_file_path = os.path.join(hot_folder, f"{unique_identifier}.fa")
+        if not os.path.isfile(fasta_file_path):
+            continue
+        read_index_file(fasta_file_path)
+        get_fasta_handle_pool().warm(fasta_file_path)
+        warmed_genomes.append(unique_identifier)
+
+    logging.info(
+        f"Warmed up {len(warmed_genomes)} genomes in {time.perf_counter() - warm_up_started:.2f}s"
+    )
+    return warmed_genomes
@@ -1,4 +1,13 @@
+import os
+import json
+import time
+import shutil
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+import pysam
 from service.utility_service import reverse_complement, parse_genome_data
 from service.query_handler_service import (
     get_genomes,
@@ -6,9 +15,24 @@ from service.query_handler_service import (
     searchseq,
     retrieveseq,
     read_index_file,
+    iter_search_hits,
+    stream_search_hits,
+    collect_search_hits,
+    encode_search_cursor,
+    decode_search_cursor,
 )
 
 from service.genome_handler_sevice import register_genome
+from service.admission_service import (
+    AdmissionController,
+    AdmissionRejected,
+    estimate_query_cost,
+)
+from service.block_cache_service import BlockCache
+from service.handle_pool_service import FastaHandlePool
+from service.federated_search_service import federated_search, search_genome
+from service import storage_tier_service
+from service.storage_tier_service import compact_storage, resolve_genome_path
 
 
 @pytest.mark.parametrize(
@@ -103,3 +127,548 @@ def test_searchseq(fasta_file_path):
     assert expected_position == searchseq(
         fasta_file_path, sequence_header, search_sequence
     )
+
+
+@pytest.mark.parametrize(
+    "sequence_header, strand, expected_starts",
+    [
+        ("test_sequence", "+", [15, 25, 42, 142, 151, 177, 258, 309, 312]),
+        (
+            "test_sequence",
+            "-",
+            [74, 113, 123, 130, 172, 204, 209, 218, 236, 269, 286, 298],
+        ),
+        ("test_sequence:20-160", "+", [25, 42, 142, 151]),
+    ],
+)
+def test_iter_search_hits(fasta_file_path, sequence_header, strand, expected_starts):
+    hits = iter_search_hits(fasta_file_path, sequence_header, "TCC")
+    assert expected_starts == [hit["start"] for hit in hits if hit["strand"] == strand]
+
+
+def test_iter_search_hits_across_windows(fasta_file_path):
+    all_hits = list(iter_search_hits(fasta_file_path, "", "GGCC"))
+    assert all_hits == list(
+        iter_search_hits(fasta_file_path, "", "GGCC", window_size=7)
+    )
+
+
+def test_search_cursor_round_trip():
+    cursor = encode_search_cursor("test_sequence", 41, "-")
+    assert ("test_sequence", 41, "-") == decode_search_cursor(cursor)
+    with pytest.raises(ValueError):
+        decode_search_cursor("not-a-cursor")
+
+
+def test_stream_search_hits_pages(fasta_file_path):
+    all_hits = list(iter_search_hits(fasta_file_path, "", "TCC"))
+
+    paged_hits, cursor = [], None
+    while True:
+        *hit_lines, last_line = stream_search_hits(
+            fasta_file_path, "", "TCC", limit=4, cursor=cursor
+        )
+        assert len(hit_lines) <= 4
+        paged_hits.extend(json.loads(line) for line in hit_lines)
+        cursor = json.loads(last_line)["next_cursor"]
+        if cursor is None:
+            break
+
+    assert all_hits == paged_hits
+
+
+def test_collect_search_hits_batches(fasta_file_path):
+    *page_lines, last_line = stream_search_hits(fasta_file_path, "", "TCC", limit=7)
+
+    batch_lines, cursor = [], None
+    while len(batch_lines) < 7:
+        hit_lines, cursor = collect_search_hits(
+            fasta_file_path, "", "TCC", min(2, 7 - len(batch_lines)), cursor
+        )
+        batch_lines.extend(hit_lines)
+        if cursor is None:
+            break
+
+    assert page_lines == batch_lines
+    assert json.loads(last_line)["next_cursor"] == cursor
+
+
+def test_storage_tiering(fasta_file_path, tmp_path):
+    hot_folder, cold_folder = tmp_path / "uploads", tmp_path / "cold"
+    hot_folder.mkdir()
+    for suffix in ["", ".fai"]:
+        shutil.copyfile(
+            f"{fasta_file_path}{suffix}", hot_folder / f"test_uid.fa{suffix}"
+        )
+
+    demoted = compact_storage(
+        hot_folder=str(hot_folder),
+        cold_folder=str(cold_folder),
+        budget_bytes=0,
+        access_log=str(tmp_path / "access.json"),
+    )
+    assert ["test_uid"] == demoted
+    assert not (hot_folder / "test_uid.fa").exists()
+    assert (cold_folder / "test_uid.fa.gz").exists()
+
+    hot_path = resolve_genome_path("test_uid", str(hot_folder), str(cold_folder))
+    assert not (cold_folder / "test_uid.fa.gz").exists()
+    assert ">test_sequence:1-10\nACAAGATGCC\n" == retrieveseq(
+        hot_path, "test_sequence:1-10"
+    )
+
+
+def test_compaction_keeps_genomes_accessed_during_it(
+    fasta_file_path, tmp_path, monkeypatch
+):
+    hot_folder, cold_folder = tmp_path / "uploads", tmp_path / "cold"
+    hot_folder.mkdir()
+    for suffix in ["", ".fai"]:
+        shutil.copyfile(
+            f"{fasta_file_path}{suffix}", hot_folder / f"test_uid.fa{suffix}"
+        )
+    access_log = str(tmp_path / "access.json")
+    with open(access_log, "w") as access_log_fh:
+        json.dump({"test_uid": 0}, access_log_fh)
+
+    # A request resolves the genome right after compaction lists the candidates
+    load_access_log = storage_tier_service.load_access_log
+
+    def load_access_log_then_access(access_log):
+        last_access = load_access_log(access_log)
+        storage_tier_service.record_access("test_uid", access_log=access_log)
+        return last_access
+
+    monkeypatch.setattr(
+        storage_tier_service, "load_access_log", load_access_log_then_access
+    )
+    demoted = compact_storage(
+        hot_folder=str(hot_folder),
+        cold_folder=str(cold_folder),
+        budget_bytes=0,
+        access_log=access_log,
+    )
+    assert [] == demoted
+    assert (hot_folder / "test_uid.fa").exists()
+    with open(access_log) as access_log_fh:
+        assert json.load(access_log_fh)["test_uid"] > 0
+
+
+def test_compaction_keeps_genomes_being_read(fasta_file_path, tmp_path, monkeypatch):
+    hot_folder, cold_folder = tmp_path / "uploads", tmp_path / "cold"
+    hot_folder.mkdir()
+    for suffix in ["", ".fai"]:
+        shutil.copyfile(
+            f"{fasta_file_path}{suffix}", hot_folder / f"test_uid.fa{suffix}"
+        )
+    access_log = str(tmp_path / "access.json")
+    with open(access_log, "w") as access_log_fh:
+        json.dump({"test_uid": 0}, access_log_fh)
+
+    # A query acquires the genome while it is compressed, without the tier lock
+    tabix_compress = pysam.tabix_compress
+
+    def tabix_compress_then_acquire(*args, **kwargs):
+        assert not storage_tier_service._tier_lock.locked()
+        tabix_compress(*args, **kwargs)
+        storage_tier_service.acquire_genome_path(
+            "test_uid", str(hot_folder), str(cold_folder)
+        )
+
+    monkeypatch.setattr(pysam, "tabix_compress", tabix_compress_then_acquire)
+    compaction_options = dict(
+        hot_folder=str(hot_folder),
+        cold_folder=str(cold_folder),
+        budget_bytes=0,
+        cold_after=0,
+        access_log=access_log,
+    )
+    assert [] == compact_storage(**compaction_options)
+    assert (hot_folder / "test_uid.fa").exists()
+    assert [] == list(cold_folder.iterdir())
+    monkeypatch.setattr(pysam, "tabix_compress", tabix_compress)
+
+    # Still being read, however long ago it was accessed
+    assert [] == compact_storage(**compaction_options, now=time.time() + 60)
+    storage_tier_service.release_genome("test_uid")
+    assert ["test_uid"] == compact_storage(**compaction_options)
+
+
+def test_concurrent_promotions(fasta_file_path, tmp_path):
+    hot_folder, cold_folder = tmp_path / "uploads", tmp_path / "cold"
+    cold_folder.mkdir()
+    hot_folder.mkdir()
+    pysam.tabix_compress(fasta_file_path, str(cold_folder / "test_uid.fa.gz"))
+    pysam.faidx(str(cold_folder / "test_uid.fa.gz"))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        hot_paths = list(
+            executor.map(
+                lambda _: resolve_genome_path(
+                    "test_uid", str(hot_folder), str(cold_folder)
+                ),
+                range(4),
+            )
+        )
+    assert [str(hot_folder / "test_uid.fa")] * 4 == hot_paths
+    assert ["test_uid.fa", "test_uid.fa.fai"] == sorted(os.listdir(hot_folder))
+    assert [] == list(cold_folder.iterdir())
+    assert ">test_sequence:1-10\nACAAGATGCC\n" == retrieveseq(
+        hot_paths[0], "test_sequence:1-10"
+    )
+
+
+def test_load_access_log_of_each_file(tmp_path):
+    for access_time in [1, 2]:
+        access_log = str(tmp_path / f"access_{access_time}.json")
+        with open(access_log, "w") as access_log_fh:
+            json.dump({"test_uid": access_time}, access_log_fh)
+        assert {"test_uid": access_time} == storage_tier_service.load_access_log(
+            access_log
+        )
+
+
+def test_register_genome(fasta_file_path, tmp_path):
+    with open(fasta_file_path, "rb") as fasta_fh:
+        fasta_body = fasta_fh.read()
+    request_file_items = [
+        (
+            "fasta_file",
+            [
+                {"filename": "first.fa", "body": fasta_body},
+                {"filename": "invalid.fa", "body": b"not a fasta file"},
+                {"filename": "second.fa", "body": fasta_body},
+            ],
+        )
+    ]
+    register_file = tmp_path / "genome_register.csv"
+
+    uploaded_files = asyncio.run(
+        register_genome(request_file_items, str(register_file), str(tmp_path))
+    )
+
+    assert ["first.fa", "second.fa"] == [
+        upload["filename"] for upload in uploaded_files["uploaded_files"]
+    ]
+    assert ["invalid.fa"] == [
+        failure["filename"] for failure in uploaded_files["failed_files"]
+    ]
+
+    registered_genomes = get_genomes(str(register_file))
+    for upload in uploaded_files["uploaded_files"]:
+        upload_path = registered_genomes[upload["unique_identifier"]]["upload_path"]
+        assert {"test_sequence": "368"} == read_index_file(upload_path)
+
+
+def test_register_genome_does_not_block_the_event_loop(
+    fasta_file_path, tmp_path, monkeypatch
+):
+    from service import genome_handler_sevice
+
+    with open(fasta_file_path, "rb") as fasta_fh:
+        request_file_items = [
+            ("fasta_file", [{"filename": "first.fa", "body": fasta_fh.read()}])
+        ]
+    indexed = threading.Event()
+    store_genome = genome_handler_sevice.store_genome
+
+    def store_genome_once_indexed(*args):
+        # Only set by a coroutine, so it times out if registering blocks the loop
+        if not indexed.wait(timeout=5):
+            return "Event loop was blocked"
+        return store_genome(*args)
+
+    monkeypatch.setattr(
+        genome_handler_sevice, "store_genome", store_genome_once_indexed
+    )
+
+    async def register_while_serving():
+        registration = asyncio.ensure_future(
+            register_genome(
+                request_file_items, str(tmp_path / "genome_register.csv"), str(tmp_path)
+            )
+        )
+        await asyncio.sleep(0.1)
+        indexed.set()
+        return await registration
+
+    uploaded_files = asyncio.run(register_while_serving())
+    assert "failed_files" not in uploaded_files
+    assert ["first.fa"] == [
+        upload["filename"] for upload in uploaded_files["uploaded_files"]
+    ]
+
+
+@pytest.mark.parametrize(
+    "query_type, sequence_header, query, expected_cost",
+    [
+        ("length", "", None, 0),
+        ("retrieveseq", "test_sequence:1-10", None, 10),
+        ("searchseq", "test_sequence", "TCC", 2 * 366),
+        ("searchseq", "unknown_sequence", "TCC", 0),
+    ],
+)
+def test_estimate_query_cost(
+    fasta_file_path, query_type, sequence_header, query, expected_cost
+):
+    assert expected_cost == estimate_query_cost(
+        fasta_file_path, query_type, sequence_header, query
+    )
+
+
+def test_admission_controller_rejects_when_queue_is_full():
+    async def run_queries():
+        controller = AdmissionController({"heavy": (1, 1), "light": (1, 1)})
+        release = asyncio.Event()
+
+        async def query(query_class):
+            async with controller.admit(query_class):
+                await release.wait()
+
+        running = asyncio.ensure_future(query("heavy"))
+        queued = asyncio.ensure_future(query("heavy"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected):
+            await query("heavy")
+
+        # Light queries have their own limits
+        light = asyncio.ensure_future(query("light"))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(running, queued, light)
+
+    asyncio.run(run_queries())
+
+
+def test_light_query_completes_while_heavy_queries_are_queued(
+    fasta_file_path, monkeypatch
+):
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.testing import bind_unused_port
+
+    from app import make_app
+    from service import admission_service, query_handler_service
+
+    heavy_pool = ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    light_threads = []
+
+    def blocking_searchseq(*args):
+        release.wait()
+        return "searched"
+
+    def get_length(*args):
+        light_threads.append(threading.current_thread())
+        return {"test_sequence": "368"}
+
+    # Searches are heavy, lengths are light, one of each runs at a time
+    monkeypatch.setattr(admission_service, "heavy_query_cost", 1)
+    monkeypatch.setattr(admission_service, "get_heavy_query_pool", lambda: heavy_pool)
+    monkeypatch.setattr(
+        admission_service,
+        "_admission_controller",
+        AdmissionController(
+            {admission_service.LIGHT: (1, 1), admission_service.HEAVY: (1, 1)}
+        ),
+    )
+    monkeypatch.setattr(query_handler_service, "searchseq", blocking_searchseq)
+    monkeypatch.setattr(query_handler_service, "get_length", get_length)
+    monkeypatch.setattr(
+        storage_tier_service, "acquire_genome_path", lambda *args: fasta_file_path
+    )
+
+    async def run_queries():
+        sock, port = bind_unused_port()
+        server = HTTPServer(make_app())
+        server.add_sockets([sock])
+        client = AsyncHTTPClient()
+        url = f"http://127.0.0.1:{port}/queryengine"
+
+        heavy = [
+            asyncio.ensure_future(
+                client.fetch(f"{url}/searchseq/?uid=test_uid&query=TCC")
+            )
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.1)
+
+        light = await client.fetch(
+            f"{url}/length/?uid=test_uid&sequence_region=test_sequence",
+            request_timeout=5,
+        )
+        assert {"test_sequence": "368"} == json.loads(light.body)["data"]
+        assert not any(future.done() for future in heavy)
+
+        release.set()
+        for response in await asyncio.gather(*heavy):
+            assert "searched" == json.loads(response.body)["data"]
+        server.stop()
+
+    try:
+        asyncio.run(run_queries())
+    finally:
+        release.set()
+        heavy_pool.shutdown()
+
+    # Light queries run on their own thread pool, not on the IOLoop
+    assert [threading.main_thread()] != light_threads
+    assert light_threads[0].name.startswith("light_query")
+
+
+def test_search_genome(fasta_file_path):
+    result = search_genome("test_uid", fasta_file_path, "TCC", max_hits=2)
+    assert result["contains_query"]
+    assert [15, 25] == [hit["start"] for hit in result["hits"]]
+
+    result = search_genome("test_uid", fasta_file_path, "NNNNN", max_hits=2)
+    assert not result["contains_query"]
+
+
+@pytest.mark.parametrize("any_hit, expected_results", [(False, 3), (True, 1)])
+def test_federated_search(fasta_file_path, any_hit, expected_results):
+    genome_paths = {f"uid_{index}": fasta_file_path for index in range(3)}
+
+    async def collect_results():
+        return [
+            result
+            async for result in federated_search(
+                genome_paths, "TCC", max_hits=5, any_hit=any_hit
+            )
+        ]
+
+    results = asyncio.run(collect_results())
+    assert expected_results == len(results)
+    assert all(result["contains_query"] for result in results)
+
+
+def test_federated_search_reports_missing_genomes(fasta_file_path, monkeypatch):
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.testing import bind_unused_port
+
+    from app import make_app
+    from service import query_handler_service
+
+    # Both genomes are registered, only the first one has a FASTA file
+    monkeypatch.setattr(
+        query_handler_service,
+        "get_genomes",
+        lambda: {"test_uid": {}, "missing_uid": {}},
+    )
+    monkeypatch.setattr(
+        storage_tier_service,
+        "locate_genome_path",
+        lambda unique_identifier: (
+            fasta_file_path if unique_identifier == "test_uid" else None
+        ),
+    )
+
+    async def fetch_results():
+        sock, port = bind_unused_port()
+        server = HTTPServer(make_app())
+        server.add_sockets([sock])
+        response = await AsyncHTTPClient().fetch(
+            f"http://127.0.0.1:{port}/queryengine/federatedsearch/?query=TCC",
+            request_timeout=30,
+        )
+        server.stop()
+        return [json.loads(line) for line in response.body.decode().splitlines()]
+
+    *genome_results, summary = asyncio.run(fetch_results())
+    genome_results = {result["unique_identifier"]: result for result in genome_results}
+    assert {"test_uid", "missing_uid"} == set(genome_results)
+    assert genome_results["test_uid"]["contains_query"]
+    assert "Genome file not found" == genome_results["missing_uid"]["error"]
+    assert {
+        "searched_genomes": 1,
+        "genomes_with_hits": 1,
+        "missing_genomes": ["missing_uid"],
+        "complete": True,
+    } == summary
+
+
+@pytest.mark.parametrize(
+    "sequence_header",
+    ["test_sequence", "test_sequence:65-145", "test_sequence:300-1000"],
+)
+def test_retrieveseq_matches_samtools(fasta_file_path, sequence_header):
+    block_cache = BlockCache(max_bytes=100, block_size=16)
+    assert pysam.faidx(fasta_file_path, sequence_header) == retrieveseq(
+        fasta_file_path, sequence_header, block_cache
+    )
+
+
+def test_block_cache(fasta_file_path):
+    block_cache = BlockCache(max_bytes=64, block_size=16)
+    with pysam.FastaFile(fasta_file_path) as fasta:
+        for start in range(0, 60, 10):
+            expected = fasta.fetch("test_sequence", start, start + 20)
+            assert expected == block_cache.fetch(
+                fasta_file_path, "test_sequence", start, start + 20
+            )
+
+    stats = block_cache.stats()
+    assert stats["misses"] == 5
+    assert stats["hits"] > 0
+    assert stats["cached_bytes"] <= 64
+
+
+def test_heavy_retrieveseq_uses_the_shared_block_cache(fasta_file_path, monkeypatch):
+    from tornado.httpclient import AsyncHTTPClient
+    from tornado.httpserver import HTTPServer
+    from tornado.testing import bind_unused_port
+
+    from app import make_app
+    from service import admission_service, block_cache_service
+
+    monkeypatch.setattr(admission_service, "heavy_query_cost", 1)
+    monkeypatch.setattr(block_cache_service, "_block_cache", BlockCache())
+    monkeypatch.setattr(
+        storage_tier_service, "acquire_genome_path", lambda *args: fasta_file_path
+    )
+
+    async def fetch_data(paths):
+        sock, port = bind_unused_port()
+        server = HTTPServer(make_app())
+        server.add_sockets([sock])
+        client = AsyncHTTPClient()
+        responses = [
+            await client.fetch(f"http://127.0.0.1:{port}/queryengine/{path}")
+            for path in paths
+        ]
+        server.stop()
+        return [json.loads(response.body)["data"] for response in responses]
+
+    *sequences, cache_stats = asyncio.run(
+        fetch_data(
+            ["retrieveseq/?uid=test_uid&sequence_region=test_sequence:1-10"] * 2
+            + ["cachestats/"]
+        )
+    )
+    assert [">test_sequence:1-10\nACAAGATGCC\n"] * 2 == sequences
+    assert (1, 1) == (cache_stats["hits"], cache_stats["misses"])
+
+
+def test_fasta_handle_pool_reuses_handles(fasta_file_path):
+    handle_pool = FastaHandlePool(max_handles=1)
+    with handle_pool.handle(fasta_file_path) as first_handle:
+        with handle_pool.handle(fasta_file_path) as second_handle:
+            assert first_handle is not second_handle
+
+    # Only one idle handle is kept, and it is handed out again
+    with handle_pool.handle(fasta_file_path) as reused_handle:
+        assert reused_handle in [first_handle, second_handle]
+        assert "ACAAGATGCC" == reused_handle.fetch("test_sequence", 0, 10)
+
+
+def test_read_index_file_reloads_changed_index(fasta_file_path, tmp_path):
+    copied_fasta_file_path = str(tmp_path / "test_fasta.fa")
+    shutil.copyfile(fasta_file_path, copied_fasta_file_path)
+    shutil.copyfile(f"{fasta_file_path}.fai", f"{copied_fasta_file_path}.fai")
+    assert {"test_sequence": "368"} == read_index_file(copied_fasta_file_path)
+
+    with open(f"{copied_fasta_file_path}.fai", "w") as index_fh:
+        index_fh.write("renamed_sequence\t368\t15\t70\t71\n")
+    assert {"renamed_sequence": "368"} == read_index_file(copied_fasta_file_path)
@@ -0,0 +1,453 @@
+import logging
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+from itertools import islice
+
+import click
+import numpy as np
+import pandas as pd
+import pyfastx
+from Levenshtein import hamming
+from scipy import spatial
+
+from utilities import (
+    cli_options,
+    hamming_utils,
+    pipeline_utils,
+    synthetic_utils,
+    umi_codes,
+    umi_utils,
+)
+
+# Options of the synthetic FASTQ generator, shared by the generate and stages benchmarks
+SYNTHETIC_OPTIONS = [
+    click.option("--number_of_reads", default=1_000_000, help="Number of reads"),
+    click.option("--unique_umis", default=10_000, help="Number of true UMI's"),
+    click.option(
+        "--error_rate",
+        default=0.001,
+        type=click.FloatRange(0, 1),
+        help="Substitution probability of each UMI base",
+    ),
+    click.option(
+        "--flank_error_rate",
+        default=0.0,
+        type=click.FloatRange(0, 1),
+        help="Substitution probability of each UMI prefix and suffix base",
+    ),
+    click.option("--umi_prefix", default="CTCGACAA", help="UMI Prefix"),
+    click.option("--umi_suffix", default="AAGGGGAG", help="UMI Suffix"),
+    click.option("--umi_length", default=10, help="UMI length"),
+    click.option("--read_length", default=150, help="Read length"),
+    click.option("--gzip/--no_gzip", "gzipped", default=False, help="gzip the FASTQ"),
+    click.option("--seed", default=0, help="Random seed"),
+]
+
+
+def legacy_extract_umi_from_fastq(input_fastq, umi_prefix, umi_suffix, max_reads):
+    """Previous extraction path, kept as a baseline: one regex compile and one pd.concat per read.
+
+    Args:
+        input_fastq (file): *.fastq or *.fastq.gz file.
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        max_reads (int): Stop after this many reads, the run time grows quadratically
+
+    Returns:
+        pandas dataframe: Sequence headers and UMI sequences
+    """
+    main_readname_umi_df = pd.DataFrame(columns=["ReadName", "UMI"])
+    for name, sequence, *_ in islice(pyfastx.Fastx(input_fastq), max_reads):
+        umi_regex_pattern = re.compile(f"{umi_prefix}(.*){umi_suffix}", re.IGNORECASE)
+        umi = umi_regex_pattern.search(sequence).group(1)
+        current_readname_umi_df = pd.DataFrame({"ReadName": [name], "UMI": [umi]})
+        main_readname_umi_df = pd.concat(
+            [main_readname_umi_df, current_readname_umi_df], ignore_index=True
+        )
+    return main_readname_umi_df
+
+
+def time_call(function, *args, **kwargs):
+    """Run a function and return its result and wall time in seconds."""
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def trace_call(function, *args, **kwargs):
+    """Run a function and return its result and peak traced memory in bytes."""
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_pipeline_stages(
+    measure,
+    output_dir,
+    input_fastq,
+    umi_prefix,
+    umi_suffix,
+    threads,
+    umi_encoding,
+    collapse_method,
+    flank_mismatches=0,
+    umi_length=None,
+):
+    """Run the stages of parse_fastq.main one after another, without the cache.
+
+    Args:
+        measure (function): time_call or trace_call, run on each stage
+        output_dir (str): Output folder
+        input_fastq (file): *.fastq or *.fastq.gz file.
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        threads (int): Number of extraction processes
+        umi_encoding (str): One of umi_codes.UMI_ENCODINGS
+        collapse_method (str): One of cluster_utils.COLLAPSE_METHODS
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+
+    Returns:
+        tuple: (report, cluster_result, measurements) - summary from pipeline_utils.report_stage, output of cluster_stage and the measurement of each stage
+    """
+    measurements = {}
+    extract_result, measurements["extract"] = measure(
+        pipeline_utils.extract_stage,
+        output_dir,
+        input_fastq,
+        umi_prefix,
+        umi_suffix,
+        threads=threads,
+        umi_encoding=umi_encoding,
+        flank_mismatches=flank_mismatches,
+        umi_length=umi_length,
+        use_cache=False,
+    )
+    count_result, measurements["count"] = measure(
+        pipeline_utils.count_stage, output_dir, extract_result, use_cache=False
+    )
+    distance_result, measurements["distances"] = measure(
+        pipeline_utils.distance_stage, output_dir, count_result, use_cache=False
+    )
+    cluster_result, measurements["cluster"] = measure(
+        pipeline_utils.cluster_stage,
+        output_dir,
+        count_result,
+        collapse_method=collapse_method,
+        use_cache=False,
+    )
+    report, measurements["report"] = measure(
+        pipeline_utils.report_stage,
+        output_dir,
+        count_result,
+        distance_result,
+        cluster_result,
+    )
+    return report, cluster_result, measurements
+
+
+def count_umis(reads, umi_length, umi_encoding):
+    """Cut the UMI out of each read and count it, the way extraction does."""
+    unique_umi_counts = umi_utils.create_umi_counter(umi_encoding)
+    if umi_encoding == "2bit":
+        for read in reads:
+            unique_umi_counts.add(read[1 : umi_length + 1])
+        len(unique_umi_counts)
+    else:
+        for read in reads:
+            unique_umi_counts[read[1 : umi_length + 1]] += 1
+    return unique_umi_counts
+
+
+@click.group()
+def cli():
+    """Benchmarks for the UMI pipeline. Run from the genomics_coding_challenge folder."""
+
+
+@cli.command()
+@click.option(
+    "--input_fastq",
+    required=True,
+    type=click.Path(exists=True),
+    help="Input FASTQ file to extract UMI from. Can be gzipped",
+)
+@click.option("--umi_prefix", default="CTCGACAA", help="UMI Prefix")
+@click.option("--umi_suffix", default="AAGGGGAG", help="UMI Suffix")
+@click.option(
+    "--legacy_max_reads",
+    default=5000,
+    type=int,
+    help="Number of reads the previous, quadratic extraction path is run on",
+)
+def extraction(input_fastq, umi_prefix, umi_suffix, legacy_max_reads):
+    """Compare reads/sec of streaming UMI extraction against the previous extraction path."""
+    legacy_df, legacy_seconds = time_call(
+        legacy_extract_umi_from_fastq,
+        input_fastq,
+        umi_prefix,
+        umi_suffix,
+        legacy_max_reads,
+    )
+    unique_umi_counts, streaming_seconds = time_call(
+        umi_utils.extract_umis,
+        input_fastq,
+        umi_prefix,
+        umi_suffix,
+        read_umi_file=os.devnull,
+    )
+    counts_only, counts_only_seconds = time_call(
+        umi_utils.extract_umis, input_fastq, umi_prefix, umi_suffix
+    )
+
+    number_of_reads = sum(unique_umi_counts.values())
+    for label, reads, seconds in [
+        ("previous (regex + pd.concat)", len(legacy_df), legacy_seconds),
+        ("streaming, writing the per read table", number_of_reads, streaming_seconds),
+        ("streaming, counts only", sum(counts_only.values()), counts_only_seconds),
+    ]:
+        logging.info(
+            f"{label}: {reads} reads in {seconds:.3f}s - {reads / seconds:,.0f} reads/sec"
+        )
+
+
+@cli.command()
+@click.option("--number_of_reads", default=2_000_000, help="Number of UMI's to count")
+@click.option("--unique_umis", default=500_000, help="Number of distinct UMI's")
+@click.option("--umi_length", default=10, help="UMI length")
+def counting(number_of_reads, unique_umis, umi_length):
+    """Compare time and memory of counting UMI's as strings and as 2-bit codes."""
+    rng = np.random.default_rng(0)
+    library = umi_codes.decode_umis(
+        rng.choice(4**umi_length, size=unique_umis, replace=False), umi_length
+    )
+    reads = [
+        f"N{library[index]}N" for index in rng.integers(0, unique_umis, number_of_reads)
+    ]
+
+    for umi_encoding in umi_codes.UMI_ENCODINGS:
+        unique_umi_counts, seconds = time_call(
+            count_umis, reads, umi_length, umi_encoding
+        )
+        del unique_umi_counts
+
+        # Memory is measured in a second run, tracing allocations slows counting down
+        tracemalloc.start()
+        unique_umi_counts = count_umis(reads, umi_length, umi_encoding)
+        counter_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        logging.info(
+            f"{umi_encoding}: {number_of_reads} reads, {len(unique_umi_counts)} unique UMI's "
+            f"in {seconds:.3f}s - {number_of_reads / seconds:,.0f} reads/sec, "
+            f"{counter_bytes / 2**20:.1f} MB"
+        )
+        del unique_umi_counts
+
+
+@cli.command("hamming")
+@click.option(
+    "--unique_umis",
+    "unique_umi_sizes",
+    multiple=True,
+    default=[10_000, 50_000, 100_000],
+    help="Number of unique UMI's, can be repeated",
+)
+@click.option("--umi_length", default=10, help="UMI length")
+@click.option(
+    "--legacy_umis",
+    default=2000,
+    help="Number of UMI's the previous pdist + Levenshtein path is run on, its pairs/sec is extrapolated",
+)
+@click.option(
+    "--condensed_max_umis",
+    default=50_000,
+    help="Largest number of UMI's to also build the condensed matrix for, it takes n^2/2 bytes",
+)
+def hamming_distance(unique_umi_sizes, umi_length, legacy_umis, condensed_max_umis):
+    """Compare pairwise Hamming distance engines at increasing numbers of unique UMI's."""
+    rng = np.random.default_rng(0)
+    legacy_sample = sorted(
+        umi_codes.decode_umis(
+            rng.choice(4**umi_length, size=legacy_umis, replace=False), umi_length
+        )
+    )
+    _, legacy_seconds = time_call(
+        spatial.distance.pdist,
+        np.array(legacy_sample).reshape(-1, 1),
+        lambda x, y: hamming(x[0], y[0]),
+    )
+    legacy_pairs_per_second = legacy_umis * (legacy_umis - 1) / 2 / legacy_seconds
+
+    for unique_umis in unique_umi_sizes:
+        umis = sorted(
+            umi_codes.decode_umis(
+                rng.choice(4**umi_length, size=unique_umis, replace=False), umi_length
+            )
+        )
+        number_of_pairs = unique_umis * (unique_umis - 1) // 2
+        logging.info(
+            f"{unique_umis} UMI's, {number_of_pairs:,} pairs. Condensed matrix takes "
+            f"{number_of_pairs * 8 / 2**30:.2f} GB as float64 (pdist), "
+            f"{number_of_pairs / 2**30:.2f} GB as uint8"
+        )
+        logging.info(
+            f"  previous (pdist + Levenshtein): {legacy_pairs_per_second:,.0f} pairs/sec "
+            f"(measured on {legacy_umis} UMI's), ~{number_of_pairs / legacy_pairs_per_second:,.0f}s"
+        )
+
+        # Blocks are reduced to a count as they are produced, nothing is kept
+        started = time.perf_counter()
+        close_pairs = 0
+        for row_start, block in hamming_utils.iter_hamming_distance_blocks(umis):
+            close_pairs += int(np.count_nonzero(np.triu(block <= 2, k=1)))
+        block_seconds = time.perf_counter() - started
+        logging.info(
+            f"  numpy blocks: {number_of_pairs / block_seconds:,.0f} pairs/sec, "
+            f"{block_seconds:.3f}s, {close_pairs} pairs within distance 2"
+        )
+
+        (rows, _, _), neighbor_seconds = time_call(
+            hamming_utils.find_similar_pairs, umis, 2
+        )
+        logging.info(
+            f"  neighbor index: {neighbor_seconds:.3f}s, {len(rows)} pairs within distance 2"
+        )
+
+        if unique_umis <= condensed_max_umis:
+            _, condensed_seconds = time_call(
+                hamming_utils.pairwise_hamming_distance, umis
+            )
+            logging.info(
+                f"  numpy condensed matrix: {number_of_pairs / condensed_seconds:,.0f} pairs/sec, "
+                f"{condensed_seconds:.3f}s"
+            )
+
+
+@cli.command()
+@click.option(
+    "--output_fastq",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="FASTQ file to write",
+)
+@click.option(
+    "--truth_file",
+    type=click.Path(dir_okay=False),
+    help="Tab separated table of the true and observed UMI of each read",
+)
+@cli_options.add_options(SYNTHETIC_OPTIONS)
+def generate(output_fastq, truth_file, **synthetic_options):
+    """Write a synthetic FASTQ file with known UMI's and base call errors."""
+    truth, seconds = time_call(
+        synthetic_utils.generate_fastq, output_fastq, truth_file, **synthetic_options
+    )
+    logging.info(
+        f"{truth['Reads']} reads, {truth['Error_Bases']} substituted UMI bases in {seconds:.3f}s. "
+        f"True percentage of accurately called bases is {truth['Accurate_Bases_Percentage']}%"
+    )
+
+
+@cli.command()
+@cli_options.add_options(SYNTHETIC_OPTIONS)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of extraction processes. Memory of worker processes is not traced",
+)
+@click.option(
+    "--umi_encoding",
+    type=click.Choice(umi_codes.UMI_ENCODINGS),
+    default="string",
+    help="UMI encoding",
+)
+@click.option(
+    "--flank_mismatches",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Largest number of mismatches in each flank",
+)
+@click.option(
+    "--max_accuracy_error",
+    type=click.FloatRange(min=0),
+    help="Fail if the reported percentage of accurately called bases is further than this from the true one",
+)
+@cli_options.add_options(cli_options.CLUSTER_OPTIONS)
+def stages(
+    threads,
+    umi_encoding,
+    flank_mismatches,
+    max_accuracy_error,
+    collapse_method,
+    **synthetic_options,
+):
+    """Time each stage of the pipeline on a synthetic FASTQ file, and check its accuracy against the truth."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        input_fastq = os.path.join(
+            output_dir,
+            "synthetic.fastq.gz" if synthetic_options["gzipped"] else "synthetic.fastq",
+        )
+        truth = synthetic_utils.generate_fastq(input_fastq, **synthetic_options)
+        stage_options = dict(
+            output_dir=output_dir,
+            input_fastq=input_fastq,
+            umi_prefix=synthetic_options["umi_prefix"],
+            umi_suffix=synthetic_options["umi_suffix"],
+            threads=threads,
+            umi_encoding=umi_encoding,
+            collapse_method=collapse_method,
+            flank_mismatches=flank_mismatches,
+            umi_length=synthetic_options["umi_length"],
+        )
+        report, cluster_result, stage_seconds = run_pipeline_stages(
+            time_call, **stage_options
+        )
+
+        # Memory is measured in a second run, tracing allocations slows the stages down
+        _, _, stage_peak_bytes = run_pipeline_stages(trace_call, **stage_options)
+
+    number_of_reads = truth["Reads"]
+    for stage, seconds in stage_seconds.items():
+        logging.info(
+            f"{stage}: {seconds:.3f}s - {number_of_reads / seconds:,.0f} reads/sec, "
+            f"peak {stage_peak_bytes[stage] / 2**20:.1f} MB"
+        )
+    total_seconds = sum(stage_seconds.values())
+    logging.info(
+        f"all stages: {total_seconds:.3f}s - {number_of_reads / total_seconds:,.0f} reads/sec"
+    )
+
+    logging.info(
+        f"{report['Unique_UMIs']} unique UMI's observed from {truth['Unique_UMIs']} true UMI's"
+    )
+    logging.info(
+        f"{truth['Flank_Error_Reads']} reads with flank errors, {report['Recovered_Reads']} "
+        f"recovered with flank mismatches, {report['Failed_Reads']} skipped"
+    )
+    if "Cluster_UMI" in cluster_result.data:
+        logging.info(
+            f"{len(set(cluster_result.data['Cluster_UMI'].tolist()))} clusters"
+        )
+    accuracy_error = (
+        report["Accurate_Bases_Percentage"] - truth["Accurate_Bases_Percentage"]
+    )
+    logging.info(
+        f"Percentage of accurately called bases is {report['Accurate_Bases_Percentage']}% "
+        f"reported, {truth['Accurate_Bases_Percentage']}% true, error "
+        f"{accuracy_error:+.4f}"
+    )
+    # A NaN error, without UMI bases, fails too
+    if max_accuracy_error is not None and not abs(accuracy_error) <= max_accuracy_error:
+        raise click.ClickException(
+            f"Accuracy error {accuracy_error:+.4f} is larger than {max_accuracy_error}"
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    cli()
@@ -0,0 +1,1009 @@
+import gzip
+import math
+import json
+import pickle
+import pstats
+import random
+import re
+import sys
+import tracemalloc
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pyfastx
+import pytest
+from Levenshtein import hamming
+from scipy import spatial
+
+import matplotlib.pyplot as plt
+
+from utilities import (
+    batch_utils,
+    cluster_utils,
+    flank_utils,
+    hamming_utils,
+    pipeline_utils,
+    plotting_utils,
+    profile_utils,
+    quality_utils,
+    store_utils,
+    stream_utils,
+    synthetic_utils,
+    table_utils,
+    umi_codes,
+    umi_utils,
+)
+from utilities.umi_codes import EncodedUmiCounts
+
+
+def encoded_counts(umis):
+    umi_counts = EncodedUmiCounts()
+    for umi in umis:
+        umi_counts.add(umi)
+    return umi_counts
+
+
+def test_encoded_umi_counts_update_empty():
+    umi_counts = EncodedUmiCounts()
+    umi_counts.update(EncodedUmiCounts())
+    assert len(umi_counts) == 0
+    assert umi_counts.items() == []
+
+
+def test_encoded_umi_counts_update_fallback_only():
+    fallback_umis = ["ACGN", "NNNN", "ACGN", "A" * 20]
+    umi_counts = encoded_counts(fallback_umis)
+    umi_counts.update(encoded_counts(["NNNN", "TTGN"]))
+    assert umi_counts.items() == list(Counter(fallback_umis + ["NNNN", "TTGN"]).items())
+
+    umi_counts = encoded_counts(["ACGT", "ACGT", "TTTT"])
+    umi_counts.update(encoded_counts(fallback_umis))
+    assert umi_counts.items() == list(
+        Counter(["ACGT", "ACGT", "TTTT"] + fallback_umis).items()
+    )
+
+
+def test_encoded_umi_counts_update_pickled():
+    umi_counts = EncodedUmiCounts()
+    umi_counts.update(pickle.loads(pickle.dumps(EncodedUmiCounts())))
+    umi_counts.update(pickle.loads(pickle.dumps(encoded_counts(["ACGN", "ACGN"]))))
+    umi_counts.update(pickle.loads(pickle.dumps(encoded_counts(["ACGT", "ACGN"]))))
+    assert umi_counts.items() == [("ACGN", 3), ("ACGT", 1)]
+
+
+def random_umis(rng, number_of_umis, lengths=(6,), bases="ACGT"):
+    return [
+        "".join(rng.choice(bases) for _ in range(rng.choice(lengths)))
+        for _ in range(number_of_umis)
+    ]
+
+
+@pytest.mark.parametrize(
+    "umis",
+    [
+        [],
+        ["NNNNNN", "ACGNNN", "NNNNNN"],
+        random_umis(random.Random(0), 500),
+        random_umis(random.Random(1), 500, lengths=(6, 6, 6, 5, 20), bases="ACGTN"),
+        ["", "ACGT", ""] + random_umis(random.Random(2), 100, lengths=(4,)),
+    ],
+)
+@pytest.mark.parametrize("batch_size", [7, umi_codes.ENCODE_BATCH_SIZE])
+def test_encoded_umi_counts_match_counter(monkeypatch, umis, batch_size):
+    monkeypatch.setattr(umi_codes, "ENCODE_BATCH_SIZE", batch_size)
+    umi_counts, expected = encoded_counts(umis), Counter(umis)
+
+    assert umi_counts.items() == list(expected.items())
+    assert umi_counts.most_common() == expected.most_common()
+    assert umi_counts.most_common(3) == expected.most_common(3)
+    assert len(umi_counts) == len(expected)
+    assert all(umi_counts[umi] == expected[umi] for umi in expected)
+    assert umi_counts["TTTTTT"] == expected["TTTTTT"]
+    assert ("NNNNNN" in umi_counts) == ("NNNNNN" in expected)
+
+    # Counted in parts and merged, like the shards of a FASTQ file
+    merged, parts = EncodedUmiCounts(), [umis[:50], umis[50:51], umis[51:]]
+    for part in parts:
+        merged.update(encoded_counts(part))
+    assert merged.items() == list(expected.items())
+    merged.update(Counter(umis[:10]))
+    expected.update(umis[:10])
+    assert merged.items() == list(expected.items())
+
+    # A Counter merged into empty counts, then more UMI's added
+    from_counter = EncodedUmiCounts()
+    from_counter.update(Counter(umis[:50]))
+    for umi in umis[50:]:
+        from_counter.add(umi)
+    assert from_counter.items() == list(Counter(umis).items())
+    assert len(from_counter) == len(Counter(umis))
+    assert all(from_counter[umi] == count for umi, count in Counter(umis).items())
+
+
+@pytest.mark.parametrize(
+    "umi_length,bases",
+    # uint32 codes, uint64 codes, uint8 matrices for N's and for long UMI's
+    [(1, "ACGT"), (10, "ACGT"), (16, "ACGT"), (17, "ACGT"), (31, "ACGT")]
+    + [(8, "ACGTN"), (40, "ACGT")],
+)
+@pytest.mark.parametrize("block_elements", [1, 7, hamming_utils.HAMMING_BLOCK_ELEMENTS])
+def test_pairwise_hamming_distance_match_brute_force(umi_length, bases, block_elements):
+    umis = random_umis(random.Random(umi_length), 60, (umi_length,), bases)
+    # Similar UMI's, a base or two apart
+    umis += [umi[:-2] + "AA" for umi in umis[:10] if len(umi) > 2]
+    expected = [[hamming(umi, other) for other in umis] for umi in umis]
+
+    blocks = list(hamming_utils.iter_hamming_distance_blocks(umis, block_elements))
+    assert [row_start for row_start, _ in blocks] == sorted(
+        {row_start for row_start, _ in blocks}
+    )
+    for row_start, block in blocks:
+        for row in range(len(block)):
+            assert block[row].tolist() == expected[row_start + row][row_start:]
+    assert sum(len(block) for _, block in blocks) == len(umis)
+
+    condensed = hamming_utils.pairwise_hamming_distance(umis, block_elements)
+    matrix = hamming_utils.encode_umi_matrix(umis)
+    assert np.array_equal(
+        condensed, np.rint(spatial.distance.pdist(matrix, "hamming") * umi_length)
+    )
+
+    codes = hamming_utils.pack_umis(umis)
+    if codes is not None:
+        assert codes.dtype == (np.uint32 if umi_length <= 16 else np.uint64)
+        assert (
+            hamming_utils.packed_hamming_distance(
+                codes[:, None], codes[None, :]
+            ).tolist()
+            == expected
+        )
+
+
+def brute_force_pairs(umis, max_distance):
+    return [
+        (row, column, hamming(umis[row], umis[column]))
+        for row in range(len(umis))
+        for column in range(row + 1, len(umis))
+        if 0 < hamming(umis[row], umis[column]) <= max_distance
+    ]
+
+
+@pytest.mark.parametrize("max_distance", [1, 2, 3])
+# UMI's no longer than max_distance have every position masked
+@pytest.mark.parametrize(
+    "umi_length,bases",
+    [
+        (5, "ACGT"),
+        (6, "ACGTN"),
+        (40, "AC"),
+        (1, "ACGTN"),
+        (2, "ACGTN"),
+        (3, "ACGTN"),
+        (2, "ACGT"),
+    ],
+)
+def test_find_similar_pairs_match_brute_force(max_distance, umi_length, bases):
+    umis = sorted(
+        set(random_umis(random.Random(umi_length), 300, (umi_length,), bases))
+    )
+    rows, columns, distances = hamming_utils.find_similar_pairs(umis, max_distance)
+    assert list(zip(rows.tolist(), columns.tolist(), distances.tolist())) == (
+        brute_force_pairs(umis, max_distance)
+    )
+
+
+def test_find_similar_umis_match_brute_force():
+    umis = random_umis(random.Random(0), 200, (5,))
+    sorted_umis = sorted(set(umis))
+    expected, seen = [], set()
+    for umi in sorted_umis:
+        similar_umis = [other for other in sorted_umis if 0 < hamming(umi, other) <= 1]
+        if not similar_umis:
+            continue
+        similar_umis = sorted([umi] + similar_umis)
+        if tuple(similar_umis) not in seen:
+            seen.add(tuple(similar_umis))
+            expected.append(similar_umis)
+    assert umi_utils.find_similar_umis(Counter(umis), 1) == expected
+
+
+# UMI, count, its cluster UMI by the directional and connected methods
+CLUSTER_EXAMPLE = [
+    ("AAAAAA", 100, "AAAAAA", "AAAAAA"),
+    # 100 >= 2 * 40 - 1
+    ("AAAAAT", 40, "AAAAAA", "AAAAAA"),
+    # 40 < 2 * 30 - 1, starts its own cluster
+    ("AAAATT", 30, "AAAATT", "AAAAAA"),
+    ("AAAATG", 10, "AAAATT", "AAAAAA"),
+    # 100 < 2 * 60 - 1
+    ("CAAAAA", 60, "CAAAAA", "AAAAAA"),
+    ("CAAAAC", 1, "CAAAAA", "AAAAAA"),
+    # Equal counts, the first UMI in order is the cluster UMI
+    ("TTTTTG", 1, "TTTTTG", "TTTTTG"),
+    ("TTTTTT", 1, "TTTTTG", "TTTTTG"),
+    ("GGGGGG", 5, "GGGGGG", "GGGGGG"),
+]
+
+
+@pytest.mark.parametrize(
+    "method,expected_column", [("directional", 2), ("connected", 3)]
+)
+def test_cluster_umis_example(method, expected_column):
+    umi_clusters = cluster_utils.cluster_umis(
+        Counter({row[0]: row[1] for row in CLUSTER_EXAMPLE}), 1, method=method
+    )
+    expected = sorted((row[0], row[expected_column]) for row in CLUSTER_EXAMPLE)
+    assert list(zip(umi_clusters.UMI, umi_clusters.Cluster_UMI)) == expected
+    assert umi_clusters.Distance.tolist() == [
+        hamming(umi, cluster_umi) for umi, cluster_umi in expected
+    ]
+
+
+def test_union_find_components_match_graph_search():
+    rng = np.random.default_rng(0)
+    number_of_umis = 300
+    rows = rng.integers(0, number_of_umis, 250)
+    columns = rng.integers(0, number_of_umis, 250)
+
+    neighbors = [[] for _ in range(number_of_umis)]
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        neighbors[row].append(column)
+        neighbors[column].append(row)
+    expected = [-1] * number_of_umis
+    for root in range(number_of_umis):
+        if expected[root] >= 0:
+            continue
+        expected[root] = root
+        component = [root]
+        for umi in component:
+            for neighbor in neighbors[umi]:
+                if expected[neighbor] < 0:
+                    expected[neighbor] = root
+                    component.append(neighbor)
+
+    roots = cluster_utils.union_find_components(number_of_umis, rows, columns)
+    assert roots.tolist() == expected
+
+
+@pytest.mark.parametrize(
+    "quality_strings",
+    [
+        [],
+        ["IIII", "#5?I", "!!!!"],
+        ["IIII", "", "#5?", "I", ""],
+        ["", ""],
+    ],
+)
+def test_summarize_umi_qualities(quality_strings):
+    min_qualities, mean_qualities, correct_probabilities = (
+        quality_utils.summarize_umi_qualities(quality_strings)
+    )
+    for quality, min_quality, mean_quality, correct_probability in zip(
+        quality_strings, min_qualities, mean_qualities, correct_probabilities
+    ):
+        scores = [ord(character) - 33 for character in quality]
+        assert min_quality == (min(scores) if scores else 255)
+        assert mean_quality == pytest.approx(np.mean(scores) if scores else 255)
+        assert correct_probability == pytest.approx(
+            np.prod([1 - min(10 ** (-score / 10), 0.75) for score in scores])
+        )
+    assert len(min_qualities) == len(quality_strings)
+
+
+@pytest.mark.parametrize("weighted", [False, True])
+def test_umi_quality_filter(weighted):
+    reads = [("ACGT", "IIII"), ("ACGT", "II#I"), ("TTTT", "5555"), ("ACGT", "IIII")]
+    quality_filter = quality_utils.UmiQualityFilter(
+        min_base_quality=10, min_mean_quality=25, weighted=weighted
+    )
+    umi_counts = Counter()
+    for umi, quality in reads:
+        quality_filter.add(umi, quality)
+    quality_filter.flush(umi_counts)
+
+    # II#I has a base below 10, 5555 a mean of 20
+    assert umi_counts == Counter({"ACGT": 2})
+    assert quality_filter.filtered_reads == 2
+    if weighted:
+        assert quality_filter.umi_weights["ACGT"] == pytest.approx(2 * (1 - 1e-4) ** 4)
+    else:
+        assert not quality_filter.umi_weights
+
+
+@pytest.mark.parametrize("max_mismatches", [0, 1, 2, 3])
+@pytest.mark.parametrize("start,end", [(0, None), (5, 150), (40, 60)])
+def test_find_approximate_matches_match_brute_force(max_mismatches, start, end):
+    rng = random.Random(max_mismatches)
+    pattern = "CTCGACAA"
+    text = "".join(rng.choice("ACGTN") for _ in range(200))
+    # Plant copies of the pattern with up to max_mismatches substitutions
+    for position in range(0, 190, 23):
+        window = list(pattern)
+        for substituted in rng.sample(
+            range(len(pattern)), rng.randint(0, max_mismatches)
+        ):
+            window[substituted] = "T" if window[substituted] != "T" else "G"
+        text = text[:position] + "".join(window) + text[position + len(pattern) :]
+
+    last_start = (len(text) if end is None else end) - len(pattern)
+    expected = [
+        (window_start, hamming(text[window_start : window_start + 8], pattern))
+        for window_start in range(start, last_start + 1)
+        if hamming(text[window_start : window_start + 8], pattern) <= max_mismatches
+    ]
+    assert expected
+    assert (
+        flank_utils.find_approximate_matches(
+            text,
+            pattern,
+            flank_utils.pattern_masks(pattern),
+            max_mismatches,
+            start=start,
+            end=end,
+        )
+        == expected
+    )
+
+
+def write_fastq(path, reads, member_size=None):
+    text = "".join(
+        f"@read_{index} comment\n{sequence}\n+\n{'I' * len(sequence)}\n"
+        for index, sequence in enumerate(reads)
+    ).encode("ascii")
+    if member_size is None:
+        path.write_bytes(text)
+        return
+    # Concatenated gzip members, like BGZF blocks
+    path.write_bytes(
+        b"".join(
+            gzip.compress(text[start : start + member_size])
+            for start in range(0, len(text), member_size)
+        )
+    )
+
+
+@pytest.mark.parametrize("member_size", [None, 1 << 16])
+@pytest.mark.parametrize("chunk_size", [7, 64, 1 << 12])
+def test_stream_records_match_pyfastx(tmp_path, member_size, chunk_size):
+    rng = random.Random(0)
+    reads = [
+        "".join(rng.choice("ACGT") for _ in range(length))
+        for length in [40_000, 150, 1, 40_000, 3, 20_000]
+    ]
+    input_fastq = tmp_path / ("reads.fastq" if member_size is None else "reads.fq.gz")
+    write_fastq(input_fastq, reads, member_size)
+
+    stream_records = [
+        record
+        for block in stream_utils.iter_record_blocks(str(input_fastq), chunk_size)
+        for record in stream_utils.parse_record_block(block)
+    ]
+    assert stream_records == [
+        tuple(record) for record in pyfastx.Fastx(str(input_fastq))
+    ]
+
+
+def umi_reads(rng, number_of_reads, umi_bases="ACGTN", umi_lengths=(6, 6, 6, 5)):
+    # Reads with CTCGACAA-UMI-AAGGGGAG, and 1 in 30 without flanks
+    reads = [
+        "".join(rng.choice("ACGT") for _ in range(20))
+        + "CTCGACAA"
+        + "".join(rng.choice(umi_bases) for _ in range(rng.choice(umi_lengths)))
+        + "AAGGGGAG"
+        + "".join(rng.choice("ACGT") for _ in range(20))
+        for _ in range(number_of_reads)
+    ] + ["ACGT" * 10] * (number_of_reads // 30)
+    rng.shuffle(reads)
+    return reads
+
+
+@pytest.mark.parametrize("member_size", [None, 1 << 12])
+@pytest.mark.parametrize("ingest", ["auto", "pyfastx"])
+def test_sharded_counts_match_single_thread(tmp_path, member_size, ingest):
+    reads = umi_reads(random.Random(0), 3000)
+    input_fastq = tmp_path / ("reads.fastq" if member_size is None else "reads.fq.gz")
+    write_fastq(input_fastq, reads, member_size)
+
+    umi_counts = [
+        umi_utils.extract_umis(
+            str(input_fastq),
+            "CTCGACAA",
+            "AAGGGGAG",
+            read_umi_file=str(tmp_path / f"reads_{threads}.txt"),
+            threads=threads,
+            ingest=ingest,
+        )
+        for threads in [1, 3]
+    ]
+    assert list(umi_counts[0].items()) == list(umi_counts[1].items())
+    assert (tmp_path / "reads_1.txt").read_text() == (
+        tmp_path / "reads_3.txt"
+    ).read_text()
+    # Nothing, like a pyfastx index, is written next to the input
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [input_fastq.name, "reads_1.txt", "reads_3.txt"]
+    )
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_stream_records_without_final_newline(tmp_path, newline):
+    input_fastq = tmp_path / "reads.fastq"
+    input_fastq.write_bytes(
+        newline.join(
+            ["@read_1 comment", "ACGT", "+", "IIII", "@read_2", "GG", "+read_2", "#I"]
+        ).encode("ascii")
+    )
+    assert list(stream_utils.iter_stream_records(str(input_fastq))) == [
+        ("read_1", "ACGT", "IIII"),
+        ("read_2", "GG", "#I"),
+    ]
+
+
+def test_stream_records_incomplete(tmp_path):
+    input_fastq = tmp_path / "reads.fastq"
+    input_fastq.write_bytes(b"@read_1\nACGT\n+\nIIII\n@read_2\nGG\n")
+    with pytest.raises(ValueError, match="incomplete FASTQ record"):
+        list(stream_utils.iter_stream_records(str(input_fastq)))
+
+
+def test_run_stage_reruns_when_outputs_change(tmp_path):
+    output_file = tmp_path / "table.txt"
+    runs = []
+
+    def compute():
+        runs.append(len(runs))
+        output_file.write_text(f"run {len(runs)}\n")
+        return {"runs": np.array(len(runs))}
+
+    def run(params):
+        return pipeline_utils.run_stage(
+            str(tmp_path), "stage", [], params, compute, outputs=[str(output_file)]
+        )
+
+    assert not run({"a": 1}).cached
+    assert run({"a": 1}).cached
+    # Another run with other parameters overwrites the output
+    assert not run({"a": 2}).cached
+    rerun = run({"a": 1})
+    assert not rerun.cached and int(rerun.data["runs"]) == 3
+    assert output_file.read_text() == "run 3\n"
+    output_file.unlink()
+    assert not run({"a": 1}).cached
+
+
+def test_run_stage_does_not_cache_streams(tmp_path):
+    def compute():
+        return {"column": np.arange(3)}
+
+    stream_result = pipeline_utils.run_stage(
+        str(tmp_path), "extract", [], {}, compute, cacheable=False
+    )
+    downstream_result = pipeline_utils.run_stage(
+        str(tmp_path), "count", [stream_result], {}, compute
+    )
+    assert not stream_result.cacheable and not downstream_result.cacheable
+    assert not (tmp_path / pipeline_utils.CACHE_FOLDER).exists()
+
+
+@pytest.mark.parametrize("distance_output", ["dense", "sparse"])
+@pytest.mark.parametrize("collapse_method", ["groups", "directional"])
+def test_run_pipeline_without_umis(tmp_path, distance_output, collapse_method):
+    input_fastq = tmp_path / "reads.fastq"
+    write_fastq(input_fastq, ["ACGT" * 10] * 20)
+
+    _, report = pipeline_utils.run_pipeline(
+        str(input_fastq),
+        "CTCGACAA",
+        "AAGGGGAG",
+        distance_output=distance_output,
+        collapse_method=collapse_method,
+        output_dir=str(tmp_path / "output"),
+    )
+    assert report["Unique_UMIs"] == 0
+    assert report["Total_UMI_Bases"] == 0
+    assert math.isnan(report["Accurate_Bases_Percentage"])
+
+
+def build_test_store(umi_counts, path, params=None):
+    return store_utils.build_store(
+        list(umi_counts),
+        list(umi_counts.values()),
+        weights=[count / 2 for count in umi_counts.values()],
+        totals={"filtered_reads": 1, "recovered_reads": 2, "failed_reads": 3},
+        params=params or {"umi_prefix": "CTCGACAA"},
+        inputs=[store_utils.input_record([path, 100, 1.0], 10, len(umi_counts))],
+    )
+
+
+def test_merge_stores_round_trip(tmp_path):
+    rng = random.Random(0)
+    umi_counts = [
+        Counter(random_umis(rng, 300, lengths=(6, 6, 5, 32), bases="ACGTN"))
+        for _ in range(3)
+    ]
+    stores = [
+        build_test_store(counts, f"sample_{index}.fastq")
+        for index, counts in enumerate(umi_counts)
+    ]
+    store_file = str(tmp_path / "counts.npz")
+    store_utils.save_store(store_file, store_utils.merge_stores(*stores))
+    merged = store_utils.load_store(store_file)
+
+    expected = sum(umi_counts, Counter())
+    umis, counts, weights = store_utils.store_umi_counts(merged)
+    assert dict(zip(umis, counts.tolist())) == dict(expected)
+    assert dict(zip(umis, weights.tolist())) == {
+        umi: count / 2 for umi, count in expected.items()
+    }
+    assert len(umis) == len(expected)
+    assert [int(merged[name]) for name in store_utils.TOTAL_COLUMNS] == [3, 6, 9]
+    assert [
+        record["input_fastq"][0]
+        for record in store_utils.store_provenance(merged)["inputs"]
+    ] == ["sample_0.fastq", "sample_1.fastq", "sample_2.fastq"]
+    assert store_utils.find_input(merged, ["sample_1.fastq", 100, 1.0])
+    assert not store_utils.find_input(merged, ["sample_3.fastq", 100, 1.0])
+    with pytest.raises(ValueError, match="changed since"):
+        store_utils.find_input(merged, ["sample_1.fastq", 200, 1.0])
+
+    # Merging in another order gives the same store
+    reordered = store_utils.merge_stores(stores[2], stores[0], stores[1])
+    for name in ["umi_lengths", "codes", "other_umis", "counts", "other_counts"]:
+        assert np.array_equal(reordered[name], merged[name])
+
+
+def test_merge_stores_rejects_mismatches():
+    store = build_test_store(Counter(["ACGT"]), "sample.fastq")
+    with pytest.raises(ValueError, match="more than one count store"):
+        store_utils.merge_stores(store, store)
+    other_params = build_test_store(
+        Counter(["ACGT"]), "other.fastq", params={"umi_prefix": "GG"}
+    )
+    with pytest.raises(ValueError, match="extraction parameters"):
+        store_utils.merge_stores(store, other_params)
+
+
+def test_arrow_dictionaries_across_batches(tmp_path):
+    pyarrow = table_utils.import_pyarrow()
+    umis = random_umis(random.Random(0), 1000, lengths=(3,))
+    lines = [f"read_{index}\t{umi}\n" for index, umi in enumerate(umis)]
+    part_file = str(tmp_path / "part.arrow")
+    with table_utils.TableWriter(
+        part_file, ["Read", "UMI"], "arrow", ["UMI"], row_group_size=70
+    ) as table_writer:
+        for line in lines[500:]:
+            table_writer.write(line)
+
+    table_file = str(tmp_path / "reads.arrow")
+    with table_utils.TableWriter(
+        table_file, ["Read", "UMI"], "arrow", ["UMI"], row_group_size=70
+    ) as table_writer:
+        table_writer.write_block("".join(lines[:500]))
+        table_writer.append_file(part_file)
+
+    with pyarrow.memory_map(table_file) as source:
+        reader = pyarrow.ipc.open_file(source)
+        batches = [
+            reader.get_batch(index) for index in range(reader.num_record_batches)
+        ]
+    assert len(batches) > 10
+    assert [value for batch in batches for value in batch["UMI"].to_pylist()] == umis
+    # One dictionary in order of first occurrence, later batches extend it
+    assert batches[-1]["UMI"].dictionary.to_pylist() == list(dict.fromkeys(umis))
+
+
+def test_run_batch_samples_in_one_process(tmp_path):
+    reads = umi_reads(random.Random(0), 400, umi_bases="AC", umi_lengths=(6,))
+    write_fastq(tmp_path / "reads.fastq", reads)
+    sample_sheet = tmp_path / "samples.tsv"
+    sample_sheet.write_text("Sample\tFASTQ\nA\treads.fastq\nB\treads.fastq\n")
+    output_dir = tmp_path / "output"
+
+    sample_summary = batch_utils.run_batch(
+        str(sample_sheet), "CTCGACAA", "AAGGGGAG", output_dir=str(output_dir)
+    )
+
+    # Plots of sample B are not drawn over those of sample A
+    for plot in ["UMI_Count_Frequency_distribution.png", "UMI_Dendrogram_single.png"]:
+        assert (output_dir / "A" / plot).read_bytes() == (
+            output_dir / "B" / plot
+        ).read_bytes()
+    assert not plt.get_fignums()
+
+    expected = Counter(
+        read[28:-28] for read in reads if "CTCGACAA" in read and read[28:-28]
+    )
+    count_matrix = pd.read_csv(
+        output_dir / "UMI_Count_Matrix.txt", sep="\t", dtype={"UMI": str}
+    ).set_index("UMI")
+    assert count_matrix.A.to_dict() == dict(expected)
+    assert count_matrix.B.to_dict() == dict(expected)
+    assert count_matrix.Total.to_dict() == {
+        umi: 2 * count for umi, count in expected.items()
+    }
+
+    summary_table = pd.read_csv(output_dir / "Sample_Summary.txt", sep="\t")
+    assert summary_table.Sample.tolist() == ["A", "B"]
+    assert summary_table.Reads.tolist() == [sum(expected.values())] * 2
+    assert summary_table.Unique_UMIs.tolist() == [len(expected)] * 2
+    assert summary_table.Failed_Reads.tolist() == [len(reads) - 400] * 2
+    assert summary_table.Accurate_Bases_Percentage.tolist() == (
+        sample_summary.Accurate_Bases_Percentage.tolist()
+    )
+
+
+def brute_force_edges(umis, max_distance):
+    umis = sorted(umis)
+    return [
+        (umis[row], umis[column], distance)
+        for row, column, distance in brute_force_pairs(umis, max_distance)
+    ]
+
+
+@pytest.mark.parametrize("max_distance", [1, 2])
+def test_sparse_hamming_distance_match_brute_force(max_distance):
+    umi_counts = Counter(random_umis(random.Random(0), 300, (5,), "ACGTN"))
+    edges = umi_utils.calculate_sparse_hamming_distance(umi_counts, max_distance)
+    assert list(edges.itertuples(index=False, name=None)) == brute_force_edges(
+        umi_counts, max_distance
+    )
+
+
+@pytest.mark.parametrize("dense_distance_max_umis", [10, 5000])
+def test_run_pipeline_distance_output_auto(tmp_path, dense_distance_max_umis):
+    input_fastq = tmp_path / "reads.fastq"
+    write_fastq(input_fastq, umi_reads(random.Random(0), 300, "ACGT", umi_lengths=(6,)))
+    output_dir = tmp_path / "output"
+    count_result, _ = pipeline_utils.run_pipeline(
+        str(input_fastq),
+        "CTCGACAA",
+        "AAGGGGAG",
+        distance_output="auto",
+        dense_distance_max_umis=dense_distance_max_umis,
+        sparse_max_distance=2,
+        output_dir=str(output_dir),
+    )
+    umis = pipeline_utils.umi_list(count_result.data["umis"])
+    assert len(umis) > 10
+
+    edges_file = output_dir / "UMI_Hamming_Distance_Edges.txt"
+    table_file = output_dir / "UMI_Hamming_Distance_Table.txt"
+    if dense_distance_max_umis < len(umis):
+        assert not table_file.exists()
+        edges = pd.read_csv(edges_file, sep="\t", dtype=str)
+        assert [
+            (umi_1, umi_2, int(distance))
+            for umi_1, umi_2, distance in edges.itertuples(index=False, name=None)
+        ] == brute_force_edges(umis, 2)
+    else:
+        assert not edges_file.exists()
+        table = pd.read_csv(table_file, sep="\t", index_col=0)
+        assert table.index.tolist() == sorted(umis)
+        assert table.to_numpy().tolist() == [
+            [hamming(umi, other) for other in sorted(umis)] for umi in sorted(umis)
+        ]
+
+
+def test_report_stage_dendrogram_of_most_common_umis(tmp_path, monkeypatch):
+    reads = umi_reads(random.Random(0), 300, "ACGT", umi_lengths=(6,))
+    input_fastq = tmp_path / "reads.fastq"
+    write_fastq(input_fastq, reads)
+    dendrograms = []
+    monkeypatch.setattr(
+        plotting_utils,
+        "create_dendrogram",
+        lambda **arguments: dendrograms.append(arguments),
+    )
+
+    pipeline_utils.run_pipeline(
+        str(input_fastq),
+        "CTCGACAA",
+        "AAGGGGAG",
+        dendrogram_max_umis=20,
+        dendrogram_leaves=5,
+        output_dir=str(tmp_path / "output"),
+    )
+
+    # Ties are broken by first occurrence, like Counter.most_common
+    most_common = Counter(
+        read[28:-28] for read in reads if "CTCGACAA" in read
+    ).most_common(20)
+    (dendrogram,) = dendrograms
+    assert dendrogram["labels"] == [
+        f"{umi} ({count})" for umi, count in sorted(most_common)
+    ]
+    sorted_umis = sorted(umi for umi, _ in most_common)
+    assert np.array_equal(
+        dendrogram["distance_matrix"],
+        np.rint(
+            spatial.distance.pdist(
+                hamming_utils.encode_umi_matrix(sorted_umis), "hamming"
+            )
+            * 6
+        ),
+    )
+    assert dendrogram["max_leaves"] == 5
+
+
+@pytest.mark.parametrize(
+    "max_leaves,truncated", [(None, False), (5, True), (30, False)]
+)
+def test_create_dendrogram_truncates_leaves(
+    tmp_path, monkeypatch, max_leaves, truncated
+):
+    umis = sorted(set(random_umis(random.Random(0), 20, (6,))))
+    calls = []
+    dendrogram = plotting_utils.cluster.hierarchy.dendrogram
+
+    def record_dendrogram(*args, **kwargs):
+        calls.append(kwargs)
+        return dendrogram(*args, **kwargs)
+
+    monkeypatch.setattr(
+        plotting_utils.cluster.hierarchy, "dendrogram", record_dendrogram
+    )
+    plotting_utils.create_dendrogram(
+        hamming_utils.pairwise_hamming_distance(umis),
+        "single",
+        str(tmp_path / "dendrogram.png"),
+        umis,
+        max_leaves=max_leaves,
+    )
+    assert (tmp_path / "dendrogram.png").exists()
+    if truncated:
+        assert calls[0]["truncate_mode"] == "lastp"
+        assert calls[0]["p"] == max_leaves
+    else:
+        assert "truncate_mode" not in calls[0]
+
+
+def linkage_distances():
+    umis = sorted(set(random_umis(random.Random(0), 50, (8,))))
+    return hamming_utils.pairwise_hamming_distance(umis)
+
+
+@pytest.mark.parametrize("method", ["single", "complete", "average", "ward"])
+def test_compute_linkage_scipy_fallback(monkeypatch, method):
+    # An import of a None module raises ImportError, as if fastcluster were not installed
+    monkeypatch.setitem(sys.modules, "fastcluster", None)
+    distances = linkage_distances()
+    assert np.array_equal(
+        plotting_utils.compute_linkage(distances, method),
+        plotting_utils.cluster.hierarchy.linkage(
+            distances.astype(np.double), method=method
+        ),
+    )
+
+
+@pytest.mark.parametrize("method", ["single", "complete", "average", "ward"])
+def test_compute_linkage_fastcluster_matches_scipy(method):
+    pytest.importorskip("fastcluster")
+    distances = linkage_distances().astype(np.double)
+    linkage = plotting_utils.compute_linkage(distances, method)
+    expected = plotting_utils.cluster.hierarchy.linkage(distances, method=method)
+    # Merge heights are the same, ties may merge in another order
+    assert np.allclose(linkage[:, 2], expected[:, 2])
+
+
+@pytest.mark.parametrize(
+    "threads,ingest", [(1, "pyfastx"), (3, "pyfastx"), (1, "stream"), (3, "stream")]
+)
+@pytest.mark.parametrize("output_format", ["tsv", "parquet"])
+def test_run_pipeline_per_read_table(tmp_path, threads, ingest, output_format):
+    # Few unique UMI's keep the frequency plot quick to draw
+    reads = umi_reads(random.Random(0), 2000, "AC", umi_lengths=(6,))
+    input_fastq = tmp_path / "reads.fastq"
+    write_fastq(input_fastq, reads)
+    output_dir = tmp_path / "output"
+    pipeline_utils.run_pipeline(
+        str(input_fastq),
+        "CTCGACAA",
+        "AAGGGGAG",
+        threads=threads,
+        ingest=ingest,
+        output_format=output_format,
+        distance_output="sparse",
+        dendrogram_max_umis=10,
+        output_dir=str(output_dir),
+    )
+
+    table_file = table_utils.table_file_name(
+        str(output_dir), "UMI_in_each_read", output_format
+    )
+    if output_format == "tsv":
+        table = pd.read_csv(table_file, sep="\t", dtype=str)
+    else:
+        table = pd.read_parquet(table_file)
+    # Reads in file order, reads without flanks left out
+    assert list(table.itertuples(index=False, name=None)) == [
+        (f"read_{index}", read[28:-28])
+        for index, read in enumerate(reads)
+        if "CTCGACAA" in read
+    ]
+
+
+def test_run_pipeline_without_per_read_table(tmp_path):
+    input_fastq = tmp_path / "reads.fastq"
+    write_fastq(input_fastq, umi_reads(random.Random(0), 200, "AC", (6,)))
+    output_dir = tmp_path / "output"
+    pipeline_utils.run_pipeline(
+        str(input_fastq),
+        "CTCGACAA",
+        "AAGGGGAG",
+        per_read_table=False,
+        distance_output="sparse",
+        dendrogram_max_umis=10,
+        output_dir=str(output_dir),
+    )
+    assert not [path for path in output_dir.iterdir() if "each_read" in path.name]
+    assert (output_dir / "Unique_UMI_Sequence_Counts.txt").exists()
+
+
+def regex_umi(read, umi_prefix, umi_suffix):
+    match = re.search(f"{umi_prefix}(.*){umi_suffix}", read, re.I)
+    return match.group(1) if match else None
+
+
+@pytest.mark.parametrize(
+    "read",
+    [
+        # First prefix, last suffix
+        "TTCTCGACAAACGTAAGGGGAGCTCGACAAGGAAGGGGAGTT",
+        # Lower case reads, and lower case UMI's kept as they are
+        "ttctcgacaaacgtaaggggagtt",
+        "TTctcgacaaACgtAAGGGGAGTT",
+        # Suffix overlapping the prefix, it must start after the prefix
+        "CTCGACAAGGGGAG",
+        "CTCGACAAGGGGAGAAGGGGAG",
+        # Empty UMI
+        "CTCGACAAAAGGGGAG",
+        # No suffix after the prefix, no prefix, neither
+        "AAGGGGAGTTCTCGACAAACGT",
+        "ACGTAAGGGGAG",
+        "ACGTACGT",
+        "",
+    ],
+)
+@pytest.mark.parametrize(
+    "umi_prefix,umi_suffix", [("CTCGACAA", "AAGGGGAG"), ("ctcgacaa", "aaggggag")]
+)
+def test_flank_matcher_matches_regex(read, umi_prefix, umi_suffix):
+    find_umi = umi_utils.compile_flank_matcher(umi_prefix, umi_suffix)
+    find_umi_span = umi_utils.compile_flank_matcher(
+        umi_prefix, umi_suffix, return_span=True
+    )
+    expected = regex_umi(read, umi_prefix, umi_suffix)
+    assert find_umi(read) == expected
+    umi_span = find_umi_span(read)
+    assert (None if umi_span is None else read[umi_span[0] : umi_span[1]]) == expected
+
+
+def test_flank_matcher_matches_regex_on_random_reads():
+    # Short flanks over two bases overlap and repeat often
+    rng = random.Random(0)
+    find_umi = umi_utils.compile_flank_matcher("ABA", "BAB")
+    for _ in range(5000):
+        read = "".join(rng.choice("ABab") for _ in range(rng.randint(0, 15)))
+        assert find_umi(read) == regex_umi(read, "ABA", "BAB")
+
+
+def test_synthetic_truth_matches_pipeline(tmp_path):
+    input_fastq, truth_file = tmp_path / "reads.fastq", tmp_path / "truth.txt"
+    truth = synthetic_utils.generate_fastq(
+        str(input_fastq),
+        str(truth_file),
+        number_of_reads=2000,
+        unique_umis=50,
+        error_rate=0.01,
+        umi_length=8,
+        read_length=60,
+        seed=1,
+    )
+    truth_table = pd.read_csv(truth_file, sep="\t", dtype={"True_UMI": str, "UMI": str})
+
+    assert len(truth_table) == truth["Reads"] == 2000
+    assert truth_table.True_UMI.nunique() <= truth["Unique_UMIs"]
+    assert truth_table.Errors.tolist() == [
+        hamming(true_umi, umi)
+        for true_umi, umi in zip(truth_table.True_UMI, truth_table.UMI)
+    ]
+    assert truth_table.Errors.sum() == truth["Error_Bases"] > 0
+    assert truth["Total_UMI_Bases"] == 2000 * 8
+    assert truth["Accurate_Bases_Percentage"] == pytest.approx(
+        (1 - truth["Error_Bases"] / truth["Total_UMI_Bases"]) * 100
+    )
+
+    output_dir = tmp_path / "output"
+    count_result, report = pipeline_utils.run_pipeline(
+        str(input_fastq),
+        "CTCGACAA",
+        "AAGGGGAG",
+        distance_output="sparse",
+        dendrogram_max_umis=10,
+        output_dir=str(output_dir),
+    )
+    umi_counts = dict(
+        zip(
+            pipeline_utils.umi_list(count_result.data["umis"]),
+            count_result.data["counts"].tolist(),
+        )
+    )
+    assert umi_counts == dict(Counter(truth_table.UMI))
+    assert report["Total_UMI_Bases"] == truth["Total_UMI_Bases"]
+    read_table = pd.read_csv(output_dir / "UMI_in_each_read.txt", sep="\t", dtype=str)
+    assert read_table.ReadName.tolist() == truth_table.ReadName.tolist()
+    assert read_table.UMI.tolist() == truth_table.UMI.tolist()
+
+
+def test_run_pipeline_profile_report(tmp_path):
+    input_fastq = tmp_path / "reads.fastq"
+    write_fastq(input_fastq, umi_reads(random.Random(0), 300, "AC", (6,)))
+    profile_report, profile_dir = tmp_path / "profile.json", tmp_path / "profiles"
+
+    reports = []
+    for _ in range(2):
+        pipeline_utils.run_pipeline(
+            str(input_fastq),
+            "CTCGACAA",
+            "AAGGGGAG",
+            output_dir=str(tmp_path / "output"),
+            profile_report=str(profile_report),
+            profile_dir=str(profile_dir),
+            trace_memory=True,
+        )
+        reports.append(json.loads(profile_report.read_text()))
+
+    for report in reports:
+        assert report["version"] == profile_utils.PROFILE_REPORT_VERSION
+        assert report["options"]["input_fastq"] == str(input_fastq)
+        assert report["total"]["wall_seconds"] > 0
+        stages = {record["stage"]: record for record in report["stages"]}
+        assert [record["stage"] for record in report["stages"]] == [
+            "extract",
+            "count",
+            "distances",
+            "cluster",
+            "write_outputs",
+            "dendrogram",
+            "report",
+        ]
+        assert stages["extract"]["items"]["reads"] == 300
+        assert stages["extract"]["items"]["failed_reads"] == 10
+        assert stages["dendrogram"]["items"]["umis"] == (
+            stages["extract"]["items"]["unique_umis"]
+        )
+
+        # Nested stages are neither traced nor profiled on their own
+        for record in report["stages"]:
+            nested = record["stage"] in ["write_outputs", "dendrogram"]
+            assert record["parent"] == ("report" if nested else None)
+            assert (record["tracemalloc_peak_mb"] is None) == nested
+            assert (record["profile"] is None) == nested
+            if not nested:
+                assert record["profile"] == str(profile_dir / f"{record['stage']}.prof")
+                assert pstats.Stats(record["profile"]).total_calls > 0
+
+    # Cached stages are loaded on the second run, report is never cached
+    assert [record["cached"] for record in reports[0]["stages"]] == [False] * 7
+    assert [record["cached"] for record in reports[1]["stages"]] == [True] * 4 + [
+        False
+    ] * 3
+
+
+def test_stage_profiler_nested_stages():
+    stage_profiler = profile_utils.StageProfiler(trace_memory=True)
+    with stage_profiler.stage("outer") as record:
+        record["items"]["rows"] = 3
+        with stage_profiler.stage("inner"):
+            assert tracemalloc.is_tracing()
+        # The nested stage left the outer stage's tracing on
+        assert tracemalloc.is_tracing()
+    assert not tracemalloc.is_tracing()
+
+    inner, outer = stage_profiler.report()["stages"]
+    assert (inner["stage"], inner["parent"]) == ("inner", "outer")
+    assert (outer["stage"], outer["parent"]) == ("outer", None)
+    assert outer["items"] == {"rows": 3}
+    assert inner["tracemalloc_peak_mb"] is None
+    assert outer["tracemalloc_peak_mb"] is not None
@@ -0,0 +1,163 @@
+import logging
+import os
+
+import click
+
+from utilities import batch_utils, cli_options, pipeline_utils, store_utils
+
+# Stage subcommands of the UMI pipeline. Each stage loads the stages it depends on from
+# the cache in --output_dir, and runs them first if they are not cached.
+
+
+def _extract(options):
+    os.makedirs(options["output_dir"], exist_ok=True)
+    return pipeline_utils.extract_stage(
+        options["output_dir"],
+        options["input_fastq"],
+        options["umi_prefix"],
+        options["umi_suffix"],
+        threads=options["threads"],
+        ingest=options["ingest"],
+        per_read_table=options["per_read_table"],
+        umi_encoding=options["umi_encoding"],
+        output_format=options["output_format"],
+        min_umi_base_quality=options["min_umi_base_quality"],
+        min_umi_mean_quality=options["min_umi_mean_quality"],
+        quality_weighted=options["quality_weighted"],
+        flank_mismatches=options["flank_mismatches"],
+        umi_length=options["umi_length"],
+        use_cache=options["cache"],
+    )
+
+
+def _count(options):
+    return pipeline_utils.count_stage(
+        options["output_dir"], _extract(options), use_cache=options["cache"]
+    )
+
+
+def _distances(options, count_result):
+    return pipeline_utils.distance_stage(
+        options["output_dir"],
+        count_result,
+        distance_output=options["distance_output"],
+        dense_distance_max_umis=options["dense_distance_max_umis"],
+        sparse_max_distance=options["sparse_max_distance"],
+        use_cache=options["cache"],
+    )
+
+
+def _cluster(options, count_result):
+    return pipeline_utils.cluster_stage(
+        options["output_dir"],
+        count_result,
+        collapse_method=options["collapse_method"],
+        use_cache=options["cache"],
+    )
+
+
+@click.group()
+def cli():
+    """Run the stages of the UMI pipeline one at a time."""
+
+
+@cli.command()
+@cli_options.add_options(cli_options.EXTRACT_OPTIONS, cli_options.OUTPUT_OPTIONS)
+def extract(**options):
+    """Stream the FASTQ file and count its UMI's."""
+    _extract(options)
+
+
+@cli.command()
+@cli_options.add_options(cli_options.EXTRACT_OPTIONS, cli_options.OUTPUT_OPTIONS)
+def count(**options):
+    """Sort UMI counts and write counts and their frequency distribution."""
+    pipeline_utils.write_count_outputs(
+        options["output_dir"], _count(options), options["output_format"]
+    )
+
+
+@cli.command()
+@cli_options.add_options(
+    cli_options.EXTRACT_OPTIONS,
+    cli_options.DISTANCE_OPTIONS,
+    cli_options.OUTPUT_OPTIONS,
+)
+def distances(**options):
+    """Calculate hamming distances between UMI's and write them."""
+    count_result = _count(options)
+    pipeline_utils.write_distance_outputs(
+        options["output_dir"],
+        count_result,
+        _distances(options, count_result),
+        options["output_format"],
+    )
+
+
+@cli.command()
+@cli_options.add_options(
+    cli_options.EXTRACT_OPTIONS,
+    cli_options.CLUSTER_OPTIONS,
+    cli_options.OUTPUT_OPTIONS,
+)
+def cluster(**options):
+    """Collapse UMI's within a hamming distance of 2 and write cluster sizes."""
+    count_result = _count(options)
+    pipeline_utils.write_cluster_outputs(
+        options["output_dir"],
+        count_result,
+        _cluster(options, count_result),
+        options["output_format"],
+    )
+
+
+@cli.command()
+@cli_options.add_options(
+    cli_options.EXTRACT_OPTIONS,
+    cli_options.STORE_OPTIONS,
+    cli_options.DENDROGRAM_OPTIONS,
+    cli_options.CLUSTER_OPTIONS,
+    cli_options.DISTANCE_OPTIONS,
+    cli_options.OUTPUT_OPTIONS,
+    cli_options.PROFILE_OPTIONS,
+)
+def report(**options):
+    """Write all results, plot the dendrogram and report base calling accuracy."""
+    pipeline_utils.run_pipeline(**options)
+
+
+@cli.command()
+@click.option(
+    "--count_store",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="Count store to write the merged UMI counts to",
+)
+@click.argument(
+    "stores", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False)
+)
+def merge(count_store, stores):
+    """Merge the count stores of different FASTQ files into one count store."""
+    store_utils.save_store(
+        count_store,
+        store_utils.merge_stores(*[store_utils.load_store(store) for store in stores]),
+    )
+
+
+@cli.command()
+@cli_options.add_options(
+    cli_options.BATCH_OPTIONS,
+    cli_options.READ_OPTIONS,
+    cli_options.DENDROGRAM_OPTIONS,
+    cli_options.CLUSTER_OPTIONS,
+    cli_options.DISTANCE_OPTIONS,
+    cli_options.OUTPUT_OPTIONS,
+)
+def batch(**options):
+    """Run all stages on the samples of a sample sheet and merge their UMI counts."""
+    batch_utils.run_batch(**options)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    cli()
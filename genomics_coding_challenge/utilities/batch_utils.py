@@ -0,0 +1,233 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+from utilities import pipeline_utils, table_utils, umi_utils
+
+# Required columns of the sample sheet
+SAMPLE_SHEET_COLUMNS = ["Sample", "FASTQ"]
+
+# Optional columns of the sample sheet, default to the --umi_prefix and --umi_suffix options
+FLANK_COLUMNS = ["UMI_Prefix", "UMI_Suffix"]
+
+
+def read_sample_sheet(sample_sheet, umi_prefix=None, umi_suffix=None):
+    """Read and check a tab separated sample sheet.
+
+    Args:
+        sample_sheet (str): Path of the sample sheet, with Sample and FASTQ columns and optionally UMI_Prefix and UMI_Suffix
+        umi_prefix (str, optional): UMI prefix of samples without one in the sample sheet. Defaults to None.
+        umi_suffix (str, optional): UMI suffix of samples without one in the sample sheet. Defaults to None.
+
+    Returns:
+        pandas dataframe: Sample, FASTQ (absolute path), UMI_Prefix and UMI_Suffix of each sample
+    """
+    samples = pd.read_csv(
+        sample_sheet, sep="\t", dtype=str, keep_default_na=False, comment="#"
+    )
+    if samples.empty:
+        raise ValueError(f"Sample sheet {sample_sheet} has no samples")
+    missing_columns = [
+        column for column in SAMPLE_SHEET_COLUMNS if column not in samples.columns
+    ]
+    if missing_columns:
+        raise ValueError(
+            f"Sample sheet {sample_sheet} has no {', '.join(missing_columns)} column"
+        )
+
+    for column, default in zip(FLANK_COLUMNS, [umi_prefix, umi_suffix]):
+        if column not in samples.columns:
+            samples[column] = ""
+        if default is not None:
+            samples.loc[samples[column] == "", column] = default
+        if (samples[column] == "").any():
+            raise ValueError(
+                f"Samples without a {column} in {sample_sheet}, add it to the sample sheet or the command line"
+            )
+
+    # Sample names are used as output folder names
+    invalid_samples = [
+        sample
+        for sample in samples.Sample
+        if sample in ("", ".", "..") or os.sep in sample
+    ]
+    if invalid_samples:
+        raise ValueError(f"Invalid sample names in {sample_sheet}: {invalid_samples}")
+    duplicate_samples = samples.Sample[samples.Sample.duplicated()].tolist()
+    if duplicate_samples:
+        raise ValueError(f"Duplicate samples in {sample_sheet}: {duplicate_samples}")
+
+    sample_sheet_dir = os.path.dirname(os.path.abspath(sample_sheet))
+    samples["FASTQ"] = [
+        os.path.join(sample_sheet_dir, input_fastq) for input_fastq in samples.FASTQ
+    ]
+    missing_fastqs = [
+        input_fastq for input_fastq in samples.FASTQ if not os.path.isfile(input_fastq)
+    ]
+    if missing_fastqs:
+        raise ValueError(f"FASTQ files not found: {missing_fastqs}")
+
+    return samples[SAMPLE_SHEET_COLUMNS + FLANK_COLUMNS]
+
+
+def compile_flank_matchers(flanks):
+    """Compile the flank matchers of all samples once per worker process.
+
+    Args:
+        flanks (list): (UMI prefix, UMI suffix) tuples
+    """
+    for umi_prefix, umi_suffix in flanks:
+        umi_utils.compile_flank_matcher(umi_prefix, umi_suffix)
+
+
+def run_sample(sample, input_fastq, umi_prefix, umi_suffix, pipeline_options):
+    """Run the pipeline on one sample, writing to a folder named after it. Runs in a worker process.
+
+    Args:
+        sample (str): Sample name
+        input_fastq (file): *.fastq or *.fastq.gz file.
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        pipeline_options (dict): Other options of pipeline_utils.run_pipeline, output_dir is the batch output folder
+
+    Returns:
+        tuple: (report, umis, counts) - summary from pipeline_utils.report_stage, unique UMI's and their counts
+    """
+    logging.info(f"Processing sample {sample}")
+    count_result, report = pipeline_utils.run_pipeline(
+        input_fastq,
+        umi_prefix,
+        umi_suffix,
+        **dict(
+            pipeline_options,
+            output_dir=os.path.join(pipeline_options["output_dir"], sample),
+        ),
+    )
+    return (
+        report,
+        pipeline_utils.umi_list(count_result.data["umis"]),
+        count_result.data["counts"],
+    )
+
+
+def merge_umi_counts(sample_umi_counts):
+    """Merge UMI counts of samples into a UMI x sample count matrix.
+
+    Args:
+        sample_umi_counts (dict): Sample name to (umis, counts) tuples
+
+    Returns:
+        pandas dataframe: UMI, a count column per sample and Total, most common UMI's first
+    """
+    count_matrix = pd.concat(
+        {
+            sample: pd.Series(counts, index=pd.Index(umis, dtype=object))
+            for sample, (umis, counts) in sample_umi_counts.items()
+        },
+        axis=1,
+    )
+    count_matrix = count_matrix.fillna(0).astype(np.int64)
+    count_matrix["Total"] = count_matrix.sum(axis=1)
+    count_matrix = count_matrix.rename_axis("UMI").reset_index()
+    return count_matrix.sort_values(
+        ["Total", "UMI"], ascending=[False, True], ignore_index=True
+    )
+
+
+def run_batch(
+    sample_sheet,
+    umi_prefix=None,
+    umi_suffix=None,
+    processes=1,
+    output_dir="./data",
+    output_format="tsv",
+    **pipeline_options,
+):
+    """Run the pipeline on all samples of a sample sheet, and merge their UMI counts.
+
+    Samples are processed on a pool of at most processes worker processes, each sample on
+    one process. Every worker compiles the flank matchers of all samples when it starts,
+    and keeps them for all samples it processes. Results of each sample are written to
+    output_dir/<Sample>, and cached there like in a single sample run.
+
+    UMI_Count_Matrix has the count of each UMI in each sample, and Sample_Summary the
+    reads, unique UMI's and percentage of accurately called bases of each sample.
+
+    Args:
+        sample_sheet (str): Sample sheet, see read_sample_sheet
+        umi_prefix (str, optional): UMI prefix of samples without one in the sample sheet. Defaults to None.
+        umi_suffix (str, optional): UMI suffix of samples without one in the sample sheet. Defaults to None.
+        processes (int, optional): Number of samples processed in parallel. Defaults to 1.
+        output_dir (str, optional): Output folder. Defaults to "./data".
+        output_format (str, optional): Table format, one of table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+        pipeline_options: Other options of pipeline_utils.run_pipeline
+
+    Returns:
+        pandas dataframe: Sample_Summary table
+    """
+    samples = read_sample_sheet(sample_sheet, umi_prefix, umi_suffix)
+    logging.info(f"Processing {len(samples)} samples from {sample_sheet}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    pipeline_options = dict(
+        pipeline_options, threads=1, output_dir=output_dir, output_format=output_format
+    )
+    sample_arguments = [
+        samples.Sample,
+        samples.FASTQ,
+        samples.UMI_Prefix,
+        samples.UMI_Suffix,
+        repeat(pipeline_options),
+    ]
+    flanks = sorted(set(zip(samples.UMI_Prefix, samples.UMI_Suffix)))
+
+    if processes == 1 or len(samples) == 1:
+        compile_flank_matchers(flanks)
+        sample_results = list(map(run_sample, *sample_arguments))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(processes, len(samples)),
+            initializer=compile_flank_matchers,
+            initargs=(flanks,),
+        ) as executor:
+            sample_results = list(executor.map(run_sample, *sample_arguments))
+
+    count_matrix = merge_umi_counts(
+        {
+            sample: (umis, counts)
+            for sample, (_, umis, counts) in zip(samples.Sample, sample_results)
+        }
+    )
+    umi_utils.write_data_frame_to_file(
+        dataframe=count_matrix,
+        filename=table_utils.table_file_name(
+            output_dir, "UMI_Count_Matrix", output_format
+        ),
+        output_format=output_format,
+    )
+
+    sample_summary = pd.concat(
+        [
+            samples.reset_index(drop=True),
+            pd.DataFrame.from_records([report for report, _, _ in sample_results]),
+        ],
+        axis=1,
+    )
+    umi_utils.write_data_frame_to_file(
+        dataframe=sample_summary,
+        filename=table_utils.table_file_name(
+            output_dir, "Sample_Summary", output_format
+        ),
+        output_format=output_format,
+    )
+    for sample, percentage in zip(
+        sample_summary.Sample, sample_summary.Accurate_Bases_Percentage
+    ):
+        logging.info(
+            f"Percentage of accurately called bases in {sample} is {percentage}%"
+        )
+    return sample_summary
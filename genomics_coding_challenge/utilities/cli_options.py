@@ -0,0 +1,234 @@
+import click
+
+from utilities import cluster_utils, stream_utils, table_utils, umi_codes
+
+# Options of each pipeline stage, shared by parse_fastq.py and the umi_pipeline.py subcommands
+
+INPUT_OPTIONS = [
+    click.option(
+        "--input_fastq",
+        required=True,
+        type=click.Path(exists=True, allow_dash=True),
+        help="Input FASTQ file to extract UMI from. Can be gzipped, a named pipe, or - for stdin",
+    ),
+    click.option(
+        "--umi_prefix",
+        required=True,
+        type=str,
+        help="UMI Prefix",
+    ),
+    click.option(
+        "--umi_suffix",
+        required=True,
+        type=str,
+        help="UMI Suffix",
+    ),
+    click.option(
+        "--threads",
+        type=click.IntRange(min=1),
+        default=1,
+        help="Number of processes used to extract UMI's. The FASTQ file is split into shards processed in parallel",
+    ),
+    click.option(
+        "--ingest",
+        type=click.Choice(stream_utils.INGEST_MODES),
+        default="auto",
+        help="How the FASTQ input is read. pyfastx - by path, plain files are split into byte ranges for --threads. stream - read once, decompressed on a separate thread, in blocks of records for --threads. auto - stream stdin and named pipes. Gzipped files with --threads above 1 are always streamed",
+    ),
+]
+
+READ_OPTIONS = [
+    click.option(
+        "--per_read_table/--no_per_read_table",
+        default=True,
+        help="Write the UMI of each read to UMI_in_each_read.txt. Without it, memory use does not depend on the number of reads",
+    ),
+    click.option(
+        "--umi_encoding",
+        type=click.Choice(umi_codes.UMI_ENCODINGS),
+        default="string",
+        help="Count UMI's as strings, or packed into 2-bit integer codes and counted in a dense array. 2bit uses far less memory per unique UMI",
+    ),
+    click.option(
+        "--min_umi_base_quality",
+        type=click.IntRange(min=0),
+        default=0,
+        help="Reads with a UMI base below this Phred quality are not counted",
+    ),
+    click.option(
+        "--min_umi_mean_quality",
+        type=click.FloatRange(min=0),
+        default=0,
+        help="Reads with a mean UMI base quality below this Phred quality are not counted",
+    ),
+    click.option(
+        "--quality_weighted/--no_quality_weighted",
+        default=False,
+        help="Collapse UMI's by quality weight instead of read count. The weight of a UMI is the sum over its reads of the probability that all its bases were called right",
+    ),
+    click.option(
+        "--flank_mismatches",
+        type=click.IntRange(min=0),
+        default=0,
+        help="Largest number of mismatched bases in the UMI prefix and in the suffix. Reads without exact flanks are searched again allowing them",
+    ),
+    click.option(
+        "--umi_length",
+        type=click.IntRange(min=1),
+        default=None,
+        help="Expected UMI length. Only UMI's of this length are extracted, the suffix must follow the prefix after it",
+    ),
+]
+
+EXTRACT_OPTIONS = INPUT_OPTIONS + READ_OPTIONS
+
+STORE_OPTIONS = [
+    click.option(
+        "--count_store",
+        type=click.Path(dir_okay=False),
+        help="Save the UMI counts to this count store (.npz) with the FASTQ files they came from, and cluster and report the counts of the store",
+    ),
+    click.option(
+        "--append/--no_append",
+        default=False,
+        help="Add the UMI counts of --input_fastq to the counts already in --count_store instead of replacing them. A FASTQ file already in the store is not read again",
+    ),
+]
+
+BATCH_OPTIONS = [
+    click.option(
+        "--sample_sheet",
+        required=True,
+        type=click.Path(exists=True, dir_okay=False),
+        help="Tab separated sample sheet with Sample and FASTQ columns, and optionally UMI_Prefix and UMI_Suffix columns. FASTQ paths are relative to the sample sheet",
+    ),
+    click.option(
+        "--umi_prefix",
+        type=str,
+        help="UMI Prefix of samples without a UMI_Prefix in the sample sheet",
+    ),
+    click.option(
+        "--umi_suffix",
+        type=str,
+        help="UMI Suffix of samples without a UMI_Suffix in the sample sheet",
+    ),
+    click.option(
+        "--processes",
+        type=click.IntRange(min=1),
+        default=1,
+        help="Number of samples processed in parallel",
+    ),
+]
+
+DISTANCE_OPTIONS = [
+    click.option(
+        "--distance_output",
+        type=click.Choice(["auto", "dense", "sparse"]),
+        default="auto",
+        help="dense - write all pairwise hamming distances to UMI_Hamming_Distance_Table.txt. sparse - write only pairs within --sparse_max_distance to UMI_Hamming_Distance_Edges.txt. auto - sparse above --dense_distance_max_umis unique UMI's",
+    ),
+    click.option(
+        "--dense_distance_max_umis",
+        type=click.IntRange(min=0),
+        default=5000,
+        help="Largest number of unique UMI's the dense distance table is written for with --distance_output auto",
+    ),
+    click.option(
+        "--sparse_max_distance",
+        type=click.IntRange(min=0),
+        default=2,
+        help="Largest hamming distance of the pairs written with the sparse distance output",
+    ),
+]
+
+CLUSTER_OPTIONS = [
+    click.option(
+        "--collapse_method",
+        type=click.Choice(cluster_utils.COLLAPSE_METHODS),
+        default="groups",
+        help="How UMI's within a hamming distance of 2 are collapsed. groups - each UMI with its similar UMI's, groups can overlap. connected - connected components of similar UMI's. directional - a UMI joins a similar UMI with at least 2x-1 its count. connected and directional write cluster sizes to UMI_Cluster_Sizes.txt",
+    ),
+]
+
+DENDROGRAM_OPTIONS = [
+    click.option(
+        "--dendrogram_clustering_method",
+        required=True,
+        type=click.Choice(
+            ["single", "complete", "average", "weighted"],
+            case_sensitive=False,
+        ),
+        default="single",
+        help="Method to be used for clustering while generating a dendrogram, based on Hamming distances. See https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.linkage.html#scipy.cluster.hierarchy.linkage",
+    ),
+    click.option(
+        "--dendrogram_max_umis",
+        type=click.IntRange(min=2),
+        default=1000,
+        help="Largest number of UMI's clustered for the dendrogram. Above it, only the most common UMI's are clustered",
+    ),
+    click.option(
+        "--dendrogram_leaves",
+        type=click.IntRange(min=2),
+        default=100,
+        help="Largest number of leaves drawn in the dendrogram. Larger trees are truncated to their last merged clusters",
+    ),
+]
+
+OUTPUT_OPTIONS = [
+    click.option(
+        "--output_dir",
+        type=click.Path(file_okay=False),
+        default="./data",
+        help="Folder to write results to. Stage outputs are cached in its .cache folder",
+    ),
+    click.option(
+        "--output_format",
+        type=click.Choice(table_utils.OUTPUT_FORMATS),
+        default="tsv",
+        help="Format of the output tables. tsv - tab separated .txt files. parquet and arrow - compressed, dictionary encoded columnar .parquet and .arrow files, written in row groups. Needs pyarrow",
+    ),
+    click.option(
+        "--cache/--no_cache",
+        default=True,
+        help="Reuse stage outputs cached by earlier runs with the same inputs and parameters",
+    ),
+]
+
+PROFILE_OPTIONS = [
+    click.option(
+        "--profile_report",
+        type=click.Path(dir_okay=False),
+        help="Write wall time, CPU time, peak memory and item counts of each stage to this JSON file",
+    ),
+    click.option(
+        "--profile_dir",
+        type=click.Path(file_okay=False),
+        help="Run each stage under cProfile and dump its stats to <stage>.prof in this folder",
+    ),
+    click.option(
+        "--trace_memory/--no_trace_memory",
+        default=False,
+        help="Trace the peak memory allocated by Python in each stage with tracemalloc. Slows the stages down",
+    ),
+]
+
+
+def add_options(*option_lists):
+    """Apply lists of click options to a command, in the order given.
+
+    Args:
+        option_lists (list): Lists of click.option decorators
+
+    Returns:
+        function: Decorator adding the options
+    """
+
+    def decorator(command):
+        for option in reversed(
+            [option for options in option_lists for option in options]
+        ):
+            command = option(command)
+        return command
+
+    return decorator
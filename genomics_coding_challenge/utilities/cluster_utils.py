@@ -0,0 +1,175 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from utilities import hamming_utils
+
+# Ways to collapse similar UMI's, accepted by --collapse_method
+COLLAPSE_METHODS = ["groups", "connected", "directional"]
+
+
+def union_find_components(number_of_umis, rows, columns):
+    """Connected components of the graph of similar UMI's, with an array based union-find.
+
+    All edges are processed at once: the larger root of every edge that joins two
+    components is hooked under the smaller one, then paths are compressed until every
+    UMI points at its root. This repeats until no edge joins two components.
+
+    Args:
+        number_of_umis (int): Number of UMI's (graph nodes)
+        rows (numpy array): First UMI of each edge
+        columns (numpy array): Second UMI of each edge
+
+    Returns:
+        numpy array: Root of each UMI, the smallest UMI index in its component
+    """
+    parents = np.arange(number_of_umis)
+    while True:
+        row_roots, column_roots = parents[rows], parents[columns]
+        joins = row_roots != column_roots
+        if not joins.any():
+            return parents
+
+        np.minimum.at(
+            parents,
+            np.maximum(row_roots[joins], column_roots[joins]),
+            np.minimum(row_roots[joins], column_roots[joins]),
+        )
+        while True:
+            grandparents = parents[parents]
+            if (grandparents == parents).all():
+                break
+            parents = grandparents
+
+
+def directional_clusters(counts, rows, columns):
+    """Clusters of UMI's by the directional method of UMI-tools.
+
+    A UMI can absorb a similar UMI if count(parent) >= 2 * count(child) - 1. Starting
+    from the most common UMI, each cluster holds all UMI's reachable through such edges
+    that are not in a cluster yet.
+
+    Args:
+        counts (numpy array): Count (or quality weight) of each UMI
+        rows (numpy array): First UMI of each pair of similar UMI's
+        columns (numpy array): Second UMI of each pair of similar UMI's
+
+    Returns:
+        numpy array: Root of each UMI, the UMI its cluster was started from
+    """
+    number_of_umis = len(counts)
+    if counts.dtype.kind in "ui":
+        counts = counts.astype(np.int64)
+    parents = np.concatenate([rows, columns])
+    children = np.concatenate([columns, rows])
+    absorbs = counts[parents] >= 2 * counts[children] - 1
+    parents, children = parents[absorbs], children[absorbs]
+
+    # Children of each UMI, as a CSR adjacency list
+    by_parent = np.argsort(parents, kind="stable")
+    children = children[by_parent].tolist()
+    child_offsets = np.concatenate(
+        [[0], np.cumsum(np.bincount(parents, minlength=number_of_umis))]
+    ).tolist()
+
+    roots = [-1] * number_of_umis
+    for root in np.lexsort((np.arange(number_of_umis), -counts)).tolist():
+        if roots[root] >= 0:
+            continue
+        roots[root] = root
+        cluster = [root]
+        for umi in cluster:
+            for child in children[child_offsets[umi] : child_offsets[umi + 1]]:
+                if roots[child] < 0:
+                    roots[child] = root
+                    cluster.append(child)
+    return np.array(roots, dtype=np.int64)
+
+
+def cluster_umis(
+    unique_umi_counts, distance_value, method="connected", umi_weights=None
+):
+    """Cluster UMI's that are within a hamming distance of each other.
+
+    Similar pairs come from hamming_utils.find_similar_pairs. With the "connected" method,
+    clusters are connected components of similar UMI's. With "directional", a UMI only
+    joins the cluster of a UMI with at least about twice its count.
+
+    The UMI with the highest count (first in sorted order on ties) is the cluster UMI,
+    and the distance of each UMI to it is the number of bases it has wrong. With
+    umi_weights, quality weights of UMI's (see quality_utils) replace counts in both.
+
+    Args:
+        unique_umi_counts (Counter): Counter object that contains UMI sequences and counts
+        distance_value (int): Largest hamming distance between similar UMI's
+        method (str, optional): "connected" or "directional". Defaults to "connected".
+        umi_weights (dict, optional): Quality weight of each UMI, used instead of counts to cluster. Defaults to None.
+
+    Returns:
+        pandas dataframe: UMI, Count, Cluster_UMI and Distance (to the cluster UMI) of each UMI, in UMI order
+    """
+    logging.info(
+        f"Clustering UMI's within hamming distance {distance_value} ({method})"
+    )
+    sorted_umis = sorted(unique_umi_counts.keys())
+    counts = np.array([unique_umi_counts[umi] for umi in sorted_umis], dtype=np.int64)
+    rows, columns, _ = hamming_utils.find_similar_pairs(sorted_umis, distance_value)
+    cluster_counts = counts
+    if umi_weights is not None:
+        cluster_counts = np.array(
+            [umi_weights[umi] for umi in sorted_umis], dtype=np.float64
+        )
+
+    if method == "directional":
+        roots = directional_clusters(cluster_counts, rows, columns)
+    else:
+        roots = union_find_components(len(sorted_umis), rows, columns)
+
+    # Cluster UMI - the most common UMI of each cluster, ties go to the first in order
+    by_count = np.lexsort((np.arange(len(sorted_umis)), -cluster_counts, roots))
+    first_of_cluster = np.ones(len(by_count), dtype=bool)
+    first_of_cluster[1:] = roots[by_count][1:] != roots[by_count][:-1]
+    cluster_umi_of_root = np.zeros(len(sorted_umis), dtype=np.int64)
+    cluster_umi_of_root[roots[by_count][first_of_cluster]] = by_count[first_of_cluster]
+    cluster_umis = cluster_umi_of_root[roots]
+
+    return pd.DataFrame(
+        {
+            "UMI": sorted_umis,
+            "Count": counts,
+            "Cluster_UMI": [sorted_umis[index] for index in cluster_umis.tolist()],
+            "Distance": hamming_utils.pair_hamming_distance(
+                sorted_umis, np.arange(len(sorted_umis)), cluster_umis
+            ),
+        }
+    )
+
+
+def summarize_clusters(umi_clusters):
+    """Size, reads and error bases of each cluster, in one pass over the clustered UMI's.
+
+    Error bases of a cluster are the bases that differ from the cluster UMI, over all
+    reads of the cluster - sum(distance to the cluster UMI * count).
+
+    Args:
+        umi_clusters (pandas dataframe): Clustered UMI's from cluster_umis
+
+    Returns:
+        pandas dataframe: Cluster_UMI, Unique_UMIs, Reads and Error_Bases of each cluster, most reads first
+    """
+    cluster_sizes = (
+        umi_clusters.assign(
+            Error_Bases=umi_clusters.Distance.astype(np.int64) * umi_clusters.Count
+        )
+        .groupby("Cluster_UMI", sort=True)
+        .agg(
+            Unique_UMIs=("UMI", "size"),
+            Reads=("Count", "sum"),
+            Error_Bases=("Error_Bases", "sum"),
+        )
+        .reset_index()
+    )
+    return cluster_sizes.sort_values(
+        ["Reads", "Cluster_UMI"], ascending=[False, True], ignore_index=True
+    )
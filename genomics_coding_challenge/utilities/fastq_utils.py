@@ -0,0 +1,106 @@
+import logging
+import os
+
+
+def is_gzipped(input_fastq):
+    """Check for the gzip magic number at the start of a file.
+
+    Args:
+        input_fastq (file): *.fastq or *.fastq.gz file.
+
+    Returns:
+        bool: True if the file is gzip (or BGZF) compressed
+    """
+    with open(input_fastq, "rb") as fastq_fh:
+        return fastq_fh.read(2) == b"\x1f\x8b"
+
+
+def plan_fastq_shards(input_fastq, number_of_shards):
+    """Split a plain FASTQ file into contiguous, record aligned byte ranges.
+
+    Each shard starts at the first record header in its range. Gzipped files can't be
+    entered at arbitrary offsets, they are streamed instead (see stream_utils.use_stream).
+
+    Args:
+        input_fastq (file): *.fastq file.
+        number_of_shards (int): Number of shards to create
+
+    Returns:
+        list: Shards as (input_fastq, start, end) tuples of byte offsets
+    """
+    if is_gzipped(input_fastq):
+        raise ValueError(
+            f"{input_fastq} is gzipped and can't be split into byte ranges, stream it"
+        )
+
+    total = os.path.getsize(input_fastq)
+    boundaries = [
+        total * shard // number_of_shards for shard in range(number_of_shards + 1)
+    ]
+    logging.info(f"Splitting {input_fastq} into {number_of_shards} shards by bytes")
+    return [
+        (input_fastq, start, end) for start, end in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+
+def iter_shard_records(shard):
+    """Iterate over the records of a shard created by plan_fastq_shards.
+
+    Args:
+        shard (tuple): (input_fastq, start, end)
+
+    Yields:
+        tuple: (read name, sequence, quality), read names end at the first whitespace like pyfastx
+    """
+    input_fastq, start, end = shard
+    with open(input_fastq, "rb") as fastq_fh:
+        record_start = find_record_start(fastq_fh, start)
+        record_end = find_record_start(fastq_fh, end)
+
+        fastq_fh.seek(record_start)
+        position = record_start
+        lines = iter(fastq_fh)
+        for header, sequence, separator, quality in zip(lines, lines, lines, lines):
+            if position >= record_end:
+                break
+            position += len(header) + len(sequence) + len(separator) + len(quality)
+            yield (
+                header[1:].split(None, 1)[0].decode(),
+                sequence.rstrip().decode(),
+                quality.rstrip().decode(),
+            )
+
+
+def find_record_start(fastq_fh, offset):
+    """Find the first FASTQ record header at or after a byte offset.
+
+    A header is a line starting with "@" that is followed two lines later by a line
+    starting with "+". Quality lines may start with "@", but the line two below them is
+    a sequence line, so they are not mistaken for headers.
+
+    Args:
+        fastq_fh (file object): FASTQ file opened in binary mode
+        offset (int): Byte offset to start looking at
+
+    Returns:
+        int: Byte offset of the record header, or of the end of file
+    """
+    if offset == 0:
+        return 0
+
+    # Move to the start of the first line at or after offset
+    fastq_fh.seek(offset - 1)
+    fastq_fh.readline()
+
+    while True:
+        line_start = fastq_fh.tell()
+        header = fastq_fh.readline()
+        if not header:
+            return line_start
+        fastq_fh.readline()
+        separator = fastq_fh.readline()
+        if header.startswith(b"@") and separator.startswith(b"+"):
+            return line_start
+
+        fastq_fh.seek(line_start)
+        fastq_fh.readline()
@@ -0,0 +1,156 @@
+import functools
+
+from Levenshtein import hamming
+
+
+def pattern_masks(pattern):
+    """Bitap masks of a pattern: bit i of the mask of a base is set if pattern[i] is that base.
+
+    Args:
+        pattern (str): Pattern, upper case
+
+    Returns:
+        dict: Mask of each base of the pattern, bases not in it have no mask
+    """
+    masks = {}
+    for position, base in enumerate(pattern):
+        masks[base] = masks.get(base, 0) | 1 << position
+    return masks
+
+
+def find_approximate_matches(text, pattern, masks, max_mismatches, start=0, end=None):
+    """Find windows of a text within max_mismatches substitutions of a pattern, with bitap.
+
+    The shift-and algorithm keeps, for each number of mismatches j up to max_mismatches, a
+    bit vector whose bit i is set if the first i + 1 bases of the pattern end at the
+    current position of the text with at most j mismatches. All vectors are updated with a
+    few integer operations per base of the text, whatever the length of the pattern.
+
+    Args:
+        text (str): Text to search, upper case
+        pattern (str): Pattern, upper case
+        masks (dict): pattern_masks of the pattern
+        max_mismatches (int): Largest number of substituted bases
+        start (int, optional): Search text[start:end] only. Defaults to 0.
+        end (int, optional): Search text[start:end] only. Defaults to None, the end of the text.
+
+    Returns:
+        list: (window start, mismatches) of each window, left to right, with the fewest mismatches it has
+    """
+    pattern_length = len(pattern)
+    all_bits = (1 << pattern_length) - 1
+    match_bit = 1 << (pattern_length - 1)
+    states = [0] * (max_mismatches + 1)
+    levels = range(max_mismatches + 1)
+    get_mask = masks.get
+    matches = []
+
+    end = len(text) if end is None else end
+    for position in range(start, end):
+        mask = get_mask(text[position], 0)
+        substituted = 0
+        for mismatches in levels:
+            shifted = ((states[mismatches] << 1) | 1) & all_bits
+            # A base that matches extends j mismatches, any base extends j - 1
+            states[mismatches] = (shifted & mask) | substituted
+            substituted = shifted
+        for mismatches in levels:
+            if states[mismatches] & match_bit:
+                matches.append((position - pattern_length + 1, mismatches))
+                break
+    return matches
+
+
+@functools.lru_cache(maxsize=None)
+def compile_approximate_flank_matcher(
+    umi_prefix, umi_suffix, max_mismatches, umi_length=None, return_span=False
+):
+    """Build a function that extracts the UMI between a prefix and suffix with mismatches.
+
+    The prefix is the window with the fewest mismatches, the leftmost of those, like the
+    first prefix of the exact matcher. With umi_length, the suffix must start umi_length
+    bases after the prefix. Otherwise it is the window after the prefix with the fewest
+    mismatches, the leftmost of those: unlike exact suffixes, windows with mismatches turn
+    up by chance in the rest of the read, and the closest one is the likeliest. If no
+    suffix is found after the best prefix, the next best prefixes are tried. Only
+    substitutions are allowed, the flanks keep their length.
+
+    With umi_length, reads with one exact flank are checked first for the other flank
+    with mismatches umi_length bases away from it, without scanning the read.
+
+    Args:
+        umi_prefix (str): UMI prefix
+        umi_suffix (str): UMI suffix
+        max_mismatches (int): Largest number of substituted bases in each flank
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+        return_span (bool, optional): Return the start and end of the UMI in the read instead of the UMI. Defaults to False.
+
+    Returns:
+        function: Takes a read sequence, returns the UMI (or its span) or None if the flanks are not found
+    """
+    umi_prefix, umi_suffix = umi_prefix.upper(), umi_suffix.upper()
+    prefix_length, suffix_length = len(umi_prefix), len(umi_suffix)
+    prefix_masks, suffix_masks = pattern_masks(umi_prefix), pattern_masks(umi_suffix)
+
+    def suffix_start_after(read_upper, umi_start):
+        if umi_length is not None:
+            suffix_start = umi_start + umi_length
+            window = read_upper[suffix_start : suffix_start + suffix_length]
+            if (
+                len(window) == suffix_length
+                and hamming(window, umi_suffix) <= max_mismatches
+            ):
+                return suffix_start
+            return None
+
+        suffixes = find_approximate_matches(
+            read_upper, umi_suffix, suffix_masks, max_mismatches, start=umi_start
+        )
+        if not suffixes:
+            return None
+        return min(suffixes, key=lambda match: match[1])[0]
+
+    def find_umi_span(read):
+        read_upper = read if read.isupper() else read.upper()
+        if umi_length is not None:
+            prefix_start = read_upper.find(umi_prefix)
+            if prefix_start != -1:
+                umi_start = prefix_start + prefix_length
+                if suffix_start_after(read_upper, umi_start) is not None:
+                    return umi_start, umi_start + umi_length
+
+            suffix_start = read_upper.rfind(umi_suffix)
+            prefix_start = suffix_start - umi_length - prefix_length
+            if (
+                suffix_start != -1
+                and prefix_start >= 0
+                and hamming(
+                    read_upper[prefix_start : prefix_start + prefix_length], umi_prefix
+                )
+                <= max_mismatches
+            ):
+                return prefix_start + prefix_length, suffix_start
+
+        # The suffix must fit after the prefix
+        prefix_end = len(read_upper) - suffix_length - (umi_length or 0)
+        prefixes = find_approximate_matches(
+            read_upper,
+            umi_prefix,
+            prefix_masks,
+            max_mismatches,
+            end=max(prefix_end, 0),
+        )
+        for prefix_start, _ in sorted(prefixes, key=lambda match: match[1]):
+            umi_start = prefix_start + prefix_length
+            suffix_start = suffix_start_after(read_upper, umi_start)
+            if suffix_start is not None:
+                return umi_start, suffix_start
+        return None
+
+    def find_umi(read):
+        umi_span = find_umi_span(read)
+        if umi_span is None:
+            return None
+        return read[umi_span[0] : umi_span[1]]
+
+    return find_umi_span if return_span else find_umi
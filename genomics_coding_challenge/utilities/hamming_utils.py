@@ -0,0 +1,246 @@
+from itertools import combinations
+
+import numpy as np
+
+from utilities import umi_codes
+
+# Distances computed per block, a block of uint32 codes takes about 1 MB
+HAMMING_BLOCK_ELEMENTS = 1 << 18
+
+# Number of set bits in every 16 bit value
+_POPCOUNT_16 = np.array([bin(value).count("1") for value in range(1 << 16)], np.uint8)
+
+
+def distance_dtype(umi_length):
+    """Smallest unsigned integer dtype that holds distances between UMI's of a length.
+
+    Args:
+        umi_length (int): Number of bases in each UMI
+
+    Returns:
+        numpy dtype: uint8 for UMI's shorter than 256 bases
+    """
+    return np.min_scalar_type(umi_length)
+
+
+def encode_umi_matrix(umis):
+    """Store UMI's as rows of a uint8 matrix, one byte per base.
+
+    Args:
+        umis (list): UMI sequences, all the same length
+
+    Returns:
+        numpy array: (number of UMI's, UMI length) uint8 matrix
+    """
+    umi_length = len(umis[0]) if umis else 0
+    return np.frombuffer(
+        "".join(umis).encode("ascii", "replace"), dtype=np.uint8
+    ).reshape(-1, umi_length)
+
+
+def pack_umis(umis):
+    """Pack UMI's into 2-bit codes, in the smallest unsigned dtype that holds them.
+
+    Args:
+        umis (list): UMI sequences, all the same length
+
+    Returns:
+        numpy array: uint32 codes for UMI's of up to 16 bases, uint64 for up to 31 bases.
+            None if the UMI's are longer or have bases other than A, C, G and T.
+    """
+    umi_length = len(umis[0])
+    if umi_length > 31:
+        return None
+    if umi_length == 0:
+        return np.zeros(len(umis), dtype=np.uint32)
+    codes = umi_codes.encode_umis(umis, umi_length)
+    if (codes < 0).any():
+        return None
+    return codes.astype(np.uint32 if umi_length <= 16 else np.uint64)
+
+
+def packed_hamming_distance(codes, other_codes):
+    """Hamming distance between 2-bit codes, by XOR and popcount.
+
+    A base differs if either of its 2 bits differ. Those are folded into the low bit of
+    each base, and the low bits are counted with a 16 bit lookup table.
+
+    Args:
+        codes (numpy array): uint32 or uint64 codes from pack_umis
+        other_codes (numpy array): Codes of the same dtype, broadcast against codes
+
+    Returns:
+        numpy array: uint8 distances
+    """
+    differences = codes ^ other_codes
+    differences = (differences | (differences >> 1)) & codes.dtype.type(
+        0x5555555555555555 if codes.dtype == np.uint64 else 0x55555555
+    )
+    # Low bits of each base are the even bits, shift the upper half onto the odd bits
+    if codes.dtype == np.uint64:
+        differences = (differences & 0xFFFFFFFF) | (differences >> 31)
+        return _POPCOUNT_16[differences & 0xFFFF] + _POPCOUNT_16[differences >> 16]
+    return _POPCOUNT_16[(differences & 0xFFFF) | (differences >> 15)]
+
+
+def iter_hamming_distance_blocks(umis, block_elements=HAMMING_BLOCK_ELEMENTS):
+    """Compute pairwise Hamming distances block by block, for the upper triangle.
+
+    Each block holds the distances of a few consecutive UMI's to all UMI's from the
+    first of them on, and has about block_elements entries. Only the entries right of
+    the diagonal are new, the rest repeat earlier blocks.
+
+    UMI's made of A, C, G and T are compared as 2-bit codes (XOR + popcount), others as
+    uint8 matrices.
+
+    Args:
+        umis (list): UMI sequences, all the same length
+        block_elements (int, optional): Number of distances per block. Defaults to HAMMING_BLOCK_ELEMENTS.
+
+    Yields:
+        tuple: (row_start, block) - block[row, column] is the distance between
+            umis[row_start + row] and umis[row_start + column]
+    """
+    if len({len(umi) for umi in umis}) > 1:
+        raise ValueError("Hamming distance needs UMI's of the same length")
+    if not umis:
+        return
+
+    dtype = distance_dtype(len(umis[0]))
+    codes = pack_umis(umis)
+    matrix = encode_umi_matrix(umis) if codes is None else None
+
+    number_of_umis = len(umis)
+    row_start = 0
+    while row_start < number_of_umis:
+        columns = number_of_umis - row_start
+        row_end = min(number_of_umis, row_start + max(1, block_elements // columns))
+        if codes is not None:
+            block = packed_hamming_distance(
+                codes[row_start:row_end, None], codes[None, row_start:]
+            )
+        else:
+            block = (
+                matrix[row_start:row_end, None, :] != matrix[None, row_start:, :]
+            ).sum(axis=2, dtype=dtype)
+        yield row_start, block.astype(dtype, copy=False)
+        row_start = row_end
+
+
+def pairwise_hamming_distance(umis, block_elements=HAMMING_BLOCK_ELEMENTS):
+    """Condensed pairwise Hamming distances, in the same layout as scipy's pdist.
+
+    Args:
+        umis (list): UMI sequences, all the same length
+        block_elements (int, optional): Number of distances per block. Defaults to HAMMING_BLOCK_ELEMENTS.
+
+    Returns:
+        numpy array: Condensed distance matrix, in the smallest unsigned integer dtype
+    """
+    number_of_umis = len(umis)
+    dtype = distance_dtype(len(umis[0])) if umis else np.uint8
+    condensed = np.empty(number_of_umis * (number_of_umis - 1) // 2, dtype=dtype)
+
+    offset = 0
+    for row_start, block in iter_hamming_distance_blocks(umis, block_elements):
+        for row in range(len(block)):
+            row_distances = block[row, row + 1 :]
+            condensed[offset : offset + len(row_distances)] = row_distances
+            offset += len(row_distances)
+    return condensed
+
+
+def find_similar_pairs(umis, max_distance):
+    """Find all pairs of UMI's within a Hamming distance, without a distance matrix.
+
+    Two UMI's within max_distance of each other are equal once the positions they differ
+    at are masked. So for every set of max_distance positions, UMI's are grouped by their
+    sequence with those positions masked, and all UMI's in a group are similar. This takes
+    O(n * L^max_distance) time, instead of comparing all n^2 / 2 pairs.
+
+    Args:
+        umis (list): UMI sequences, all the same length
+        max_distance (int): Largest Hamming distance of a similar pair
+
+    Returns:
+        tuple: (rows, columns, distances) numpy arrays - indexes into umis with
+            rows < columns, sorted, and the Hamming distance of each pair. Identical
+            UMI's are not paired.
+    """
+    if len({len(umi) for umi in umis}) > 1:
+        raise ValueError("Hamming distance needs UMI's of the same length")
+    empty = np.empty(0, dtype=np.int64)
+    if not umis or max_distance < 1:
+        return empty, empty, np.empty(0, dtype=np.uint8)
+
+    umi_length = len(umis[0])
+    codes = pack_umis(umis)
+    matrix = encode_umi_matrix(umis) if codes is None else None
+
+    rows, columns = [empty], [empty]
+    for masked_positions in combinations(
+        range(umi_length), min(max_distance, umi_length)
+    ):
+        if codes is not None:
+            mask = sum(
+                3 << 2 * (umi_length - 1 - position) for position in masked_positions
+            )
+            keys = codes & ~codes.dtype.type(mask)
+        else:
+            kept_positions = [
+                position
+                for position in range(umi_length)
+                if position not in masked_positions
+            ]
+            if kept_positions:
+                keys = np.ascontiguousarray(matrix[:, kept_positions])
+                keys = keys.view(np.dtype((np.void, len(kept_positions)))).ravel()
+            else:
+                # Every position is masked, all UMI's are within max_distance
+                keys = np.zeros(len(umis), dtype=np.uint8)
+
+        # Equal keys are adjacent once sorted, pair each UMI with the ones after it
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        for offset in range(1, len(umis)):
+            same = sorted_keys[offset:] == sorted_keys[:-offset]
+            if not same.any():
+                break
+            rows.append(order[:-offset][same])
+            columns.append(order[offset:][same])
+
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    pairs = np.unique(np.minimum(rows, columns) * len(umis) + np.maximum(rows, columns))
+    rows, columns = pairs // len(umis), pairs % len(umis)
+
+    distances = _pair_hamming_distance(codes, matrix, rows, columns)
+    similar = distances > 0
+    return rows[similar], columns[similar], distances[similar]
+
+
+def pair_hamming_distance(umis, rows, columns):
+    """Hamming distances of selected pairs of UMI's.
+
+    Args:
+        umis (list): UMI sequences, all the same length
+        rows (numpy array): Index into umis of the first UMI of each pair
+        columns (numpy array): Index into umis of the second UMI of each pair
+
+    Returns:
+        numpy array: Distance of each pair, in the smallest unsigned integer dtype
+    """
+    if len({len(umi) for umi in umis}) > 1:
+        raise ValueError("Hamming distance needs UMI's of the same length")
+    if not umis:
+        return np.empty(0, dtype=np.uint8)
+    codes = pack_umis(umis)
+    matrix = encode_umi_matrix(umis) if codes is None else None
+    return _pair_hamming_distance(codes, matrix, rows, columns)
+
+
+def _pair_hamming_distance(codes, matrix, rows, columns):
+    if codes is not None:
+        return packed_hamming_distance(codes[rows], codes[columns])
+    return (matrix[rows] != matrix[columns]).sum(
+        axis=1, dtype=distance_dtype(matrix.shape[1])
+    )
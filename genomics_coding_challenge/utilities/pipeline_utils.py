@@ -0,0 +1,983 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import Counter, namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import spatial
+
+from utilities import (
+    cluster_utils,
+    plotting_utils,
+    profile_utils,
+    quality_utils,
+    store_utils,
+    stream_utils,
+    table_utils,
+    umi_utils,
+)
+
+# Cached stage outputs are stored in this folder of the output folder
+CACHE_FOLDER = ".cache"
+
+# Bump when the cached data of a stage changes, so old caches are not reused
+CACHE_VERSION = 1
+
+# Hamming distance at or below which UMI's are collapsed
+COLLAPSE_DISTANCE = 2
+
+# Output of a stage - the cache key it is stored under, its columns, whether it was loaded
+# from the cache, and whether it can be cached (not if it was read from a stream)
+StageResult = namedtuple(
+    "StageResult", ["key", "data", "cached", "cacheable"], defaults=[False, True]
+)
+
+
+def file_identity(path):
+    """Identify a file by path, size and modification time, without reading it.
+
+    stdin and named pipes are never the same twice, they are identified by the time
+    they are read at. Their stages are not cached, see run_stage.
+
+    Args:
+        path (str): Path to a file, or "-" for stdin
+
+    Returns:
+        list: Absolute path, size in bytes and modification time in ns
+    """
+    if stream_utils.is_stream(path):
+        return [path, None, time.time_ns()]
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def stage_key(stage, upstream_keys, params):
+    """Hash a stage's name, upstream stages and parameters into its cache key.
+
+    Args:
+        stage (str): Stage name
+        upstream_keys (list): Cache keys of the stages it reads from
+        params (dict): Parameters that change its output, JSON serializable
+
+    Returns:
+        str: Cache key
+    """
+    description = json.dumps(
+        {
+            "stage": stage,
+            "version": CACHE_VERSION,
+            "upstream": upstream_keys,
+            "params": params,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(description.encode("utf8")).hexdigest()[:20]
+
+
+def output_identities(outputs):
+    """Identify the files a stage wrote, see file_identity.
+
+    Args:
+        outputs (list): Paths of the files
+
+    Returns:
+        dict: file_identity of each file, None for missing files
+    """
+    return {
+        output: file_identity(output) if os.path.isfile(output) else None
+        for output in outputs
+    }
+
+
+def run_stage(
+    output_dir,
+    stage,
+    upstream,
+    params,
+    compute,
+    use_cache=True,
+    outputs=(),
+    cacheable=True,
+):
+    """Run a stage, or load its output if an earlier run cached it under the same key.
+
+    Stage outputs are dictionaries of numpy columns, stored as .npz files named after the
+    stage and its key. A change of parameters or of any upstream stage changes the key, so
+    only invalidated stages are recomputed.
+
+    The size and modification time of the files a stage writes are stored next to its
+    output. If a file was removed or overwritten since, for example by a run with other
+    parameters in the same output folder, the stage is rerun to write it again.
+
+    Stages of stream inputs, which are never read twice, and the stages downstream of
+    them are neither loaded from the cache nor written to it.
+
+    Args:
+        output_dir (str): Output folder, the cache is kept in its CACHE_FOLDER
+        stage (str): Stage name
+        upstream (list): StageResults of the stages it reads from
+        params (dict): Parameters that change its output, JSON serializable
+        compute (function): Computes the stage output, returns a dictionary of numpy arrays
+        use_cache (bool, optional): Load cached output if there is one. Defaults to True.
+        outputs (tuple, optional): Files the stage writes while it runs. Defaults to ().
+        cacheable (bool, optional): Cache the output. Defaults to True.
+
+    Returns:
+        StageResult: key, columns and cache hit of the stage output
+    """
+    key = stage_key(stage, [result.key for result in upstream], params)
+    cacheable = cacheable and all(result.cacheable for result in upstream)
+    if not cacheable:
+        logging.info(f"Running {stage} stage, its input is a stream and not cached")
+        return StageResult(key, compute(), cacheable=False)
+
+    cache_file = os.path.join(output_dir, CACHE_FOLDER, f"{stage}-{key}.npz")
+    outputs_file = os.path.join(output_dir, CACHE_FOLDER, f"{stage}-{key}.outputs.json")
+
+    if use_cache and os.path.isfile(cache_file):
+        cached_outputs = None
+        if os.path.isfile(outputs_file):
+            with open(outputs_file) as outputs_fh:
+                cached_outputs = json.load(outputs_fh)
+        if not outputs or cached_outputs == output_identities(outputs):
+            logging.info(f"Using cached {stage} stage output {cache_file}")
+            with np.load(cache_file) as cached:
+                return StageResult(
+                    key, {name: cached[name] for name in cached.files}, cached=True
+                )
+        logging.info(f"Outputs of the cached {stage} stage changed, running it again")
+
+    logging.info(f"Running {stage} stage")
+    data = compute()
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+    # Written under a temporary name first, an interrupted run leaves no partial cache
+    partial_file = f"{cache_file}.partial.npz"
+    np.savez(partial_file, **data)
+    if outputs:
+        with open(outputs_file, "w") as outputs_fh:
+            json.dump(output_identities(outputs), outputs_fh)
+    os.replace(partial_file, cache_file)
+    return StageResult(key, data)
+
+
+def umi_array(umis):
+    """Store UMI's as a numpy bytes array, one byte per base."""
+    return np.array([umi.encode("ascii") for umi in umis], dtype=bytes)
+
+
+def umi_list(umi_bytes):
+    """Convert a numpy bytes array from umi_array back to a list of UMI's."""
+    return [umi.decode("ascii") for umi in umi_bytes.tolist()]
+
+
+def umi_counts_of(count_result):
+    """UMI counts of the count stage, as a dictionary in most common order."""
+    return dict(
+        zip(umi_list(count_result.data["umis"]), count_result.data["counts"].tolist())
+    )
+
+
+def umi_weights_of(count_result):
+    """UMI quality weights of the count stage as a dictionary, None without weights."""
+    if "weights" not in count_result.data:
+        return None
+    return dict(
+        zip(umi_list(count_result.data["umis"]), count_result.data["weights"].tolist())
+    )
+
+
+def stage_items(*results):
+    """Count the items in stage outputs, for the profile report.
+
+    Args:
+        results (StageResult): Outputs of extract_stage, count_stage, distance_stage or cluster_stage
+
+    Returns:
+        dict: reads, filtered_reads, recovered_reads, failed_reads and unique_umis of extract and count outputs, pairs (dense) or close_pairs (sparse) of distance outputs, error_bases and clusters of cluster outputs
+    """
+    items = {}
+    for result in results:
+        data = result.data
+        if "counts" in data:
+            items["reads"] = int(data["counts"].sum())
+            items["filtered_reads"] = int(data["filtered_reads"])
+            items["recovered_reads"] = int(data["recovered_reads"])
+            items["failed_reads"] = int(data["failed_reads"])
+            items["unique_umis"] = len(data["umis"])
+        if "pdist_distance_matrix" in data:
+            items["pairs"] = len(data["pdist_distance_matrix"])
+        if "UMI_1" in data:
+            items["close_pairs"] = len(data["UMI_1"])
+        if "error_bases" in data:
+            items["error_bases"] = int(data["error_bases"])
+        if "Cluster_UMI" in data:
+            items["clusters"] = len(np.unique(data["Cluster_UMI"]))
+    return items
+
+
+def log_extraction_yield(data, seconds):
+    """Log the throughput of extraction, and how many reads flank mismatches recovered.
+
+    Args:
+        data (dict): Columns of extract_stage output
+        seconds (float): Wall time of extraction
+    """
+    failed_reads = int(data["failed_reads"])
+    recovered_reads = int(data["recovered_reads"])
+    reads = int(data["counts"].sum()) + int(data["filtered_reads"]) + failed_reads
+    logging.info(
+        f"Extracted UMI's from {reads} reads in {seconds:.3f}s - "
+        f"{reads / max(seconds, 1e-9):,.0f} reads/sec"
+    )
+    if recovered_reads:
+        logging.info(
+            f"{recovered_reads} reads ({recovered_reads / reads:.2%}) were recovered "
+            f"with flank mismatches or by the UMI length"
+        )
+    if failed_reads:
+        logging.warning(
+            f"{failed_reads} reads ({failed_reads / reads:.2%}) had no UMI flanks "
+            f"or UMI of the expected length, and were skipped"
+        )
+
+
+def extraction_params(
+    umi_prefix,
+    umi_suffix,
+    min_umi_base_quality=0,
+    min_umi_mean_quality=0,
+    quality_weighted=False,
+    flank_mismatches=0,
+    umi_length=None,
+):
+    """Parameters of extraction that change which UMI's are counted, see extract_stage.
+
+    Returns:
+        dict: The parameters, JSON serializable
+    """
+    return {
+        "umi_prefix": umi_prefix,
+        "umi_suffix": umi_suffix,
+        "min_umi_base_quality": min_umi_base_quality,
+        "min_umi_mean_quality": min_umi_mean_quality,
+        "quality_weighted": quality_weighted,
+        "flank_mismatches": flank_mismatches,
+        "umi_length": umi_length,
+    }
+
+
+def extract_stage(
+    output_dir,
+    input_fastq,
+    umi_prefix,
+    umi_suffix,
+    threads=1,
+    per_read_table=True,
+    umi_encoding="string",
+    output_format="tsv",
+    min_umi_base_quality=0,
+    min_umi_mean_quality=0,
+    quality_weighted=False,
+    flank_mismatches=0,
+    umi_length=None,
+    ingest="auto",
+    use_cache=True,
+):
+    """Stage 1 - stream the FASTQ file once and count its UMI's.
+
+    With a minimum UMI base or mean quality, reads whose UMI bases fail it are not
+    counted. With quality_weighted, the quality weight of each UMI is kept as well.
+    Reads whose flanks are not found, even with flank_mismatches mismatches, or whose UMI
+    is not umi_length bases long, are skipped and counted as failed reads.
+
+    Threads, UMI encoding, output format and ingest mode don't change the output, so they
+    are not part of the key.
+
+    Args:
+        output_dir (str): Output folder, receives the UMI_in_each_read table if per_read_table
+        input_fastq (file): *.fastq or *.fastq.gz file.
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        threads (int, optional): Number of worker processes. Defaults to 1.
+        per_read_table (bool, optional): Write the UMI of each read. Defaults to True.
+        umi_encoding (str, optional): UMI representation used while counting. Defaults to "string".
+        output_format (str, optional): Format of the per read table, one of table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+        min_umi_base_quality (int, optional): Drop reads with a UMI base below this Phred score. Defaults to 0.
+        min_umi_mean_quality (int, optional): Drop reads with a mean UMI base quality below this Phred score. Defaults to 0.
+        quality_weighted (bool, optional): Keep quality weights of UMI's, see quality_utils. Defaults to False.
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+        ingest (str, optional): How the input is read, one of stream_utils.INGEST_MODES. Defaults to "auto".
+        use_cache (bool, optional): Load cached output if there is one. Defaults to True.
+
+    Returns:
+        StageResult: umis, counts (and weights) columns in order of first occurrence, and the number of filtered_reads, recovered_reads (found with flank mismatches) and failed_reads
+    """
+    read_umi_file = table_utils.table_file_name(
+        output_dir, "UMI_in_each_read", output_format
+    )
+
+    def compute():
+        quality_filter = None
+        if min_umi_base_quality or min_umi_mean_quality or quality_weighted:
+            quality_filter = quality_utils.UmiQualityFilter(
+                min_umi_base_quality, min_umi_mean_quality, quality_weighted
+            )
+        read_outcomes = Counter()
+        started = time.perf_counter()
+        unique_umi_counts = umi_utils.extract_umis(
+            input_fastq,
+            umi_prefix,
+            umi_suffix,
+            read_umi_file=read_umi_file if per_read_table else None,
+            threads=threads,
+            umi_encoding=umi_encoding,
+            output_format=output_format,
+            quality_filter=quality_filter,
+            flank_mismatches=flank_mismatches,
+            umi_length=umi_length,
+            read_outcomes=read_outcomes,
+            ingest=ingest,
+        )
+        seconds = time.perf_counter() - started
+        umis, counts = (
+            zip(*unique_umi_counts.items()) if unique_umi_counts else ((), ())
+        )
+        data = {
+            "umis": umi_array(umis),
+            "counts": np.array(counts, dtype=np.int64),
+            "filtered_reads": np.array(0),
+            "recovered_reads": np.array(read_outcomes["recovered_reads"]),
+            "failed_reads": np.array(read_outcomes["failed_reads"]),
+        }
+        log_extraction_yield(data, seconds)
+        if quality_filter is not None:
+            logging.info(
+                f"{quality_filter.filtered_reads} reads had UMI base qualities below the minimum"
+            )
+            data["filtered_reads"] = np.array(quality_filter.filtered_reads)
+        if quality_weighted:
+            data["weights"] = np.array(
+                [quality_filter.umi_weights[umi] for umi in umis], dtype=np.float64
+            )
+        return data
+
+    return run_stage(
+        output_dir,
+        "extract",
+        [],
+        {
+            "input_fastq": file_identity(input_fastq),
+            **extraction_params(
+                umi_prefix,
+                umi_suffix,
+                min_umi_base_quality,
+                min_umi_mean_quality,
+                quality_weighted,
+                flank_mismatches,
+                umi_length,
+            ),
+        },
+        compute,
+        use_cache,
+        outputs=[read_umi_file] if per_read_table else [],
+        cacheable=not stream_utils.is_stream(input_fastq),
+    )
+
+
+def store_stage(count_store, store, extract_result, input_identity, params):
+    """Stage 1b - save the UMI counts of the extract stage to a count store, or add them to it.
+
+    The counts of every FASTQ file in the store are passed on to the count stage, so UMI's
+    are clustered and reported over all of them. Their cache key is derived from the
+    store's provenance, so later stages are recomputed only when a FASTQ file is added.
+
+    Args:
+        count_store (str): Path of the store, see store_utils
+        store (dict): Store the counts are added to. None to replace the store with them
+        extract_result (StageResult): Output of extract_stage. None if the FASTQ file is already in the store
+        input_identity (list): file_identity of the FASTQ file
+        params (dict): extraction_params the store is counted with
+
+    Returns:
+        StageResult: columns of extract_stage over all FASTQ files of the store, UMI's in store order
+    """
+    if extract_result is not None:
+        data = extract_result.data
+        fastq_store = store_utils.build_store(
+            umi_list(data["umis"]),
+            data["counts"],
+            weights=data.get("weights"),
+            totals={name: int(data[name]) for name in store_utils.TOTAL_COLUMNS},
+            params=params,
+            inputs=[
+                store_utils.input_record(
+                    input_identity, int(data["counts"].sum()), len(data["umis"])
+                )
+            ],
+        )
+        store = (
+            fastq_store
+            if store is None
+            else store_utils.merge_stores(store, fastq_store)
+        )
+        store_utils.save_store(count_store, store)
+
+    provenance = store_utils.store_provenance(store)
+    logging.info(
+        f"Count store {count_store} has {len(provenance['inputs'])} FASTQ files"
+    )
+    umis, counts, weights = store_utils.store_umi_counts(store)
+    data = {"umis": umi_array(umis), "counts": counts}
+    for name in store_utils.TOTAL_COLUMNS:
+        data[name] = store[name]
+    if weights is not None:
+        data["weights"] = weights
+    return StageResult(
+        stage_key("store", [], provenance), data, cached=extract_result is None
+    )
+
+
+def count_stage(output_dir, extract_result, use_cache=True):
+    """Stage 2 - order unique UMI's from the most to the least common.
+
+    Ties keep their order of first occurrence, like Counter.most_common.
+
+    Args:
+        output_dir (str): Output folder
+        extract_result (StageResult): Output of extract_stage or store_stage
+        use_cache (bool, optional): Load cached output if there is one. Defaults to True.
+
+    Returns:
+        StageResult: columns of extract_stage, UMI columns most common first
+    """
+
+    def compute():
+        order = np.argsort(-extract_result.data["counts"], kind="stable")
+        return {
+            name: column[order] if column.ndim else column
+            for name, column in extract_result.data.items()
+        }
+
+    return run_stage(output_dir, "count", [extract_result], {}, compute, use_cache)
+
+
+def distance_stage(
+    output_dir,
+    count_result,
+    distance_output="auto",
+    dense_distance_max_umis=5000,
+    sparse_max_distance=2,
+    use_cache=True,
+):
+    """Stage 3 - pairwise hamming distances, all of them or only the close pairs.
+
+    Args:
+        output_dir (str): Output folder
+        count_result (StageResult): Output of count_stage
+        distance_output (str, optional): "dense", "sparse" or "auto" - sparse above dense_distance_max_umis UMI's. Defaults to "auto".
+        dense_distance_max_umis (int, optional): See distance_output. Defaults to 5000.
+        sparse_max_distance (int, optional): Largest distance of a sparse pair. Defaults to 2.
+        use_cache (bool, optional): Load cached output if there is one. Defaults to True.
+
+    Returns:
+        StageResult: pdist_distance_matrix column for dense output, UMI_1, UMI_2 and Hamming_Distance columns for sparse output
+    """
+    if distance_output == "auto":
+        distance_output = (
+            "dense"
+            if len(count_result.data["umis"]) <= dense_distance_max_umis
+            else "sparse"
+        )
+
+    def compute():
+        unique_umi_counts = umi_counts_of(count_result)
+        if not unique_umi_counts:
+            logging.warning("No UMI's were found, not calculating hamming distances")
+        if distance_output == "dense":
+            pdist_distance_matrix, _ = umi_utils.calculate_pairwise_hamming_distance(
+                unique_umi_counts, squared_matrix=False
+            )
+            return {"pdist_distance_matrix": pdist_distance_matrix}
+
+        edges = umi_utils.calculate_sparse_hamming_distance(
+            unique_umi_counts, max_distance=sparse_max_distance
+        )
+        return {
+            "UMI_1": umi_array(edges.UMI_1),
+            "UMI_2": umi_array(edges.UMI_2),
+            "Hamming_Distance": edges.Hamming_Distance.to_numpy(),
+        }
+
+    params = {"distance_output": distance_output}
+    if distance_output == "sparse":
+        params["sparse_max_distance"] = sparse_max_distance
+    return run_stage(
+        output_dir, "distances", [count_result], params, compute, use_cache
+    )
+
+
+def cluster_stage(output_dir, count_result, collapse_method="groups", use_cache=True):
+    """Stage 4 - collapse UMI's within COLLAPSE_DISTANCE and count error bases.
+
+    UMI's are collapsed by their quality weights instead of counts if the extract stage
+    kept them.
+
+    Args:
+        output_dir (str): Output folder
+        count_result (StageResult): Output of count_stage
+        collapse_method (str, optional): One of cluster_utils.COLLAPSE_METHODS. Defaults to "groups".
+        use_cache (bool, optional): Load cached output if there is one. Defaults to True.
+
+    Returns:
+        StageResult: error_bases, and the clustered UMI columns of cluster_utils.cluster_umis unless collapse_method is "groups"
+    """
+
+    def compute():
+        unique_umi_counts = umi_counts_of(count_result)
+        umi_weights = umi_weights_of(count_result)
+        logging.info(
+            "Finding similar UMI's and calculating incorrectly sequenced bases"
+        )
+        if collapse_method == "groups":
+            similar_umis = umi_utils.find_similar_umis(
+                umis=unique_umi_counts, distance_value=COLLAPSE_DISTANCE
+            )
+            error_umi_bases = umi_utils.collapse_umis_find_error_bases(
+                unique_umi_counts=unique_umi_counts,
+                similar_umis_list_of_lists=similar_umis,
+                umi_weights=umi_weights,
+            )
+            return {"error_bases": np.array(error_umi_bases, dtype=np.int64)}
+
+        umi_clusters = cluster_utils.cluster_umis(
+            unique_umi_counts,
+            distance_value=COLLAPSE_DISTANCE,
+            method=collapse_method,
+            umi_weights=umi_weights,
+        )
+        return {
+            "error_bases": np.array(
+                (umi_clusters.Distance.astype(np.int64) * umi_clusters.Count).sum()
+            ),
+            "UMI": umi_array(umi_clusters.UMI),
+            "Count": umi_clusters.Count.to_numpy(),
+            "Cluster_UMI": umi_array(umi_clusters.Cluster_UMI),
+            "Distance": umi_clusters.Distance.to_numpy(),
+        }
+
+    return run_stage(
+        output_dir,
+        "cluster",
+        [count_result],
+        {"collapse_method": collapse_method, "distance_value": COLLAPSE_DISTANCE},
+        compute,
+        use_cache,
+    )
+
+
+def write_count_outputs(output_dir, count_result, output_format="tsv"):
+    """Write unique UMI counts and the UMI count frequency distribution (table and plot).
+
+    Args:
+        output_dir (str): Output folder
+        count_result (StageResult): Output of count_stage
+        output_format (str, optional): Table format, one of table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+    """
+    unique_umi_counts = umi_counts_of(count_result)
+
+    # Write unique UMI counts to file.
+    umi_utils.write_data_frame_to_file(
+        dataframe=pd.DataFrame(
+            {
+                "UMI_Sequence": list(unique_umi_counts),
+                "Count": count_result.data["counts"],
+            }
+        ),
+        filename=table_utils.table_file_name(
+            output_dir, "Unique_UMI_Sequence_Counts", output_format
+        ),
+        output_format=output_format,
+    )
+
+    logging.info(f"There were {len(unique_umi_counts)} unique UMI's in the FASTQ file")
+
+    # Plot UMI Count Frequency distribution and write dataframe to file
+    umi_count_frequency_table = plotting_utils.create_umi_frequency_distribution_graph(
+        unique_umi_counts,
+        os.path.join(output_dir, "UMI_Count_Frequency_distribution.png"),
+    )
+    umi_utils.write_data_frame_to_file(
+        dataframe=umi_count_frequency_table,
+        filename=table_utils.table_file_name(
+            output_dir, "UMI_Count_Frequency_Table", output_format
+        ),
+        output_format=output_format,
+    )
+
+
+def write_distance_outputs(
+    output_dir, count_result, distance_result, output_format="tsv"
+):
+    """Write the hamming distance table, or the edge list of close UMI pairs.
+
+    Args:
+        output_dir (str): Output folder
+        count_result (StageResult): Output of count_stage
+        distance_result (StageResult): Output of distance_stage
+        output_format (str, optional): Table format, one of table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+    """
+    if not len(count_result.data["umis"]):
+        logging.warning("No UMI's were found, not writing hamming distances")
+        return
+
+    if "pdist_distance_matrix" in distance_result.data:
+        sorted_umis = sorted(umi_list(count_result.data["umis"]))
+        umi_utils.write_data_frame_to_file(
+            dataframe=pd.DataFrame(
+                spatial.distance.squareform(
+                    distance_result.data["pdist_distance_matrix"]
+                ),
+                index=sorted_umis,
+                columns=sorted_umis,
+            ),
+            filename=table_utils.table_file_name(
+                output_dir, "UMI_Hamming_Distance_Table", output_format
+            ),
+            write_index=True,
+            output_format=output_format,
+        )
+        return
+
+    umi_utils.write_data_frame_to_file(
+        dataframe=pd.DataFrame(
+            {
+                "UMI_1": umi_list(distance_result.data["UMI_1"]),
+                "UMI_2": umi_list(distance_result.data["UMI_2"]),
+                "Hamming_Distance": distance_result.data["Hamming_Distance"],
+            }
+        ),
+        filename=table_utils.table_file_name(
+            output_dir, "UMI_Hamming_Distance_Edges", output_format
+        ),
+        output_format=output_format,
+        dictionary_columns=["UMI_1", "UMI_2"],
+    )
+
+
+def write_cluster_outputs(
+    output_dir, count_result, cluster_result, output_format="tsv"
+):
+    """Write cluster sizes, when UMI's were clustered.
+
+    Args:
+        output_dir (str): Output folder
+        count_result (StageResult): Output of count_stage
+        cluster_result (StageResult): Output of cluster_stage
+        output_format (str, optional): Table format, one of table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+    """
+    if "Cluster_UMI" not in cluster_result.data:
+        return
+
+    umi_clusters = pd.DataFrame(
+        {
+            "UMI": umi_list(cluster_result.data["UMI"]),
+            "Count": cluster_result.data["Count"],
+            "Cluster_UMI": umi_list(cluster_result.data["Cluster_UMI"]),
+            "Distance": cluster_result.data["Distance"],
+        }
+    )
+    cluster_sizes = cluster_utils.summarize_clusters(umi_clusters)
+    umi_utils.write_data_frame_to_file(
+        dataframe=cluster_sizes,
+        filename=table_utils.table_file_name(
+            output_dir, "UMI_Cluster_Sizes", output_format
+        ),
+        output_format=output_format,
+    )
+    logging.info(
+        f"{len(umi_clusters)} unique UMI's collapsed into {len(cluster_sizes)} clusters, "
+        f"largest has {cluster_sizes.Unique_UMIs.max()} UMI's"
+    )
+
+
+def report_stage(
+    output_dir,
+    count_result,
+    distance_result,
+    cluster_result,
+    dendrogram_clustering_method="single",
+    dendrogram_max_umis=1000,
+    dendrogram_leaves=100,
+    output_format="tsv",
+    profiler=None,
+):
+    """Stage 5 - write all results, plot the dendrogram and report base calling accuracy.
+
+    Not cached, it only reads the outputs of the other stages.
+
+    Args:
+        output_dir (str): Output folder
+        count_result (StageResult): Output of count_stage
+        distance_result (StageResult): Output of distance_stage
+        cluster_result (StageResult): Output of cluster_stage
+        dendrogram_clustering_method (str, optional): Linkage method of the dendrogram. Defaults to "single".
+        dendrogram_max_umis (int, optional): Number of most common UMI's clustered for the dendrogram. Defaults to 1000.
+        dendrogram_leaves (int, optional): Largest number of leaves drawn. Defaults to 100.
+        output_format (str, optional): Table format, one of table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+        profiler (profile_utils.StageProfiler, optional): Measures writing the outputs and the dendrogram as nested stages. Defaults to None.
+
+    Returns:
+        dict: Reads, Filtered_Reads, Recovered_Reads, Failed_Reads, Unique_UMIs, Error_Bases, Total_UMI_Bases and Accurate_Bases_Percentage of the run, NaN without UMI bases
+    """
+    if profiler is None:
+        profiler = profile_utils.StageProfiler()
+
+    with profiler.stage("write_outputs"):
+        write_count_outputs(output_dir, count_result, output_format)
+        write_distance_outputs(output_dir, count_result, distance_result, output_format)
+        write_cluster_outputs(output_dir, count_result, cluster_result, output_format)
+
+    unique_umi_counts = umi_counts_of(count_result)
+
+    with profiler.stage("dendrogram") as record:
+        # The dendrogram is built from at most dendrogram_max_umis of the most common UMI's
+        if len(unique_umi_counts) < 2:
+            logging.warning(
+                f"{len(unique_umi_counts)} UMI's were found, not plotting the dendrogram"
+            )
+            dendrogram_umi_counts = {}
+        elif len(unique_umi_counts) > dendrogram_max_umis:
+            logging.info(
+                f"Clustering the {dendrogram_max_umis} most common UMI's for the dendrogram"
+            )
+            dendrogram_umi_counts = dict(
+                list(unique_umi_counts.items())[:dendrogram_max_umis]
+            )
+            pdist_distance_matrix, _ = umi_utils.calculate_pairwise_hamming_distance(
+                dendrogram_umi_counts, squared_matrix=False
+            )
+        elif "pdist_distance_matrix" in distance_result.data:
+            dendrogram_umi_counts = unique_umi_counts
+            pdist_distance_matrix = distance_result.data["pdist_distance_matrix"]
+        else:
+            dendrogram_umi_counts = unique_umi_counts
+            pdist_distance_matrix, _ = umi_utils.calculate_pairwise_hamming_distance(
+                dendrogram_umi_counts, squared_matrix=False
+            )
+
+        if dendrogram_umi_counts:
+            # Obtain labels to be used in the dendrogram
+            labels = [
+                f"{umi} ({dendrogram_umi_counts[umi]})"
+                for umi in sorted(dendrogram_umi_counts.keys())
+            ]
+
+            # Plot dendrogram
+            plotting_utils.create_dendrogram(
+                distance_matrix=pdist_distance_matrix,
+                clustering_method=dendrogram_clustering_method,
+                output_file_name=os.path.join(
+                    output_dir, f"UMI_Dendrogram_{dendrogram_clustering_method}.png"
+                ),
+                labels=labels,
+                max_leaves=dendrogram_leaves,
+            )
+        record["items"]["umis"] = len(dendrogram_umi_counts)
+
+    # Find total UMI bases
+    error_umi_bases = int(cluster_result.data["error_bases"])
+    total_umi_bases = umi_utils.calculate_total_umi_bases_sequenced(unique_umi_counts)
+
+    # Calculate and log % of bases called accurately, not a number without UMI bases
+    accurate_base_calling_percentage = float("nan")
+    if total_umi_bases:
+        accurate_base_calling_percentage = (
+            total_umi_bases - error_umi_bases
+        ) / total_umi_bases
+    else:
+        logging.warning("No UMI bases were found, the accuracy can't be calculated")
+
+    logging.info(
+        "Percentage of accurately called bases - (number of correctly called bases / total called bases)*100"
+    )
+    logging.info(
+        f"Percentage of accurately called bases - ({total_umi_bases - error_umi_bases} / {total_umi_bases})*100"
+    )
+    logging.info(
+        f"Percentage of accurately called bases is {accurate_base_calling_percentage*100}%"
+    )
+
+    return {
+        "Reads": int(count_result.data["counts"].sum()),
+        "Filtered_Reads": int(count_result.data["filtered_reads"]),
+        "Recovered_Reads": int(count_result.data["recovered_reads"]),
+        "Failed_Reads": int(count_result.data["failed_reads"]),
+        "Unique_UMIs": len(unique_umi_counts),
+        "Error_Bases": error_umi_bases,
+        "Total_UMI_Bases": total_umi_bases,
+        "Accurate_Bases_Percentage": accurate_base_calling_percentage * 100,
+    }
+
+
+def run_pipeline(
+    input_fastq,
+    umi_prefix,
+    umi_suffix,
+    threads=1,
+    ingest="auto",
+    per_read_table=True,
+    umi_encoding="string",
+    distance_output="auto",
+    dense_distance_max_umis=5000,
+    sparse_max_distance=2,
+    collapse_method="groups",
+    dendrogram_clustering_method="single",
+    dendrogram_max_umis=1000,
+    dendrogram_leaves=100,
+    min_umi_base_quality=0,
+    min_umi_mean_quality=0,
+    quality_weighted=False,
+    flank_mismatches=0,
+    umi_length=None,
+    count_store=None,
+    append=False,
+    output_dir="./data",
+    output_format="tsv",
+    cache=True,
+    profile_report=None,
+    profile_dir=None,
+    trace_memory=False,
+):
+    """Run all stages, extract -> count -> distances, cluster -> report.
+
+    Stages whose inputs and parameters did not change since an earlier run are loaded
+    from the cache in output_dir instead of being recomputed.
+
+    With count_store, the UMI counts are saved to a count store and the later stages run
+    on the counts of the store. With append, they are added to the counts already in the
+    store, and a FASTQ file that is already in it is not read again.
+
+    Each stage is measured by a profile_utils.StageProfiler. With profile_report, its
+    measurements are written there as JSON.
+
+    Args:
+        See the extract, store, count, distance, cluster and report stages. cache turns
+        the use of cached stage outputs on or off. profile_report is the path of the JSON
+        profile report, profile_dir and trace_memory are passed to
+        profile_utils.StageProfiler.
+
+    Returns:
+        tuple: (count_result, report) - output of count_stage and the summary returned by report_stage
+    """
+    # Options of the run, stored in the profile report
+    run_options = dict(locals())
+
+    if append and not count_store:
+        raise ValueError("append needs a count store to add the UMI counts to")
+
+    # Make output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+    profiler = profile_utils.StageProfiler(trace_memory, profile_dir)
+
+    store = None
+    input_identity = file_identity(input_fastq)
+    store_params = extraction_params(
+        umi_prefix,
+        umi_suffix,
+        min_umi_base_quality,
+        min_umi_mean_quality,
+        quality_weighted,
+        flank_mismatches,
+        umi_length,
+    )
+    if append and os.path.isfile(count_store):
+        store = store_utils.load_store(count_store)
+        store_utils.check_params(store, store_params)
+
+    with profiler.stage("extract") as record:
+        if store is not None and store_utils.find_input(store, input_identity):
+            logging.info(
+                f"{input_fastq} is already in count store {count_store}, not reading it again"
+            )
+            extract_result = None
+            record["cached"] = True
+        else:
+            extract_result = extract_stage(
+                output_dir,
+                input_fastq,
+                umi_prefix,
+                umi_suffix,
+                threads=threads,
+                per_read_table=per_read_table,
+                umi_encoding=umi_encoding,
+                output_format=output_format,
+                min_umi_base_quality=min_umi_base_quality,
+                min_umi_mean_quality=min_umi_mean_quality,
+                quality_weighted=quality_weighted,
+                flank_mismatches=flank_mismatches,
+                umi_length=umi_length,
+                ingest=ingest,
+                use_cache=cache,
+            )
+            record["cached"] = extract_result.cached
+            record["items"] = stage_items(extract_result)
+
+    if count_store:
+        with profiler.stage("store") as record:
+            # Later stages run on the counts of all FASTQ files in the store
+            extract_result = store_stage(
+                count_store,
+                store,
+                extract_result,
+                input_identity,
+                store_params,
+            )
+            record["cached"] = extract_result.cached
+            record["items"] = stage_items(extract_result)
+
+    with profiler.stage("count") as record:
+        count_result = count_stage(output_dir, extract_result, use_cache=cache)
+        record["cached"] = count_result.cached
+        record["items"] = stage_items(count_result)
+
+    with profiler.stage("distances") as record:
+        distance_result = distance_stage(
+            output_dir,
+            count_result,
+            distance_output=distance_output,
+            dense_distance_max_umis=dense_distance_max_umis,
+            sparse_max_distance=sparse_max_distance,
+            use_cache=cache,
+        )
+        record["cached"] = distance_result.cached
+        record["items"] = stage_items(count_result, distance_result)
+
+    with profiler.stage("cluster") as record:
+        cluster_result = cluster_stage(
+            output_dir, count_result, collapse_method=collapse_method, use_cache=cache
+        )
+        record["cached"] = cluster_result.cached
+        record["items"] = stage_items(count_result, cluster_result)
+
+    with profiler.stage("report") as record:
+        report = report_stage(
+            output_dir,
+            count_result,
+            distance_result,
+            cluster_result,
+            dendrogram_clustering_method=dendrogram_clustering_method,
+            dendrogram_max_umis=dendrogram_max_umis,
+            dendrogram_leaves=dendrogram_leaves,
+            output_format=output_format,
+            profiler=profiler,
+        )
+        record["items"] = stage_items(count_result)
+
+    if profile_report:
+        profiler.write_report(profile_report, run_options)
+    return count_result, report
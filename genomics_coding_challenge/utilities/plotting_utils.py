@@ -18,30 +18,43 @@ def create_umi_frequency_distribution_graph(unique_umi_counts, output_file_name)
         freq_df: Pandas dataframe, containing UMI count frequency distribution
     """
 
-    logging.info("Plotting UMI Count Frequency distribution")
+    umi_counts_df = pd.DataFrame(
+        {"Frequency": sorted(unique_umi_counts.values())}, dtype=np.int64
+    )
+    if umi_counts_df.empty:
+        logging.warning("No UMI's were found, not plotting UMI Count Frequency")
+        return pd.DataFrame(
+            {"UMI Counts in Library": [], "Frequency": []}, dtype=np.int64
+        )
 
-    umi_counts_df = pd.DataFrame({"Frequency": sorted(unique_umi_counts.values())})
+    logging.info("Plotting UMI Count Frequency distribution")
 
+    # Each plot gets its own figure, closed once saved, so plots of samples run in the
+    # same process (see batch_utils) don't draw on each other
+    fig, ax = plt.subplots()
     try:
         # Plot and Save
         umi_counts_df["Frequency"].value_counts().plot(
             kind="bar",
+            ax=ax,
             ylabel="No. of UMI's with the same count",
             xlabel="UMI Count in the Library",
         )
-        plt.yticks(
+        ax.set_yticks(
             np.arange(
                 min(umi_counts_df["Frequency"].value_counts()),
                 max(umi_counts_df["Frequency"].value_counts()) + 1,
                 1.0,
             )
         )
-        plt.xticks(rotation=30, ha="right")
-        plt.savefig(output_file_name, bbox_inches="tight", dpi=600)
+        plt.setp(ax.get_xticklabels(), rotation=30, ha="right")
+        fig.savefig(output_file_name, bbox_inches="tight", dpi=600)
 
         logging.info(f"UMI Frequency Distribution plot saved to {output_file_name}")
-    except Exception:
-        raise "Failed to plot UMI Count Frequency"
+    except Exception as e:
+        raise ValueError(f"Failed to plot UMI Count Frequency - {e}") from e
+    finally:
+        plt.close(fig)
 
     # Get data as a pandas df
     freq_df = pd.DataFrame(umi_counts_df["Frequency"].value_counts())
@@ -49,7 +62,32 @@ def create_umi_frequency_distribution_graph(unique_umi_counts, output_file_name)
     return freq_df.rename_axis("UMI Counts in Library").reset_index()
 
 
-def create_dendrogram(distance_matrix, clustering_method, output_file_name, labels):
+def compute_linkage(distance_matrix, clustering_method):
+    """Hierarchical/agglomerative clustering of a condensed distance matrix.
+
+    Uses fastcluster when it is installed, it returns the same linkage as scipy faster and
+    with less memory. Falls back to scipy otherwise.
+
+    Args:
+        distance_matrix (pdist distance matrix): condensed distance matrix from pairwise hamming distance calculation
+        clustering_method (str): Clustering method obtained from command line
+
+    Returns:
+        numpy array: Linkage matrix
+    """
+    distance_matrix = np.asarray(distance_matrix, dtype=np.double)
+    try:
+        import fastcluster
+    except ImportError:
+        return cluster.hierarchy.linkage(distance_matrix, method=clustering_method)
+
+    logging.info("Computing linkage with fastcluster")
+    return fastcluster.linkage(distance_matrix, method=clustering_method)
+
+
+def create_dendrogram(
+    distance_matrix, clustering_method, output_file_name, labels, max_leaves=None
+):
     """This function plots dendrogram, given a pdist distance matrix (from pairwise hamming distance calculation).
 
     Args:
@@ -58,22 +96,35 @@ def create_dendrogram(distance_matrix, clustering_method, output_file_name, labe
             See https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.linkage.html#scipy.cluster.hierarchy.linkage
         output_file_name (str): File path to plot dendrogram
         labels (list): labels for dendrogram
+        max_leaves (int, optional): Only draw the last max_leaves merged clusters if there are more UMI's. Defaults to None, draw every UMI.
     """
 
     logging.info("Plotting dendrogram")
 
     # Performs hierarchical/agglomerative clustering
-    linkage = cluster.hierarchy.linkage(distance_matrix, method=clustering_method)
+    linkage = compute_linkage(distance_matrix, clustering_method)
+
+    # Collapse the bottom of large trees, leaves then show the number of UMI's they hold
+    truncate = {}
+    if max_leaves is not None and len(labels) > max_leaves:
+        logging.info(f"Drawing the last {max_leaves} merged clusters of the dendrogram")
+        truncate = {"truncate_mode": "lastp", "p": max_leaves}
 
+    fig, ax = plt.subplots()
     try:
         # Plot and save dendrogram
-        plt.figure()
-        plt.title("Hierarchical Clustering Dendrogram")
-        plt.xlabel(f"Distance (clustering method - {clustering_method})")
+        ax.set_title("Hierarchical Clustering Dendrogram")
+        ax.set_xlabel(f"Distance (clustering method - {clustering_method})")
         cluster.hierarchy.dendrogram(
-            linkage, orientation="left", labels=labels, show_leaf_counts=True
+            linkage,
+            orientation="left",
+            labels=labels,
+            show_leaf_counts=True,
+            ax=ax,
+            **truncate,
         )
-    except Exception:
-        raise "Failed to plot dendrogram"
-    plt.savefig(output_file_name, bbox_inches="tight", dpi=600)
-    return
+        fig.savefig(output_file_name, bbox_inches="tight", dpi=600)
+    except Exception as e:
+        raise ValueError(f"Failed to plot dendrogram - {e}") from e
+    finally:
+        plt.close(fig)
@@ -0,0 +1,184 @@
+import cProfile
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+# Bump when the fields of the profile report change
+PROFILE_REPORT_VERSION = 1
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_BYTES = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss_bytes(who="self"):
+    """Highest resident set size of this process, or of its largest finished child process.
+
+    Args:
+        who (str, optional): "self" or "children". Defaults to "self".
+
+    Returns:
+        int: Peak RSS in bytes, None if it can't be measured on this platform
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(
+        resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN
+    )
+    return usage.ru_maxrss * _MAXRSS_BYTES
+
+
+def children_cpu_seconds():
+    """User and system CPU time of finished child processes, such as extraction workers."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def megabytes(number_of_bytes):
+    """Bytes to MB, rounded for the report. None stays None."""
+    return None if number_of_bytes is None else round(number_of_bytes / 2**20, 3)
+
+
+class StageProfiler:
+    """Measures each pipeline stage, and writes the measurements as a JSON report.
+
+    Each stage run inside stage() gets a record with its wall time, CPU time of this
+    process and of the worker processes that finished during it, the peak RSS of the
+    process so far (a high-water mark, so the stage that raised it is the one where it
+    jumps), and item counts added by the caller. With trace_memory the peak of memory
+    allocated by Python during the stage is traced as well, which slows stages down. With
+    profile_dir each stage is run under cProfile and its stats are dumped to
+    profile_dir/<stage>.prof, to be read with pstats or snakeviz.
+
+    Stages can be nested, nested stages are timed but not traced or profiled on their own,
+    their parent already is.
+    """
+
+    def __init__(self, trace_memory=False, profile_dir=None):
+        """Set what is measured besides time and RSS.
+
+        Args:
+            trace_memory (bool, optional): Trace peak Python memory of each stage with tracemalloc. Defaults to False.
+            profile_dir (str, optional): Folder to dump cProfile stats of each stage to. Defaults to None.
+        """
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.records = []
+        self.started = datetime.now(timezone.utc)
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.process_time()
+        self._children_cpu_start = children_cpu_seconds()
+        self._open_stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code run inside the with block as one stage.
+
+        Args:
+            name (str): Stage name
+
+        Yields:
+            dict: Record of the stage. Add item counts to its "items" dictionary, and set "cached" if it was loaded from the cache
+        """
+        nested = bool(self._open_stages)
+        record = {
+            "stage": name,
+            "parent": self._open_stages[-1]["stage"] if nested else None,
+            "cached": False,
+            "items": {},
+        }
+        self._open_stages.append(record)
+
+        trace_memory = self.trace_memory and not nested
+        profiler = cProfile.Profile() if self.profile_dir and not nested else None
+        if trace_memory:
+            tracemalloc.start()
+        children_cpu_start = children_cpu_seconds()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record["wall_seconds"] = round(time.perf_counter() - wall_start, 6)
+            record["cpu_seconds"] = round(time.process_time() - cpu_start, 6)
+            record["children_cpu_seconds"] = round(
+                children_cpu_seconds() - children_cpu_start, 6
+            )
+            record["peak_rss_mb"] = megabytes(peak_rss_bytes())
+            record["tracemalloc_peak_mb"] = None
+            if trace_memory:
+                record["tracemalloc_peak_mb"] = megabytes(
+                    tracemalloc.get_traced_memory()[1]
+                )
+                tracemalloc.stop()
+            record["profile"] = None
+            if profiler is not None:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                record["profile"] = os.path.join(
+                    self.profile_dir, f"{name.replace('/', '_')}.prof"
+                )
+                profiler.dump_stats(record["profile"])
+
+            self._open_stages.pop()
+            self.records.append(record)
+            logging.info(
+                f"{name} stage took {record['wall_seconds']:.3f}s wall, "
+                f"{record['cpu_seconds'] + record['children_cpu_seconds']:.3f}s CPU"
+            )
+
+    def report(self, options=None):
+        """Measurements of all stages run so far.
+
+        Args:
+            options (dict, optional): Options of the run, stored with the report. Defaults to None.
+
+        Returns:
+            dict: Report with the run's metadata, totals and a record per stage in the order they finished
+        """
+        return {
+            "version": PROFILE_REPORT_VERSION,
+            "started": self.started.isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "argv": sys.argv,
+            "options": options or {},
+            "total": {
+                "wall_seconds": round(time.perf_counter() - self._wall_start, 6),
+                "cpu_seconds": round(time.process_time() - self._cpu_start, 6),
+                "children_cpu_seconds": round(
+                    children_cpu_seconds() - self._children_cpu_start, 6
+                ),
+                "peak_rss_mb": megabytes(peak_rss_bytes()),
+                "children_peak_rss_mb": megabytes(peak_rss_bytes("children")),
+            },
+            "stages": self.records,
+        }
+
+    def write_report(self, filename, options=None):
+        """Write the report as JSON.
+
+        Args:
+            filename (str): Path of the JSON report
+            options (dict, optional): Options of the run, stored with the report. Defaults to None.
+        """
+        logging.info(f"Writing profile report to {filename}")
+        with open(filename, "w") as report_fh:
+            json.dump(self.report(options), report_fh, indent=2, default=str)
+            report_fh.write("\n")
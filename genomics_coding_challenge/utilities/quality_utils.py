@@ -0,0 +1,148 @@
+from collections import Counter
+from itertools import compress
+
+import numpy as np
+
+# Offset of Phred+33 (Sanger / Illumina 1.8+) quality characters
+PHRED_OFFSET = 33
+
+# Number of UMI's whose qualities are decoded in one go
+QUALITY_BATCH_SIZE = 1 << 16
+
+# log(1 - error probability) of each Phred score, error probability is 10^(-Q/10)
+_LOG_CORRECT_PROBABILITY = np.log1p(-np.minimum(10 ** (-np.arange(256) / 10), 0.75))
+
+
+def decode_qualities(quality_strings):
+    """Decode Phred+33 quality strings into one flat uint8 array, in one numpy call.
+
+    Args:
+        quality_strings (list): Quality strings
+
+    Returns:
+        tuple: (qualities, starts, lengths) - Phred scores of all strings, and the start and length of each string in them
+    """
+    lengths = np.fromiter(
+        map(len, quality_strings), dtype=np.int64, count=len(quality_strings)
+    )
+    starts = np.zeros(len(quality_strings), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    qualities = np.frombuffer(
+        "".join(quality_strings).encode("ascii", "replace"), dtype=np.uint8
+    ) - np.uint8(PHRED_OFFSET)
+    return qualities, starts, lengths
+
+
+def summarize_umi_qualities(quality_strings):
+    """Lowest and mean base quality, and the probability of no base call error, of each UMI.
+
+    Args:
+        quality_strings (list): Quality strings of the UMI bases of each read
+
+    Returns:
+        tuple: (min_qualities, mean_qualities, correct_probabilities) numpy arrays. UMI's without bases pass any threshold and have no errors.
+    """
+    qualities, starts, lengths = decode_qualities(quality_strings)
+    if len(lengths) and (lengths == lengths[0]).all() and lengths[0] > 0:
+        # All UMI's have the same length, reduce the rows of a matrix
+        qualities = qualities.reshape(len(lengths), lengths[0])
+        return (
+            qualities.min(axis=1),
+            qualities.mean(axis=1),
+            np.exp(_LOG_CORRECT_PROBABILITY[qualities].sum(axis=1)),
+        )
+
+    # A trailing sentinel keeps the starts of empty UMI's at the end valid for reduceat,
+    # it is the identity of each reduction so the last UMI is not changed by it
+    empty = lengths == 0
+    min_qualities = np.minimum.reduceat(np.append(qualities, np.uint8(255)), starts)
+    min_qualities[empty] = 255
+    quality_sums = np.add.reduceat(np.append(qualities.astype(np.int64), 0), starts)
+    log_correct_sums = np.add.reduceat(
+        np.append(_LOG_CORRECT_PROBABILITY[qualities], 0.0), starts
+    )
+    log_correct_sums[empty] = 0
+    mean_qualities = quality_sums / np.maximum(lengths, 1)
+    mean_qualities[empty] = 255
+    return min_qualities, mean_qualities, np.exp(log_correct_sums)
+
+
+class UmiQualityFilter:
+    """Filters UMI's by base quality and adds up quality weights, batch by batch.
+
+    UMI's are passed to add with the qualities of their bases, and buffered until flush
+    decodes them with numpy, QUALITY_BATCH_SIZE at a time. UMI's that pass are counted
+    in the UMI counter given to flush, in read order. With weighted, each UMI also gets the sum of
+    the probabilities that all its bases were called right, over its reads, which can
+    replace read counts when UMI's are collapsed.
+    """
+
+    def __init__(self, min_base_quality=0, min_mean_quality=0, weighted=False):
+        """Set the quality thresholds.
+
+        Args:
+            min_base_quality (int, optional): Drop UMI's with a base below this Phred score. Defaults to 0.
+            min_mean_quality (int, optional): Drop UMI's with a mean base quality below this Phred score. Defaults to 0.
+            weighted (bool, optional): Add up quality weights of UMI's. Defaults to False.
+        """
+        self.min_base_quality = min_base_quality
+        self.min_mean_quality = min_mean_quality
+        self.weighted = weighted
+        self.filtered_reads = 0
+        self.umi_weights = Counter()
+        self._umis = []
+        self._qualities = []
+
+    def add(self, umi, quality):
+        """Queue a UMI and the qualities of its bases.
+
+        Args:
+            umi (str): UMI sequence
+            quality (str): Phred+33 qualities of the UMI bases
+
+        Returns:
+            bool: True once QUALITY_BATCH_SIZE UMI's are queued, time to flush
+        """
+        self._umis.append(umi)
+        self._qualities.append(quality)
+        return len(self._umis) >= QUALITY_BATCH_SIZE
+
+    def flush(self, unique_umi_counts):
+        """Filter the queued UMI's and count those that pass.
+
+        Args:
+            unique_umi_counts (Counter or EncodedUmiCounts): Counter of UMI's that passed
+        """
+        umis, self._umis = self._umis, []
+        quality_strings, self._qualities = self._qualities, []
+        if not umis:
+            return
+
+        min_qualities, mean_qualities, correct_probabilities = summarize_umi_qualities(
+            quality_strings
+        )
+        passed = (min_qualities >= self.min_base_quality) & (
+            mean_qualities >= self.min_mean_quality
+        )
+        self.filtered_reads += len(umis) - int(passed.sum())
+
+        passed_umis = list(compress(umis, passed.tolist()))
+        if isinstance(unique_umi_counts, Counter):
+            unique_umi_counts.update(passed_umis)
+        else:
+            for umi in passed_umis:
+                unique_umi_counts.add(umi)
+
+        if self.weighted:
+            umi_weights = self.umi_weights
+            for umi, weight in zip(passed_umis, correct_probabilities[passed].tolist()):
+                umi_weights[umi] += weight
+
+    def update(self, other):
+        """Add the filtered reads and weights of another filter, like Counter.update.
+
+        Args:
+            other (UmiQualityFilter): Filter of another part of the reads
+        """
+        self.filtered_reads += other.filtered_reads
+        self.umi_weights.update(other.umi_weights)
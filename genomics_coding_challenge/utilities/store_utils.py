@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+from datetime import datetime, timezone
+
+import numpy as np
+
+from utilities import umi_codes
+
+# Bump when the arrays of the count store change, older stores are not read
+STORE_VERSION = 1
+
+# Longest UMI stored as a 2-bit code, longer UMI's are stored as strings
+MAX_CODED_UMI_LENGTH = 31
+
+# Read totals of the FASTQ files in a store, summed when stores are merged
+TOTAL_COLUMNS = ["filtered_reads", "recovered_reads", "failed_reads"]
+
+
+def _sum_duplicates(keys, columns):
+    """Sort rows by their keys, and sum the columns of rows with the same keys.
+
+    Args:
+        keys (list): Key arrays of the same length, the first one sorts first
+        columns (dict): Arrays of the same length as the keys
+
+    Returns:
+        tuple: (keys, columns) - sorted unique keys and the summed columns of each
+    """
+    if not len(keys[0]):
+        return keys, columns
+
+    order = np.lexsort(keys[::-1])
+    keys = [key[order] for key in keys]
+    group_starts = np.zeros(len(order), dtype=bool)
+    group_starts[0] = True
+    for key in keys:
+        group_starts[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(group_starts)
+    return [key[starts] for key in keys], {
+        name: np.add.reduceat(column[order], starts) for name, column in columns.items()
+    }
+
+
+def _collapse(store, value_columns):
+    """Sort the UMI's of a store and sum the columns of repeated UMI's, in place.
+
+    Args:
+        store (dict): Arrays of a count store, UMI's in any order and possibly repeated
+        value_columns (list): Names of the columns summed, counts and maybe weights
+
+    Returns:
+        dict: The store
+    """
+    (store["umi_lengths"], store["codes"]), coded_columns = _sum_duplicates(
+        [store["umi_lengths"], store["codes"]],
+        {name: store[name] for name in value_columns},
+    )
+    (store["other_umis"],), other_columns = _sum_duplicates(
+        [store["other_umis"]],
+        {name: store[f"other_{name}"] for name in value_columns},
+    )
+    for name in value_columns:
+        store[name] = coded_columns[name]
+        store[f"other_{name}"] = other_columns[name]
+    return store
+
+
+def build_store(umis, counts, weights=None, totals=None, params=None, inputs=()):
+    """Build a count store from UMI counts.
+
+    A store keeps UMI's of A, C, G and T bases as their length and 2-bit code, and other
+    UMI's as strings, each sorted with their counts (and quality weights). Sorted unique
+    keys make stores mergeable by summing the counts of equal keys, without the FASTQ
+    files. The provenance records the extraction parameters and every FASTQ file counted.
+
+    Args:
+        umis (list): Unique UMI sequences
+        counts (list): Count of each UMI
+        weights (list, optional): Quality weight of each UMI. Defaults to None, unweighted.
+        totals (dict, optional): Read totals of TOTAL_COLUMNS. Defaults to None, no reads.
+        params (dict, optional): Extraction parameters the UMI's were counted with. Defaults to None.
+        inputs (list, optional): Provenance of each FASTQ file counted, see input_record. Defaults to ().
+
+    Returns:
+        dict: Numpy arrays of the store
+    """
+    umis = list(umis)
+    umi_lengths = np.array([len(umi) for umi in umis], dtype=np.int64)
+    coded = np.zeros(len(umis), dtype=bool)
+    codes = np.full(len(umis), -1, dtype=np.int64)
+    for umi_length in np.unique(umi_lengths).tolist():
+        if not 0 < umi_length <= MAX_CODED_UMI_LENGTH:
+            continue
+        rows = np.flatnonzero(umi_lengths == umi_length)
+        codes[rows] = umi_codes.encode_umis([umis[row] for row in rows], umi_length)
+        coded[rows] = codes[rows] != -1
+
+    columns = {"counts": np.asarray(counts, dtype=np.int64)}
+    if weights is not None:
+        columns["weights"] = np.asarray(weights, dtype=np.float64)
+
+    store = {
+        "version": np.array(STORE_VERSION),
+        "umi_lengths": umi_lengths[coded].astype(np.uint8),
+        "codes": codes[coded],
+        "other_umis": np.array(
+            [umi.encode("ascii") for umi, is_coded in zip(umis, coded) if not is_coded],
+            dtype=bytes,
+        ),
+        "provenance": np.array(
+            json.dumps({"params": params or {}, "inputs": list(inputs)})
+        ),
+    }
+    for name, column in columns.items():
+        store[name] = column[coded]
+        store[f"other_{name}"] = column[~coded]
+    for name in TOTAL_COLUMNS:
+        store[name] = np.array((totals or {}).get(name, 0), dtype=np.int64)
+    return _collapse(store, list(columns))
+
+
+def input_record(identity, reads, unique_umis):
+    """Provenance of one FASTQ file counted into a store.
+
+    Args:
+        identity (list): pipeline_utils.file_identity of the FASTQ file
+        reads (int): Reads with a UMI counted
+        unique_umis (int): Unique UMI's found
+
+    Returns:
+        dict: input_fastq identity, reads, unique_umis and the UTC time it was added
+    """
+    return {
+        "input_fastq": identity,
+        "reads": reads,
+        "unique_umis": unique_umis,
+        "added": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def store_provenance(store):
+    """Extraction parameters and FASTQ files of a store.
+
+    Returns:
+        dict: params and inputs, see build_store
+    """
+    return json.loads(store["provenance"].item())
+
+
+def store_umi_counts(store):
+    """UMI's of a store with their counts, in store order.
+
+    Coded UMI's come first, by length and then alphabetically, followed by the other
+    UMI's sorted as strings.
+
+    Returns:
+        tuple: (umis, counts, weights) - list of UMI's, their counts and quality weights, None if the store has none
+    """
+    umis = []
+    umi_lengths = store["umi_lengths"].astype(np.int64)
+    boundaries = np.flatnonzero(np.diff(umi_lengths)) + 1
+    for start, end in zip(
+        np.r_[0, boundaries].tolist(), np.r_[boundaries, len(umi_lengths)].tolist()
+    ):
+        if start < end:
+            umis.extend(
+                umi_codes.decode_umis(store["codes"][start:end], umi_lengths[start])
+            )
+    umis.extend(umi.decode("ascii") for umi in store["other_umis"].tolist())
+
+    counts = np.concatenate([store["counts"], store["other_counts"]])
+    weights = None
+    if "weights" in store:
+        weights = np.concatenate([store["weights"], store["other_weights"]])
+    return umis, counts, weights
+
+
+def find_input(store, identity):
+    """Check whether a FASTQ file was already counted into a store.
+
+    Args:
+        store (dict): Count store
+        identity (list): pipeline_utils.file_identity of the FASTQ file
+
+    Returns:
+        bool: True if the same file, by path, size and modification time, is in the store
+    """
+    for record in store_provenance(store)["inputs"]:
+        path, size, modified = record["input_fastq"]
+        if path != identity[0] or size is None:
+            continue
+        if [size, modified] == identity[1:]:
+            return True
+        raise ValueError(
+            f"{path} changed since it was added to the count store, "
+            "rebuild the store without --append"
+        )
+    return False
+
+
+def check_params(store, params):
+    """Check that a store was counted with the given extraction parameters.
+
+    Counts extracted with other flanks, quality thresholds or flank mismatches can't be
+    added up.
+
+    Args:
+        store (dict): Count store
+        params (dict): Extraction parameters
+    """
+    store_params = store_provenance(store)["params"]
+    if store_params != params:
+        raise ValueError(
+            f"The count store was counted with extraction parameters {store_params}, "
+            f"not {params}"
+        )
+
+
+def merge_stores(*stores):
+    """Merge count stores, summing the counts of their UMI's and their read totals.
+
+    Args:
+        stores (dict): Count stores counted with the same extraction parameters, from different FASTQ files
+
+    Returns:
+        dict: Merged count store
+    """
+    params = store_provenance(stores[0])["params"]
+    inputs = []
+    for store in stores:
+        check_params(store, params)
+        for record in store_provenance(store)["inputs"]:
+            path, size, _ = record["input_fastq"]
+            if size is not None and path in [
+                other["input_fastq"][0] for other in inputs
+            ]:
+                raise ValueError(f"{path} is in more than one count store")
+            inputs.append(record)
+
+    value_columns = ["counts", "weights"] if "weights" in stores[0] else ["counts"]
+    merged = {
+        "version": np.array(STORE_VERSION),
+        "provenance": np.array(json.dumps({"params": params, "inputs": inputs})),
+    }
+    for name in ["umi_lengths", "codes", "other_umis"] + [
+        f"{prefix}{name}" for prefix in ["", "other_"] for name in value_columns
+    ]:
+        merged[name] = np.concatenate([store[name] for store in stores])
+    for name in TOTAL_COLUMNS:
+        merged[name] = np.array(sum(int(store[name]) for store in stores))
+    return _collapse(merged, value_columns)
+
+
+def save_store(filename, store):
+    """Write a count store as a compressed .npz file.
+
+    Args:
+        filename (str): Path of the store
+        store (dict): Count store
+    """
+    logging.info(
+        f"Saving {len(store_provenance(store)['inputs'])} FASTQ files, "
+        f"{len(store['codes']) + len(store['other_umis'])} unique UMI's to count store {filename}"
+    )
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    # Written under a temporary name first, an interrupted run keeps the old store
+    partial_file = f"{filename}.partial.npz"
+    np.savez_compressed(partial_file, **store)
+    os.replace(partial_file, filename)
+
+
+def load_store(filename):
+    """Read a count store written by save_store.
+
+    Args:
+        filename (str): Path of the store
+
+    Returns:
+        dict: Count store
+    """
+    with np.load(filename) as stored:
+        store = {name: stored[name] for name in stored.files}
+    if int(store.get("version", -1)) != STORE_VERSION:
+        raise ValueError(
+            f"{filename} is not a version {STORE_VERSION} count store, rebuild it"
+        )
+    return store
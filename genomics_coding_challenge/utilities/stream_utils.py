@@ -0,0 +1,277 @@
+import logging
+import os
+import queue
+import stat
+import sys
+import threading
+
+from utilities import fastq_utils
+
+# How FASTQ input is read. pyfastx - by path, plain files are sharded by byte range.
+# stream - read once front to back on a reader thread. auto - stream stdin, named pipes
+# and gzipped files read with more than one thread, which are streamed in any mode
+INGEST_MODES = ["auto", "pyfastx", "stream"]
+
+# Bytes read from the input at a time
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Decompressed chunks buffered between the reader thread and extraction
+STREAM_QUEUE_SIZE = 16
+
+# Record batches in flight per extraction worker process
+BATCHES_PER_WORKER = 2
+
+# How often a blocked reader thread checks whether the stream was closed, in seconds
+_PUT_TIMEOUT = 0.1
+
+# How long close waits for the reader thread, it may be blocked reading a pipe
+_JOIN_TIMEOUT = 1
+
+_END_OF_STREAM = object()
+
+
+def is_stream(input_fastq):
+    """Check if the input can only be read once, front to back: stdin ("-") or a named pipe.
+
+    Args:
+        input_fastq (str): Path, or "-" for stdin
+
+    Returns:
+        bool: True unless input_fastq is a regular file
+    """
+    return input_fastq == "-" or not stat.S_ISREG(os.stat(input_fastq).st_mode)
+
+
+def use_stream(input_fastq, ingest="auto", threads=1):
+    """Decide whether a FASTQ input is read with the streaming reader.
+
+    In auto mode, plain files are left to pyfastx, they can be split into byte ranges
+    read in parallel. So are gzipped files read by one thread, pyfastx parses them
+    fastest on a single core. Gzipped files read by more threads are always streamed, they
+    can't be split into byte ranges, and are decompressed once on the reader thread.
+
+    Args:
+        input_fastq (str): Path, or "-" for stdin
+        ingest (str, optional): One of INGEST_MODES. Defaults to "auto".
+        threads (int, optional): Number of extraction processes. Defaults to 1.
+
+    Returns:
+        bool: True to stream the input
+    """
+    if is_stream(input_fastq):
+        return True
+    if threads > 1 and fastq_utils.is_gzipped(input_fastq):
+        return True
+    return ingest == "stream"
+
+
+def import_zlib_backend():
+    """Import the fastest installed zlib compatible module, for gzip decompression.
+
+    python-isal and zlib-ng decompress gzip about twice as fast as zlib, and are used if
+    installed.
+
+    Returns:
+        module: isal.isal_zlib, zlib_ng.zlib_ng or zlib
+    """
+    try:
+        from isal import isal_zlib
+
+        return isal_zlib
+    except ImportError:
+        pass
+    try:
+        from zlib_ng import zlib_ng
+
+        return zlib_ng
+    except ImportError:
+        import zlib
+
+        return zlib
+
+
+def iter_decompressed_chunks(fastq_fh, chunk_size=STREAM_CHUNK_SIZE):
+    """Read a file front to back, decompressing it if it is gzipped.
+
+    Gzip is detected from the first bytes read, so the file doesn't need to be
+    seekable. Concatenated gzip members (including BGZF blocks) are all decompressed.
+
+    Args:
+        fastq_fh (file object): File opened in binary mode
+        chunk_size (int, optional): Bytes read at a time. Defaults to STREAM_CHUNK_SIZE.
+
+    Yields:
+        bytes: Chunks of the decompressed file
+    """
+    chunk = fastq_fh.read(chunk_size)
+    if not chunk.startswith(b"\x1f\x8b"):
+        while chunk:
+            yield chunk
+            chunk = fastq_fh.read(chunk_size)
+        return
+
+    zlib_backend = import_zlib_backend()
+    logging.info(f"Decompressing gzip input with {zlib_backend.__name__}")
+    # wbits 31 - a gzip header and trailer
+    decompressor = zlib_backend.decompressobj(31)
+    while chunk:
+        decompressed = decompressor.decompress(chunk)
+        if decompressed:
+            yield decompressed
+        if decompressor.eof:
+            # Start of the next gzip member
+            chunk = decompressor.unused_data
+            decompressor = zlib_backend.decompressobj(31)
+            if not chunk:
+                chunk = fastq_fh.read(chunk_size)
+        else:
+            chunk = fastq_fh.read(chunk_size)
+    remaining = decompressor.flush()
+    if remaining:
+        yield remaining
+
+
+class ChunkReader:
+    """Reads and decompresses a FASTQ input on a separate thread.
+
+    The reader thread puts decompressed chunks in a queue of at most STREAM_QUEUE_SIZE
+    chunks, which the consuming thread iterates over. zlib releases the GIL while it
+    decompresses, so decompression runs alongside extraction. The queue is bounded, so a
+    fast reader waits for extraction instead of buffering the whole input.
+    """
+
+    def __init__(self, input_fastq, chunk_size=STREAM_CHUNK_SIZE):
+        """Open the input and start the reader thread.
+
+        Args:
+            input_fastq (str): Path of a file or named pipe, or "-" for stdin
+            chunk_size (int, optional): Bytes read at a time. Defaults to STREAM_CHUNK_SIZE.
+        """
+        self.input_fastq = input_fastq
+        self.chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self._closed = threading.Event()
+        self._thread = threading.Thread(
+            target=self._read, name="fastq-reader", daemon=True
+        )
+        self._thread.start()
+
+    def _read(self):
+        try:
+            if self.input_fastq == "-":
+                fastq_fh = os.fdopen(os.dup(sys.stdin.fileno()), "rb")
+            else:
+                fastq_fh = open(self.input_fastq, "rb")
+            with fastq_fh:
+                for chunk in iter_decompressed_chunks(fastq_fh, self.chunk_size):
+                    if not self._put(chunk):
+                        return
+            self._put(_END_OF_STREAM)
+        except Exception as error:
+            # Raised again in the consuming thread
+            self._put(error)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is _END_OF_STREAM:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        """Stop the reader thread, if the input was not read to the end."""
+        self._closed.set()
+        self._thread.join(_JOIN_TIMEOUT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_record_blocks(input_fastq, chunk_size=STREAM_CHUNK_SIZE):
+    """Read a FASTQ input as blocks of whole 4 line records, decompressed on a reader thread.
+
+    Args:
+        input_fastq (str): Path of a file or named pipe, or "-" for stdin
+        chunk_size (int, optional): Bytes read at a time. Defaults to STREAM_CHUNK_SIZE.
+
+    Yields:
+        str: Text of consecutive records, ending with a newline
+    """
+    with ChunkReader(input_fastq, chunk_size) as chunk_reader:
+        # Chunks after the last cut, and their number of newlines
+        rest, rest_lines = [], 0
+        for chunk in chunk_reader:
+            chunk_lines = chunk.count(b"\n")
+            # Cut after the last line of the last whole record, going back from the
+            # last newline over the lines of the unfinished record. If the chunk has
+            # fewer newlines than that, the cut is in rest, and the chunk is kept whole
+            block_end = chunk.rfind(b"\n")
+            for _ in range((rest_lines + chunk_lines) % 4):
+                if block_end == -1:
+                    break
+                block_end = chunk.rfind(b"\n", 0, block_end)
+            if block_end == -1:
+                rest.append(chunk)
+                rest_lines += chunk_lines
+                continue
+            rest.append(memoryview(chunk)[: block_end + 1])
+            yield b"".join(rest).decode("latin-1")
+            rest = [chunk[block_end + 1 :]]
+            rest_lines = rest[0].count(b"\n")
+        rest = b"".join(rest)
+        if rest.strip():
+            if rest.count(b"\n") < 3:
+                raise ValueError(f"{input_fastq} ends with an incomplete FASTQ record")
+            yield rest.decode("latin-1") + ("" if rest.endswith(b"\n") else "\n")
+
+
+def parse_record_block(block):
+    """Split a block of 4 line FASTQ records into records.
+
+    Args:
+        block (str): Text of whole records, from iter_record_blocks
+
+    Returns:
+        list: (read name, sequence, quality) tuples, read names end at the first whitespace like pyfastx
+    """
+    lines = block.split("\n")
+    if not lines[0].startswith("@"):
+        raise ValueError(f"FASTQ record header expected, found {lines[0][:50]}")
+    headers, sequences, qualities = lines[0:-1:4], lines[1:-1:4], lines[3:-1:4]
+    if "\r" in block:
+        sequences = [sequence.rstrip("\r") for sequence in sequences]
+        qualities = [quality.rstrip("\r") for quality in qualities]
+    return list(
+        zip(
+            [header[1:].split(None, 1)[0] for header in headers],
+            sequences,
+            qualities,
+        )
+    )
+
+
+def iter_stream_records(input_fastq):
+    """Iterate over the records of a FASTQ input read by the streaming reader.
+
+    Args:
+        input_fastq (str): Path of a file or named pipe, or "-" for stdin
+
+    Yields:
+        tuple: (read name, sequence, quality)
+    """
+    for block in iter_record_blocks(input_fastq):
+        yield from parse_record_block(block)
@@ -0,0 +1,202 @@
+import gzip
+import logging
+
+import numpy as np
+
+from utilities import quality_utils, table_utils, umi_codes, umi_utils
+
+# Reads generated and written in one go
+SYNTHETIC_BATCH_SIZE = 1 << 16
+
+# Phred quality of correctly called bases, substituted UMI bases get a random quality below it
+SYNTHETIC_QUALITY = 40
+
+# Columns of the ground truth table
+TRUTH_COLUMNS = ["ReadName", "True_UMI", "UMI", "Errors", "Flank_Errors"]
+
+_BASE_BYTES = np.frombuffer(umi_codes.BASES.encode("ascii"), dtype=np.uint8)
+
+
+def random_bases(rng, shape):
+    """Random A, C, G and T bases, as a uint8 array of base indexes."""
+    return rng.integers(0, 4, size=shape, dtype=np.uint8)
+
+
+def generate_fastq(
+    output_fastq,
+    truth_file=None,
+    number_of_reads=100_000,
+    unique_umis=1000,
+    error_rate=0.001,
+    flank_error_rate=0.0,
+    umi_prefix="CTCGACAA",
+    umi_suffix="AAGGGGAG",
+    umi_length=10,
+    read_length=150,
+    gzipped=False,
+    seed=0,
+):
+    """Write a FASTQ file of synthetic reads carrying a prefix-UMI-suffix construct.
+
+    unique_umis true UMI's are drawn at random, and each read gets one of them, with
+    log-normal abundances. Each UMI base is substituted with probability error_rate by
+    another base, with a low quality. The construct sits in the middle of the read,
+    between random bases; flanks that would make extraction find another prefix or
+    suffix are drawn again, so the UMI extracted from each read is the observed one.
+    Prefix and suffix bases are then substituted with probability flank_error_rate.
+
+    Args:
+        output_fastq (str): FASTQ file to write
+        truth_file (str, optional): Tab separated table of the true and observed UMI of each read. Defaults to None.
+        number_of_reads (int, optional): Number of reads. Defaults to 100_000.
+        unique_umis (int, optional): Number of true UMI's. Defaults to 1000.
+        error_rate (float, optional): Substitution probability of each UMI base. Defaults to 0.001.
+        flank_error_rate (float, optional): Substitution probability of each prefix and suffix base. Defaults to 0.0.
+        umi_prefix (str, optional): UMI prefix. Defaults to "CTCGACAA".
+        umi_suffix (str, optional): UMI suffix. Defaults to "AAGGGGAG".
+        umi_length (int, optional): UMI length, at most 31. Defaults to 10.
+        read_length (int, optional): Read length, at least the construct length. Defaults to 150.
+        gzipped (bool, optional): gzip the FASTQ file. Defaults to False.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        dict: Reads, Unique_UMIs, Error_Bases, Total_UMI_Bases and Accurate_Bases_Percentage of the true UMI's, and the number of Flank_Error_Reads with substituted flank bases
+    """
+    construct_length = len(umi_prefix) + umi_length + len(umi_suffix)
+    if read_length < construct_length:
+        raise ValueError(
+            f"Reads of {read_length} bases can't hold a {construct_length} base construct"
+        )
+    if unique_umis > 4**umi_length:
+        raise ValueError(f"There are only {4**umi_length} UMI's of {umi_length} bases")
+
+    rng = np.random.default_rng(seed)
+    true_umis = _BASE_BYTES[
+        (
+            rng.choice(4**umi_length, size=unique_umis, replace=False)[:, None]
+            >> np.arange(2 * (umi_length - 1), -1, -2)
+        )
+        & 3
+    ]
+    abundances = rng.lognormal(0, 1, size=unique_umis)
+    abundances /= abundances.sum()
+
+    left_length = (read_length - construct_length) // 2
+    right_length = read_length - construct_length - left_length
+    prefix_bytes = np.frombuffer(umi_prefix.upper().encode("ascii"), dtype=np.uint8)
+    suffix_bytes = np.frombuffer(umi_suffix.upper().encode("ascii"), dtype=np.uint8)
+    umi_span = (
+        left_length + len(prefix_bytes),
+        left_length + construct_length - len(suffix_bytes),
+    )
+    find_umi_span = umi_utils.compile_flank_matcher(
+        umi_prefix, umi_suffix, return_span=True
+    )
+
+    logging.info(
+        f"Writing {number_of_reads} synthetic reads with {unique_umis} true UMI's to {output_fastq}"
+    )
+    fastq_fh = (
+        gzip.open(output_fastq, "wt", compresslevel=3)
+        if gzipped
+        else open(output_fastq, "w")
+    )
+    truth_writer = (
+        table_utils.TableWriter(truth_file, TRUTH_COLUMNS) if truth_file else None
+    )
+    error_bases = flank_error_reads = 0
+    try:
+        for batch_start in range(0, number_of_reads, SYNTHETIC_BATCH_SIZE):
+            batch_size = min(SYNTHETIC_BATCH_SIZE, number_of_reads - batch_start)
+            true_umi_bytes = true_umis[
+                rng.choice(unique_umis, size=batch_size, p=abundances)
+            ]
+
+            # Substitute UMI bases by one of the 3 other bases
+            errors = rng.random(true_umi_bytes.shape) < error_rate
+            umi_bases = np.searchsorted(_BASE_BYTES, true_umi_bytes)
+            umi_bases[errors] = (
+                umi_bases[errors] + rng.integers(1, 4, size=int(errors.sum()))
+            ) % 4
+            umi_bytes = _BASE_BYTES[umi_bases]
+            error_bases += int(errors.sum())
+
+            reads = np.hstack(
+                [
+                    _BASE_BYTES[random_bases(rng, (batch_size, left_length))],
+                    np.broadcast_to(prefix_bytes, (batch_size, len(prefix_bytes))),
+                    umi_bytes,
+                    np.broadcast_to(suffix_bytes, (batch_size, len(suffix_bytes))),
+                    _BASE_BYTES[random_bases(rng, (batch_size, right_length))],
+                ]
+            )
+            qualities = np.full(
+                reads.shape, SYNTHETIC_QUALITY + quality_utils.PHRED_OFFSET, np.uint8
+            )
+            qualities[:, umi_span[0] : umi_span[1]][errors] = (
+                rng.integers(2, 20, size=int(errors.sum())) + quality_utils.PHRED_OFFSET
+            )
+
+            # Redraw flanks until extraction finds the construct where it was put
+            for row in range(batch_size):
+                while find_umi_span(reads[row].tobytes().decode("ascii")) != umi_span:
+                    reads[row, : umi_span[0] - len(prefix_bytes)] = _BASE_BYTES[
+                        random_bases(rng, left_length)
+                    ]
+                    reads[row, umi_span[1] + len(suffix_bytes) :] = _BASE_BYTES[
+                        random_bases(rng, right_length)
+                    ]
+
+            flank_columns = np.r_[
+                umi_span[0] - len(prefix_bytes) : umi_span[0],
+                umi_span[1] : umi_span[1] + len(suffix_bytes),
+            ]
+            flank_errors = (
+                rng.random((batch_size, len(flank_columns))) < flank_error_rate
+            )
+            flank_bases = np.searchsorted(_BASE_BYTES, reads[:, flank_columns])
+            flank_bases[flank_errors] = (
+                flank_bases[flank_errors]
+                + rng.integers(1, 4, size=int(flank_errors.sum()))
+            ) % 4
+            reads[:, flank_columns] = _BASE_BYTES[flank_bases]
+            flank_error_counts = flank_errors.sum(axis=1)
+            flank_error_reads += int(np.count_nonzero(flank_error_counts))
+
+            read_text = reads.tobytes().decode("ascii")
+            quality_text = qualities.tobytes().decode("ascii")
+            true_umi_text = true_umi_bytes.tobytes().decode("ascii")
+            error_counts = errors.sum(axis=1).tolist()
+            flank_error_counts = flank_error_counts.tolist()
+            lines = []
+            for row in range(batch_size):
+                read_name = f"synthetic_{batch_start + row}"
+                read_start = row * read_length
+                lines.append(
+                    f"@{read_name}\n{read_text[read_start : read_start + read_length]}\n"
+                    f"+\n{quality_text[read_start : read_start + read_length]}\n"
+                )
+                if truth_writer is not None:
+                    umi_start = read_start + umi_span[0]
+                    true_umi_start = row * umi_length
+                    truth_writer.write(
+                        f"{read_name}\t{true_umi_text[true_umi_start : true_umi_start + umi_length]}"
+                        f"\t{read_text[umi_start : umi_start + umi_length]}\t{error_counts[row]}\t{flank_error_counts[row]}\n"
+                    )
+            fastq_fh.write("".join(lines))
+    finally:
+        fastq_fh.close()
+        if truth_writer is not None:
+            truth_writer.close()
+
+    total_umi_bases = number_of_reads * umi_length
+    return {
+        "Reads": number_of_reads,
+        "Unique_UMIs": unique_umis,
+        "Error_Bases": error_bases,
+        "Total_UMI_Bases": total_umi_bases,
+        "Accurate_Bases_Percentage": (total_umi_bases - error_bases)
+        / max(total_umi_bases, 1)
+        * 100,
+        "Flank_Error_Reads": flank_error_reads,
+    }
@@ -0,0 +1,303 @@
+import logging
+import os
+import shutil
+
+import numpy as np
+
+# Table formats accepted by --output_format. parquet and arrow need pyarrow
+OUTPUT_FORMATS = ["tsv", "parquet", "arrow"]
+
+# File extension of each table format
+TABLE_EXTENSIONS = {"tsv": ".txt", "parquet": ".parquet", "arrow": ".arrow"}
+
+# Rows per row group (parquet) or record batch (arrow) of columnar tables
+ROW_GROUP_SIZE = 1 << 20
+
+# Compression of columnar tables
+COMPRESSION = "zstd"
+
+# Write buffer of tab separated tables
+TSV_BUFFER_SIZE = 1 << 20
+
+
+def import_pyarrow():
+    """Import pyarrow, which is only needed for columnar tables.
+
+    Returns:
+        module: pyarrow
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError(
+            "pyarrow is needed to write parquet and arrow tables, install it or use --output_format tsv"
+        ) from error
+    return pyarrow
+
+
+def table_file_name(output_dir, table_name, output_format="tsv"):
+    """Path of a table written in a format.
+
+    Args:
+        output_dir (str): Output folder
+        table_name (str): File name without extension
+        output_format (str, optional): One of OUTPUT_FORMATS. Defaults to "tsv".
+
+    Returns:
+        str: Path of the table
+    """
+    return os.path.join(output_dir, table_name + TABLE_EXTENSIONS[output_format])
+
+
+def write_table(
+    dataframe, filename, output_format="tsv", write_index=None, dictionary_columns=()
+):
+    """Write a dataframe as a tab separated, parquet or arrow table.
+
+    Args:
+        dataframe (pandas df): Pandas dataframe to save to file
+        filename (str): Path to write the dataframe to
+        output_format (str, optional): One of OUTPUT_FORMATS. Defaults to "tsv".
+        write_index (bool, optional): Write row headers if True. Defaults to None.
+        dictionary_columns (tuple, optional): Columns with repeated values, dictionary encoded in arrow tables. Defaults to ().
+    """
+    logging.info(f"Writing dataframe to file {filename}")
+    if output_format == "tsv":
+        dataframe.to_csv(filename, header=True, index=write_index, sep="\t", mode="w")
+        return
+
+    pyarrow = import_pyarrow()
+    table = pyarrow.Table.from_pandas(dataframe, preserve_index=bool(write_index))
+    with TableWriter(
+        filename, table.column_names, output_format, dictionary_columns
+    ) as table_writer:
+        table_writer.write_table(table)
+
+
+class TableWriter:
+    """Writes a table of string columns, streamed as tab separated lines.
+
+    Lines are passed to write, like to a file opened for writing. Tab separated tables
+    are written through a buffered file. Columnar tables buffer ROW_GROUP_SIZE lines,
+    parse them with pyarrow's CSV reader and write them as one compressed row group
+    (parquet) or record batch (arrow), so memory use does not depend on the number of
+    rows. Parquet dictionary encodes each row group. Arrow files keep one dictionary
+    per dictionary column, and each batch adds only its new values to it as a dictionary
+    delta, so they can be memory mapped with pyarrow.memory_map and read without parsing.
+    """
+
+    def __init__(
+        self,
+        filename,
+        columns,
+        output_format="tsv",
+        dictionary_columns=(),
+        header=True,
+        row_group_size=ROW_GROUP_SIZE,
+    ):
+        """Open a table for writing.
+
+        Args:
+            filename (str): Path of the table
+            columns (list): Column names
+            output_format (str, optional): One of OUTPUT_FORMATS. Defaults to "tsv".
+            dictionary_columns (tuple, optional): Columns with repeated values, dictionary encoded in arrow tables. Defaults to ().
+            header (bool, optional): Write column names to tab separated tables. Defaults to True.
+            row_group_size (int, optional): Rows per row group or record batch. Defaults to ROW_GROUP_SIZE.
+        """
+        self.filename = filename
+        self.columns = list(columns)
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+
+        if output_format == "tsv":
+            self._fh = open(filename, "w", buffering=TSV_BUFFER_SIZE)
+            if header:
+                self._fh.write("\t".join(self.columns) + "\n")
+            # Lines go straight to the file
+            self.write = self.write_block = self._fh.write
+            return
+
+        self._pyarrow = import_pyarrow()
+        self._lines = []
+        self._buffered_rows = 0
+        self._dictionaries = {column: {} for column in dictionary_columns}
+        # Values of each dictionary in code order, extended with the new values of each batch
+        self._dictionary_values = {
+            column: self._pyarrow.array([], type=self._pyarrow.string())
+            for column in dictionary_columns
+        }
+        self._writer = None
+
+    def write(self, line):
+        """Add a tab separated line, ending in a newline, to the table.
+
+        Args:
+            line (str): Row of the table
+        """
+        self._lines.append(line)
+        self._buffered_rows += 1
+        if self._buffered_rows >= self.row_group_size:
+            self._write_lines()
+
+    def write_block(self, block):
+        """Add several tab separated lines, each ending in a newline, to the table.
+
+        Args:
+            block (str): Rows of the table
+        """
+        self._lines.append(block)
+        self._buffered_rows += block.count("\n")
+        if self._buffered_rows >= self.row_group_size:
+            self._write_lines()
+
+    def _write_lines(self):
+        lines, self._lines = self._lines, []
+        self._buffered_rows = 0
+        if not lines:
+            return
+        pyarrow = self._pyarrow
+        self.write_table(
+            pyarrow.csv.read_csv(
+                pyarrow.py_buffer("".join(lines).encode("utf8")),
+                read_options=pyarrow.csv.ReadOptions(column_names=self.columns),
+                parse_options=pyarrow.csv.ParseOptions(
+                    delimiter="\t", quote_char=False
+                ),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    column_types={column: pyarrow.string() for column in self.columns},
+                    strings_can_be_null=False,
+                ),
+            )
+        )
+
+    def write_table(self, table):
+        """Write a pyarrow table with the columns of this table.
+
+        Args:
+            table (pyarrow Table): Rows to add
+        """
+        pyarrow = self._pyarrow
+        if self.output_format == "parquet":
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(
+                    self.filename, table.schema, compression=COMPRESSION
+                )
+            self._writer.write_table(table, row_group_size=self.row_group_size)
+            return
+
+        table = self._encode_dictionaries(table)
+        if self._writer is None:
+            self._writer = pyarrow.ipc.new_file(
+                self.filename,
+                table.schema,
+                options=pyarrow.ipc.IpcWriteOptions(
+                    compression=COMPRESSION, emit_dictionary_deltas=True
+                ),
+            )
+        self._writer.write_table(table, max_chunksize=self.row_group_size)
+
+    def _encode_dictionaries(self, table):
+        # Arrow files allow one dictionary per column, that later batches can only append
+        # to. Values are numbered in order of first occurrence across all batches. Only
+        # the values first seen in a batch are converted, the writer emits them as a delta.
+        pyarrow = self._pyarrow
+        for column, dictionary in self._dictionaries.items():
+            position = table.column_names.index(column)
+            encoded = table.column(position).combine_chunks().dictionary_encode()
+            number_of_values = len(dictionary)
+            codes = np.fromiter(
+                (
+                    dictionary.setdefault(value, len(dictionary))
+                    for value in encoded.dictionary.to_pylist()
+                ),
+                dtype=np.int32,
+                count=len(encoded.dictionary),
+            )
+            # New values got the next codes, in the order of the batch dictionary
+            new_values = codes >= number_of_values
+            if new_values.any():
+                self._dictionary_values[column] = pyarrow.concat_arrays(
+                    [
+                        self._dictionary_values[column],
+                        encoded.dictionary.filter(pyarrow.array(new_values)),
+                    ]
+                )
+            indices = codes[encoded.indices.to_numpy(zero_copy_only=False)]
+            table = table.set_column(
+                position,
+                column,
+                pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(indices, type=pyarrow.int32()),
+                    self._dictionary_values[column],
+                ),
+            )
+        return table
+
+    def append_file(self, filename):
+        """Append the rows of a table written in the same format, without a header.
+
+        Args:
+            filename (str): Path of the table to append
+        """
+        if self.output_format == "tsv":
+            with open(filename, "r") as part_fh:
+                shutil.copyfileobj(part_fh, self._fh)
+            return
+
+        self._write_lines()
+        pyarrow = self._pyarrow
+        if self.output_format == "parquet":
+            for batch in pyarrow.parquet.ParquetFile(filename).iter_batches(
+                batch_size=self.row_group_size
+            ):
+                self.write_table(pyarrow.Table.from_batches([batch]))
+            return
+
+        with pyarrow.memory_map(filename) as source:
+            reader = pyarrow.ipc.open_file(source)
+            for batch_number in range(reader.num_record_batches):
+                table = pyarrow.Table.from_batches([reader.get_batch(batch_number)])
+                self.write_table(table.cast(self._plain_schema(table.schema)))
+
+    def _plain_schema(self, schema):
+        # Dictionary columns decoded back to strings
+        pyarrow = self._pyarrow
+        return pyarrow.schema(
+            [
+                (
+                    pyarrow.field(field.name, field.type.value_type)
+                    if pyarrow.types.is_dictionary(field.type)
+                    else field
+                )
+                for field in schema
+            ]
+        )
+
+    def close(self):
+        """Write buffered rows and close the table. Empty columnar tables get a schema only."""
+        if self.output_format == "tsv":
+            self._fh.close()
+            return
+
+        self._write_lines()
+        if self._writer is None:
+            pyarrow = self._pyarrow
+            self.write_table(
+                pyarrow.table(
+                    {
+                        column: pyarrow.array([], type=pyarrow.string())
+                        for column in self.columns
+                    }
+                )
+            )
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,350 @@
+import logging
+from collections.abc import Mapping
+from operator import itemgetter
+
+import numpy as np
+
+# UMI representations accepted by --umi_encoding
+UMI_ENCODINGS = ["string", "2bit"]
+
+# 2-bit code of each base, UMI's with any other character are kept as strings
+BASES = "ACGT"
+
+# Longest UMI counted in a dense array, 4^12 uint32 counts take 64 MB
+DENSE_MAX_UMI_LENGTH = 12
+
+# Number of UMI's buffered before they are encoded and counted in one go
+ENCODE_BATCH_SIZE = 1 << 16
+
+_BASE_LOOKUP = np.full(256, 4, dtype=np.uint8)
+_BASE_LOOKUP[np.frombuffer(BASES.encode("ascii"), dtype=np.uint8)] = np.arange(4)
+_BASE_BYTES = np.frombuffer(BASES.encode("ascii"), dtype=np.uint8)
+
+
+def encode_umi(umi):
+    """Pack a UMI into an integer, 2 bits per base with the first base in the highest bits.
+
+    Args:
+        umi (str): UMI sequence made of A, C, G and T
+
+    Returns:
+        int: 2-bit code of the UMI
+    """
+    code = 0
+    for base in umi:
+        base_code = BASES.find(base)
+        if base_code == -1:
+            raise ValueError(f"UMI {umi} can't be 2-bit encoded, unknown base {base}")
+        code = (code << 2) | base_code
+    return code
+
+
+def decode_umi(code, umi_length):
+    """Unpack a 2-bit code into a UMI.
+
+    Args:
+        code (int): 2-bit code of the UMI
+        umi_length (int): Number of bases in the UMI
+
+    Returns:
+        str: UMI sequence
+    """
+    return decode_umis(np.array([code], dtype=np.int64), umi_length)[0]
+
+
+def encode_umis(umis, umi_length):
+    """Pack UMI's of the same length into integers in one numpy call.
+
+    Args:
+        umi_length (int): Number of bases in each UMI, at most 31
+        umis (list): UMI sequences, all umi_length long
+
+    Returns:
+        numpy array: int64 codes, -1 for UMI's with a character other than A, C, G or T
+    """
+    if not umis:
+        return np.empty(0, dtype=np.int64)
+
+    # Non ASCII characters are replaced by "?", which keeps one byte per base
+    bases = _BASE_LOOKUP[
+        np.frombuffer("".join(umis).encode("ascii", "replace"), dtype=np.uint8)
+    ].reshape(-1, umi_length)
+
+    codes = np.zeros(len(umis), dtype=np.int64)
+    for position in range(umi_length):
+        codes = (codes << 2) | bases[:, position]
+    codes[(bases == 4).any(axis=1)] = -1
+    return codes
+
+
+def decode_umis(codes, umi_length):
+    """Unpack 2-bit codes into UMI's in one numpy call.
+
+    Args:
+        codes (numpy array): 2-bit codes
+        umi_length (int): Number of bases in each UMI
+
+    Returns:
+        list: UMI sequences
+    """
+    shifts = np.arange(2 * (umi_length - 1), -1, -2, dtype=np.int64)
+    bases = _BASE_BYTES[(np.asarray(codes, dtype=np.int64)[:, None] >> shifts) & 3]
+    joined = bases.tobytes().decode("ascii")
+    return [
+        joined[start : start + umi_length]
+        for start in range(0, len(joined), umi_length)
+    ]
+
+
+class EncodedUmiCounts(Mapping):
+    """UMI counts backed by a dense array of 2-bit UMI codes.
+
+    A read-only mapping of UMI sequence to count that behaves like the Counter used by
+    the string representation: missing UMI's count 0, keys are in order of first
+    occurrence and most_common breaks ties the same way. UMI's are added with add,
+    buffered, and counted ENCODE_BATCH_SIZE at a time with numpy, so the per read cost
+    is a list append.
+
+    The first A/C/G/T UMI of at most DENSE_MAX_UMI_LENGTH bases sets the dense UMI
+    length. UMI's of that length are counted in a uint32 array indexed by their code.
+    UMI's of any other length, or with other characters, fall back to a dictionary.
+    """
+
+    def __init__(self):
+        self.umi_length = None
+        self._dense_counts = None
+        # Dense codes in order of first occurrence
+        self._dense_order = []
+        self._number_of_dense_umis = 0
+        # Fallback UMI's in order of first occurrence, with the number of dense UMI's seen before each
+        self._fallback_counts = {}
+        self._fallback_dense_before = []
+        self._pending = []
+
+    def add(self, umi):
+        """Count one occurrence of a UMI.
+
+        Args:
+            umi (str): UMI sequence
+        """
+        self._pending.append(umi)
+        if len(self._pending) >= ENCODE_BATCH_SIZE:
+            self._flush()
+
+    def _set_umi_length(self, umi_length):
+        self.umi_length = umi_length
+        self._dense_counts = np.zeros(4**umi_length, dtype=np.uint32)
+
+    def _find_umi_length(self, umis):
+        # The first A/C/G/T UMI short enough for the dense array sets its length
+        for umi in umis:
+            if (
+                0 < len(umi) <= DENSE_MAX_UMI_LENGTH
+                and encode_umis([umi], len(umi))[0] >= 0
+            ):
+                logging.info(f"Counting {len(umi)} bp UMI's in a dense 2-bit array")
+                self._set_umi_length(len(umi))
+                return
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        if self.umi_length is None:
+            self._find_umi_length(pending)
+
+        # Encode UMI's of the dense length, everything else goes to the fallback dictionary
+        codes = np.full(len(pending), -1, dtype=np.int64)
+        if self.umi_length is not None:
+            lengths = np.fromiter(map(len, pending), dtype=np.int64, count=len(pending))
+            if (lengths == self.umi_length).all():
+                codes = encode_umis(pending, self.umi_length)
+            else:
+                dense_positions = np.flatnonzero(lengths == self.umi_length)
+                codes[dense_positions] = encode_umis(
+                    [pending[position] for position in dense_positions],
+                    self.umi_length,
+                )
+
+        dense = codes >= 0
+        new_positions = np.empty(0, dtype=np.int64)
+        if dense.any():
+            unique_codes, first_positions, code_counts = np.unique(
+                codes[dense], return_index=True, return_counts=True
+            )
+            new = self._dense_counts[unique_codes] == 0
+            new_positions = np.flatnonzero(dense)[first_positions[new]]
+            by_position = np.argsort(new_positions)
+            new_positions = new_positions[by_position]
+            self._dense_order.append(unique_codes[new][by_position].astype(np.uint32))
+            self._dense_counts[unique_codes] += code_counts.astype(np.uint32)
+
+        fallback_positions = np.flatnonzero(~dense)
+        dense_before = self._number_of_dense_umis + np.searchsorted(
+            new_positions, fallback_positions
+        )
+        for position, before in zip(fallback_positions, dense_before.tolist()):
+            self._add_fallback(pending[position], 1, before)
+        self._number_of_dense_umis += len(new_positions)
+
+    def _add_fallback(self, umi, count, dense_before):
+        if umi not in self._fallback_counts:
+            self._fallback_counts[umi] = 0
+            self._fallback_dense_before.append(dense_before)
+        self._fallback_counts[umi] += count
+
+    def _add_count(self, umi, count):
+        if self.umi_length is None:
+            self._find_umi_length([umi])
+        code = self._code_of(umi)
+        if code < 0:
+            self._add_fallback(umi, count, self._number_of_dense_umis)
+            return
+
+        if self._dense_counts[code] == 0:
+            self._dense_order.append(np.array([code], dtype=np.uint32))
+            self._number_of_dense_umis += 1
+        self._dense_counts[code] += count
+
+    def _code_of(self, umi):
+        if self.umi_length is None or len(umi) != self.umi_length:
+            return -1
+        try:
+            return encode_umi(umi)
+        except ValueError:
+            return -1
+
+    def codes(self):
+        """Dense UMI codes and their counts, in order of first occurrence.
+
+        Returns:
+            tuple: (uint32 codes, uint32 counts) numpy arrays
+        """
+        self._flush()
+        if len(self._dense_order) > 1:
+            self._dense_order = [np.concatenate(self._dense_order)]
+        if not self._dense_order:
+            return np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+        return self._dense_order[0], self._dense_counts[self._dense_order[0]]
+
+    def __getitem__(self, umi):
+        self._flush()
+        code = self._code_of(umi)
+        if code >= 0:
+            return int(self._dense_counts[code])
+        return self._fallback_counts.get(umi, 0)
+
+    def __contains__(self, umi):
+        return self[umi] > 0
+
+    def __len__(self):
+        self._flush()
+        return self._number_of_dense_umis + len(self._fallback_counts)
+
+    def __iter__(self):
+        return iter([umi for umi, _ in self.items()])
+
+    def items(self):
+        dense_codes, dense_counts = self.codes()
+        dense_items = []
+        if len(dense_codes):
+            dense_items = list(
+                zip(decode_umis(dense_codes, self.umi_length), dense_counts.tolist())
+            )
+        if not self._fallback_counts:
+            return dense_items
+
+        # A fallback UMI goes right after the dense UMI's first seen before it
+        ordered_items = [((index, 1), item) for index, item in enumerate(dense_items)]
+        ordered_items += [
+            ((dense_before, 0), item)
+            for dense_before, item in zip(
+                self._fallback_dense_before, self._fallback_counts.items()
+            )
+        ]
+        return [item for _, item in sorted(ordered_items, key=itemgetter(0))]
+
+    def values(self):
+        return [count for _, count in self.items()]
+
+    def most_common(self, n=None):
+        """List the n most common UMI's and their counts, like Counter.most_common.
+
+        Args:
+            n (int, optional): Number of UMI's to return. Defaults to None, all UMI's.
+
+        Returns:
+            list: (UMI, count) tuples from the most common to the least, ties in order of first occurrence
+        """
+        items = sorted(self.items(), key=itemgetter(1), reverse=True)
+        return items if n is None else items[:n]
+
+    def update(self, other):
+        """Add the counts of another mapping, like Counter.update.
+
+        UMI's not seen before are added after the existing ones, as if the reads of other
+        came after the reads counted so far.
+
+        Args:
+            other (Mapping): EncodedUmiCounts or Counter of UMI's
+        """
+        self._flush()
+        if not isinstance(other, EncodedUmiCounts):
+            for umi, count in other.items():
+                self._add_count(umi, count)
+            return
+
+        other._flush()
+        if other.umi_length is None:
+            # Without a dense length, none of the UMI's of other can be 2-bit encoded
+            for umi, count in other._fallback_counts.items():
+                self._add_fallback(umi, count, self._number_of_dense_umis)
+            return
+
+        if self.umi_length is None:
+            self._set_umi_length(other.umi_length)
+        if other.umi_length != self.umi_length:
+            for umi, count in other.items():
+                self._add_count(umi, count)
+            return
+
+        other_codes, other_counts = other.codes()
+        new = self._dense_counts[other_codes] == 0
+        new_before = np.concatenate([[0], np.cumsum(new)])
+        for umi, dense_before in zip(
+            other._fallback_counts, other._fallback_dense_before
+        ):
+            self._add_fallback(
+                umi,
+                other._fallback_counts[umi],
+                self._number_of_dense_umis + int(new_before[dense_before]),
+            )
+
+        self._dense_order.append(other_codes[new])
+        self._number_of_dense_umis += int(new.sum())
+        self._dense_counts[other_codes] += other_counts
+
+    def __getstate__(self):
+        # Only the counted codes are pickled, not the dense array
+        dense_codes, dense_counts = self.codes()
+        return {
+            "umi_length": self.umi_length,
+            "dense_codes": dense_codes,
+            "dense_counts": dense_counts,
+            "fallback_counts": self._fallback_counts,
+            "fallback_dense_before": self._fallback_dense_before,
+        }
+
+    def __setstate__(self, state):
+        self.__init__()
+        if state["umi_length"] is not None:
+            self._set_umi_length(state["umi_length"])
+            self._dense_counts[state["dense_codes"]] = state["dense_counts"]
+            self._dense_order = [state["dense_codes"]]
+            self._number_of_dense_umis = len(state["dense_codes"])
+        self._fallback_counts = state["fallback_counts"]
+        self._fallback_dense_before = state["fallback_dense_before"]
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({dict(self.most_common())})"
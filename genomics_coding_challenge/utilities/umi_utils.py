@@ -1,6 +1,10 @@
 import logging
-from collections import Counter, defaultdict
-import re
+import functools
+import os
+from io import StringIO
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 import pandas as pd
 import numpy as np
@@ -8,9 +12,108 @@ from scipy import spatial
 from Levenshtein import hamming
 import pyfastx
 
+from utilities import (
+    fastq_utils,
+    flank_utils,
+    hamming_utils,
+    stream_utils,
+    table_utils,
+    umi_codes,
+)
+
+# Columns of the per read UMI table
+READ_UMI_COLUMNS = ["ReadName", "UMI"]
+
+
+@functools.lru_cache(maxsize=None)
+def compile_flank_matcher(umi_prefix, umi_suffix, return_span=False, umi_length=None):
+    """Build a function that extracts the UMI between a fixed prefix and suffix.
+
+    The matcher is built once per prefix/suffix pair. It locates the flanks with
+    plain substring search, and returns the same UMI as the case insensitive
+    regex "{umi_prefix}(.*){umi_suffix}": the first prefix and the last suffix after it.
+    With umi_length, the suffix must instead start umi_length bases after the first prefix.
+
+    Args:
+        umi_prefix (str): UMI prefix
+        umi_suffix (str): UMI suffix
+        return_span (bool, optional): Return the start and end of the UMI in the read instead of the UMI. Defaults to False.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+
+    Returns:
+        function: Takes a read sequence, returns the UMI (or its span) or None if the flanks are not found
+    """
+    umi_prefix, umi_suffix = umi_prefix.upper(), umi_suffix.upper()
+    prefix_length = len(umi_prefix)
+
+    def find_umi(read):
+        read_upper = read if read.isupper() else read.upper()
+        prefix_start = read_upper.find(umi_prefix)
+        if prefix_start == -1:
+            return None
+        umi_start = prefix_start + prefix_length
+        suffix_start = read_upper.rfind(umi_suffix, umi_start)
+        if suffix_start == -1:
+            return None
+        return read[umi_start:suffix_start]
+
+    def find_umi_span(read):
+        read_upper = read if read.isupper() else read.upper()
+        prefix_start = read_upper.find(umi_prefix)
+        if prefix_start == -1:
+            return None
+        umi_start = prefix_start + prefix_length
+        suffix_start = read_upper.rfind(umi_suffix, umi_start)
+        if suffix_start == -1:
+            return None
+        return umi_start, suffix_start
+
+    def find_umi_span_of_length(read):
+        read_upper = read if read.isupper() else read.upper()
+        prefix_start = read_upper.find(umi_prefix)
+        if prefix_start == -1:
+            return None
+        umi_start = prefix_start + prefix_length
+        if not read_upper.startswith(umi_suffix, umi_start + umi_length):
+            return None
+        return umi_start, umi_start + umi_length
+
+    def find_umi_of_length(read):
+        umi_span = find_umi_span_of_length(read)
+        if umi_span is None:
+            return None
+        return read[umi_span[0] : umi_span[1]]
+
+    if umi_length is not None:
+        return find_umi_span_of_length if return_span else find_umi_of_length
+    return find_umi_span if return_span else find_umi
+
+
+def compile_read_matchers(
+    umi_prefix, umi_suffix, return_span=False, flank_mismatches=0, umi_length=None
+):
+    """Build the exact flank matcher, and the error tolerant one it falls back to.
+
+    Args:
+        umi_prefix (str): UMI prefix
+        umi_suffix (str): UMI suffix
+        return_span (bool, optional): Matchers return the span of the UMI instead of the UMI. Defaults to False.
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+
+    Returns:
+        tuple: (exact matcher, approximate matcher) - see compile_flank_matcher and flank_utils.compile_approximate_flank_matcher. The approximate matcher is None without mismatches or a UMI length, when it would find nothing more
+    """
+    find_umi = compile_flank_matcher(umi_prefix, umi_suffix, return_span, umi_length)
+    if not flank_mismatches and umi_length is None:
+        return find_umi, None
+    return find_umi, flank_utils.compile_approximate_flank_matcher(
+        umi_prefix, umi_suffix, flank_mismatches, umi_length, return_span
+    )
+
 
 def extract_umi_from_read(read, umi_prefix, umi_suffix):
-    """Extract UMI from each read using regex
+    """Extract UMI from a read sequence
 
     Args:
         read (str): Read sequence
@@ -20,93 +123,609 @@ def extract_umi_from_read(read, umi_prefix, umi_suffix):
     Returns:
         str: UMI sequence
     """
-    umi_regex_pattern = re.compile(f"{umi_prefix}(.*){umi_suffix}", re.IGNORECASE)
-    umi = umi_regex_pattern.search(read).group(1)
+    umi = compile_flank_matcher(umi_prefix, umi_suffix)(read)
+    if umi is None:
+        raise ValueError(
+            f"UMI prefix {umi_prefix} and suffix {umi_suffix} not found in read {read}"
+        )
     return umi
 
 
-def extract_umi_from_fastq(input_fastq, umi_prefix, umi_suffix):
-    """Extract all UMI's between a umi prefix and suffix, given a fastq file. Can be gziped.
+def create_umi_counter(umi_encoding="string"):
+    """Create an empty UMI counter for the given UMI representation.
 
     Args:
-        input_fastq (file): *.fastq or *.fastq.gz file.
+        umi_encoding (str, optional): "string" for a Counter of UMI sequences, "2bit" for 2-bit encoded counts. Defaults to "string".
+
+    Returns:
+        Counter or EncodedUmiCounts: Empty UMI counter
+    """
+    if umi_encoding == "2bit":
+        return umi_codes.EncodedUmiCounts()
+    return Counter()
+
+
+def count_umis_in_records(
+    records,
+    umi_prefix,
+    umi_suffix,
+    read_umi_fh=None,
+    umi_encoding="string",
+    quality_filter=None,
+    flank_mismatches=0,
+    umi_length=None,
+    read_outcomes=None,
+):
+    """Count UMI's in FASTQ records and optionally write the UMI of each read.
+
+    Flanks are searched exactly first. Reads without exact flanks (or with a UMI of
+    another length than umi_length) are searched again allowing flank_mismatches
+    mismatches in each flank, and are skipped if the flanks are still not found.
+
+    Args:
+        records (iterable): (read name, sequence, quality) tuples
         umi_prefix (str): UMI prefix
         umi_suffix (str):  UMI suffix
+        read_umi_fh (file object, optional): Receives a "read name<TAB>UMI" line per read, a file or table_utils.TableWriter. Defaults to None.
+        umi_encoding (str, optional): UMI representation, see create_umi_counter. Defaults to "string".
+        quality_filter (UmiQualityFilter, optional): Only count UMI's that pass this filter, see quality_utils. Defaults to None.
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+        read_outcomes (Counter, optional): Receives the number of recovered_reads, found with mismatches, and failed_reads, skipped. Defaults to None.
 
     Returns:
-        pandas dataframe: main_readname_umi_df - A dataframe that contains all sequence headers and UMI sequences in the corresponding sequence
+        Counter or EncodedUmiCounts: unique_umi_counts - UMI sequences and their counts, in order of first occurrence
     """
-    logging.info("Parsing FASTQ file and extracting UMI's from reads")
-    main_readname_umi_df = pd.DataFrame(columns=["ReadName", "UMI"])
-    fastq_iterator = pyfastx.Fastx(input_fastq)
+    if quality_filter is not None:
+        return count_umis_in_records_with_quality(
+            records,
+            umi_prefix,
+            umi_suffix,
+            read_umi_fh,
+            umi_encoding,
+            quality_filter,
+            flank_mismatches,
+            umi_length,
+            read_outcomes,
+        )
+
+    find_umi, find_umi_approximately = compile_read_matchers(
+        umi_prefix, umi_suffix, flank_mismatches=flank_mismatches, umi_length=umi_length
+    )
+    unique_umi_counts = create_umi_counter(umi_encoding)
+    add_umi = unique_umi_counts.add if umi_encoding == "2bit" else None
+    recovered_reads = failed_reads = 0
 
     # Ignore quality and comment for now
-    for name, sequence, *_ in fastq_iterator:
-        umi = extract_umi_from_read(sequence, umi_prefix, umi_suffix)
-        current_readname_umi_df = pd.DataFrame({"ReadName": [name], "UMI": [umi]})
-        main_readname_umi_df = pd.concat(
-            [main_readname_umi_df, current_readname_umi_df], ignore_index=True
+    for record in records:
+        umi = find_umi(record[1])
+        if umi is None:
+            if find_umi_approximately is not None:
+                umi = find_umi_approximately(record[1])
+            if umi is None:
+                failed_reads += 1
+                continue
+            recovered_reads += 1
+        if add_umi is None:
+            unique_umi_counts[umi] += 1
+        else:
+            add_umi(umi)
+        if read_umi_fh is not None:
+            read_umi_fh.write(f"{record[0]}\t{umi}\n")
+
+    if read_outcomes is not None:
+        read_outcomes.update(recovered_reads=recovered_reads, failed_reads=failed_reads)
+    return unique_umi_counts
+
+
+def count_umis_in_records_with_quality(
+    records,
+    umi_prefix,
+    umi_suffix,
+    read_umi_fh,
+    umi_encoding,
+    quality_filter,
+    flank_mismatches=0,
+    umi_length=None,
+    read_outcomes=None,
+):
+    """Count UMI's in FASTQ records whose UMI base qualities pass a filter.
+
+    The qualities of the UMI bases are queued in quality_filter, and decoded and checked
+    a batch at a time. All reads are written to read_umi_fh, filtered or not.
+
+    Args:
+        records (iterable): (read name, sequence, quality) tuples
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        read_umi_fh (file object): Receives a "read name<TAB>UMI" line per read, or None
+        umi_encoding (str): UMI representation, see create_umi_counter
+        quality_filter (UmiQualityFilter): Filter, also receives filtered read counts and quality weights
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+        read_outcomes (Counter, optional): Receives recovered_reads and failed_reads, see count_umis_in_records. Defaults to None.
+
+    Returns:
+        Counter or EncodedUmiCounts: unique_umi_counts - UMI sequences that passed and their counts, in order of first occurrence
+    """
+    find_umi_span, find_umi_span_approximately = compile_read_matchers(
+        umi_prefix,
+        umi_suffix,
+        return_span=True,
+        flank_mismatches=flank_mismatches,
+        umi_length=umi_length,
+    )
+    unique_umi_counts = create_umi_counter(umi_encoding)
+    add_quality = quality_filter.add
+    recovered_reads = failed_reads = 0
+
+    for record in records:
+        umi_span = find_umi_span(record[1])
+        if umi_span is None:
+            if find_umi_span_approximately is not None:
+                umi_span = find_umi_span_approximately(record[1])
+            if umi_span is None:
+                failed_reads += 1
+                continue
+            recovered_reads += 1
+        umi_start, umi_end = umi_span
+        umi = record[1][umi_start:umi_end]
+        if add_quality(umi, record[2][umi_start:umi_end]):
+            quality_filter.flush(unique_umi_counts)
+        if read_umi_fh is not None:
+            read_umi_fh.write(f"{record[0]}\t{umi}\n")
+
+    quality_filter.flush(unique_umi_counts)
+    if read_outcomes is not None:
+        read_outcomes.update(recovered_reads=recovered_reads, failed_reads=failed_reads)
+    return unique_umi_counts
+
+
+def count_umis_in_shard(
+    shard,
+    umi_prefix,
+    umi_suffix,
+    read_umi_file=None,
+    umi_encoding="string",
+    output_format="tsv",
+    quality_filter=None,
+    flank_mismatches=0,
+    umi_length=None,
+):
+    """Count UMI's in one shard of a FASTQ file. Runs in a worker process.
+
+    Args:
+        shard (tuple): Shard from fastq_utils.plan_fastq_shards
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        read_umi_file (str, optional): File to write the UMI of each read of the shard to, without a header. Defaults to None.
+        umi_encoding (str, optional): UMI representation, see create_umi_counter. Defaults to "string".
+        output_format (str, optional): Format of read_umi_file, see table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+        quality_filter (UmiQualityFilter, optional): Only count UMI's that pass this filter. Defaults to None.
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+
+    Returns:
+        tuple: (unique_umi_counts, quality_filter, read_outcomes) - UMI sequences and their counts in order of first occurrence, the filter with the filtered reads and weights of the shard, and its recovered and failed reads
+    """
+    records = fastq_utils.iter_shard_records(shard)
+    read_outcomes = Counter()
+    if read_umi_file is None:
+        unique_umi_counts = count_umis_in_records(
+            records,
+            umi_prefix,
+            umi_suffix,
+            umi_encoding=umi_encoding,
+            quality_filter=quality_filter,
+            flank_mismatches=flank_mismatches,
+            umi_length=umi_length,
+            read_outcomes=read_outcomes,
         )
+        return unique_umi_counts, quality_filter, read_outcomes
+
+    with table_utils.TableWriter(
+        read_umi_file,
+        READ_UMI_COLUMNS,
+        output_format,
+        dictionary_columns=["UMI"],
+        header=False,
+    ) as read_umi_fh:
+        unique_umi_counts = count_umis_in_records(
+            records,
+            umi_prefix,
+            umi_suffix,
+            read_umi_fh,
+            umi_encoding,
+            quality_filter,
+            flank_mismatches,
+            umi_length,
+            read_outcomes,
+        )
+    return unique_umi_counts, quality_filter, read_outcomes
+
 
-    return main_readname_umi_df
+def count_umis_in_block(
+    block,
+    umi_prefix,
+    umi_suffix,
+    write_reads=False,
+    umi_encoding="string",
+    quality_filter=None,
+    flank_mismatches=0,
+    umi_length=None,
+):
+    """Count UMI's in a block of FASTQ records. Runs in a worker process.
 
+    Args:
+        block (str): Text of whole records, from stream_utils.iter_record_blocks
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        write_reads (bool, optional): Return the per read table lines of the block. Defaults to False.
+        umi_encoding (str, optional): UMI representation, see create_umi_counter. Defaults to "string".
+        quality_filter (UmiQualityFilter, optional): Only count UMI's that pass this filter. Defaults to None.
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+
+    Returns:
+        tuple: (unique_umi_counts, quality_filter, read_outcomes, read_umi_lines) - like count_umis_in_shard, and the "read name<TAB>UMI" lines of the block, or None
+    """
+    read_umi_fh = StringIO() if write_reads else None
+    read_outcomes = Counter()
+    unique_umi_counts = count_umis_in_records(
+        stream_utils.parse_record_block(block),
+        umi_prefix,
+        umi_suffix,
+        read_umi_fh,
+        umi_encoding,
+        quality_filter,
+        flank_mismatches,
+        umi_length,
+        read_outcomes,
+    )
+    read_umi_lines = read_umi_fh.getvalue() if write_reads else None
+    return unique_umi_counts, quality_filter, read_outcomes, read_umi_lines
+
+
+def count_umis_in_stream(
+    input_fastq,
+    umi_prefix,
+    umi_suffix,
+    read_umi_fh=None,
+    threads=1,
+    umi_encoding="string",
+    quality_filter=None,
+    flank_mismatches=0,
+    umi_length=None,
+    read_outcomes=None,
+):
+    """Count UMI's in a FASTQ input read front to back by the streaming reader.
+
+    A reader thread reads and decompresses the input (see stream_utils.ChunkReader).
+    With one thread, records are extracted as they are read. With more, blocks of
+    records are counted on a process pool, at most BATCHES_PER_WORKER blocks per worker
+    in flight, and their counts and per read lines are merged in input order.
+
+    Args:
+        input_fastq (str): Path of a file or named pipe, or "-" for stdin
+        See extract_umis for the other arguments.
 
-def write_data_frame_to_file(dataframe, filename, write_index=None):
+    Returns:
+        Counter or EncodedUmiCounts: unique_umi_counts - UMI sequences and their counts, in order of first occurrence
+    """
+    if threads == 1:
+        return count_umis_in_records(
+            stream_utils.iter_stream_records(input_fastq),
+            umi_prefix,
+            umi_suffix,
+            read_umi_fh,
+            umi_encoding,
+            quality_filter,
+            flank_mismatches,
+            umi_length,
+            read_outcomes,
+        )
+
+    unique_umi_counts = create_umi_counter(umi_encoding)
+
+    def merge(future):
+        (
+            block_umi_counts,
+            block_quality_filter,
+            block_read_outcomes,
+            read_umi_lines,
+        ) = future.result()
+        unique_umi_counts.update(block_umi_counts)
+        if read_outcomes is not None:
+            read_outcomes.update(block_read_outcomes)
+        if quality_filter is not None:
+            quality_filter.update(block_quality_filter)
+        if read_umi_lines:
+            read_umi_fh.write_block(read_umi_lines)
+
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        for block in stream_utils.iter_record_blocks(input_fastq):
+            if len(in_flight) >= threads * stream_utils.BATCHES_PER_WORKER:
+                merge(in_flight.popleft())
+            in_flight.append(
+                executor.submit(
+                    count_umis_in_block,
+                    block,
+                    umi_prefix,
+                    umi_suffix,
+                    read_umi_fh is not None,
+                    umi_encoding,
+                    quality_filter,
+                    flank_mismatches,
+                    umi_length,
+                )
+            )
+        while in_flight:
+            merge(in_flight.popleft())
+    return unique_umi_counts
+
+
+def extract_umis(
+    input_fastq,
+    umi_prefix,
+    umi_suffix,
+    read_umi_file=None,
+    threads=1,
+    umi_encoding="string",
+    output_format="tsv",
+    quality_filter=None,
+    flank_mismatches=0,
+    umi_length=None,
+    read_outcomes=None,
+    ingest="auto",
+):
+    """Stream a fastq file once, counting UMI's and optionally writing the UMI of each read.
+
+    Reads are processed one at a time and only UMI counts are kept in memory, so run time
+    is linear in the number of reads and memory use depends on the number of unique UMI's
+    only. The per read table is written through a buffered file as reads are processed,
+    or in compressed row groups for the parquet and arrow formats (see table_utils).
+
+    With more than one thread, the file is split into record aligned shards that are
+    processed on a process pool. Shard counts are merged and per read tables concatenated
+    in file order, so the results are the same as with one thread.
+
+    With the "2bit" UMI encoding, UMI's are counted as 2-bit integer codes in a dense
+    array (see umi_codes.EncodedUmiCounts) instead of a Counter of strings. The result
+    is a mapping with the same keys, counts and order.
+
+    With a quality_filter (see quality_utils.UmiQualityFilter), only UMI's whose base
+    qualities pass it are counted. The filter receives the number of filtered reads and,
+    if it is weighted, the quality weight of each UMI.
+
+    Reads whose flanks are not found exactly are searched again with up to
+    flank_mismatches mismatches in each flank (see flank_utils), and with umi_length only
+    UMI's of that length are extracted. Reads without flanks are skipped and counted.
+
+    stdin ("-"), named pipes and, with more than one thread, gzipped files are read once
+    by a reader thread that decompresses them, and their records are extracted as they
+    arrive, or in blocks on the process pool (see count_umis_in_stream).
+
+    Args:
+        input_fastq (file): *.fastq or *.fastq.gz file, a named pipe, or "-" for stdin.
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+        read_umi_file (str, optional): Table to write read names and UMI's to. Defaults to None.
+        threads (int, optional): Number of worker processes. Defaults to 1.
+        umi_encoding (str, optional): UMI representation, see create_umi_counter. Defaults to "string".
+        output_format (str, optional): Format of read_umi_file, see table_utils.OUTPUT_FORMATS. Defaults to "tsv".
+        quality_filter (UmiQualityFilter, optional): Only count UMI's that pass this filter. Defaults to None.
+        flank_mismatches (int, optional): Largest number of mismatches in each flank. Defaults to 0.
+        umi_length (int, optional): Expected UMI length. Defaults to None, any length.
+        read_outcomes (Counter, optional): Receives the number of recovered_reads and failed_reads. Defaults to None.
+        ingest (str, optional): How the input is read, one of stream_utils.INGEST_MODES. Defaults to "auto".
+
+    Returns:
+        Counter or EncodedUmiCounts: unique_umi_counts - UMI sequences and their counts, in order of first occurrence
+    """
+    logging.info("Parsing FASTQ file and extracting UMI's from reads")
+    read_umi_fh = None
+    if read_umi_file is not None:
+        logging.info(f"Writing the UMI of each read to file {read_umi_file}")
+        read_umi_fh = table_utils.TableWriter(
+            read_umi_file,
+            READ_UMI_COLUMNS,
+            output_format,
+            dictionary_columns=["UMI"],
+        )
+
+    try:
+        if stream_utils.use_stream(input_fastq, ingest, threads):
+            return count_umis_in_stream(
+                input_fastq,
+                umi_prefix,
+                umi_suffix,
+                read_umi_fh,
+                threads,
+                umi_encoding,
+                quality_filter,
+                flank_mismatches,
+                umi_length,
+                read_outcomes,
+            )
+
+        if threads == 1:
+            return count_umis_in_records(
+                pyfastx.Fastx(input_fastq),
+                umi_prefix,
+                umi_suffix,
+                read_umi_fh,
+                umi_encoding,
+                quality_filter,
+                flank_mismatches,
+                umi_length,
+                read_outcomes,
+            )
+
+        shards = fastq_utils.plan_fastq_shards(input_fastq, threads)
+        part_files = [
+            f"{read_umi_file}.part{shard_number}" if read_umi_file else None
+            for shard_number in range(len(shards))
+        ]
+        unique_umi_counts = create_umi_counter(umi_encoding)
+
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            for (
+                shard_umi_counts,
+                shard_quality_filter,
+                shard_read_outcomes,
+            ), part_file in zip(
+                executor.map(
+                    count_umis_in_shard,
+                    shards,
+                    repeat(umi_prefix),
+                    repeat(umi_suffix),
+                    part_files,
+                    repeat(umi_encoding),
+                    repeat(output_format),
+                    repeat(quality_filter),
+                    repeat(flank_mismatches),
+                    repeat(umi_length),
+                ),
+                part_files,
+            ):
+                unique_umi_counts.update(shard_umi_counts)
+                if read_outcomes is not None:
+                    read_outcomes.update(shard_read_outcomes)
+                if quality_filter is not None:
+                    quality_filter.update(shard_quality_filter)
+                if part_file:
+                    read_umi_fh.append_file(part_file)
+                    os.remove(part_file)
+
+        return unique_umi_counts
+    finally:
+        if read_umi_fh is not None:
+            read_umi_fh.close()
+
+
+def extract_umi_from_fastq(input_fastq, umi_prefix, umi_suffix):
+    """Extract all UMI's between a umi prefix and suffix, given a fastq file. Can be gziped.
+
+    Args:
+        input_fastq (file): *.fastq or *.fastq.gz file.
+        umi_prefix (str): UMI prefix
+        umi_suffix (str):  UMI suffix
+
+    Returns:
+        pandas dataframe: main_readname_umi_df - A dataframe that contains all sequence headers and UMI sequences in the corresponding sequence
+    """
+    read_umi_fh = StringIO()
+    count_umis_in_records(
+        pyfastx.Fastx(input_fastq), umi_prefix, umi_suffix, read_umi_fh
+    )
+    read_umi_fh.seek(0)
+    return pd.read_csv(
+        read_umi_fh,
+        sep="\t",
+        names=READ_UMI_COLUMNS,
+        dtype=str,
+        keep_default_na=False,
+    )
+
+
+def write_data_frame_to_file(
+    dataframe, filename, write_index=None, output_format="tsv", dictionary_columns=()
+):
     """Function to save a dataframe to a file.
 
     Args:
         dataframe (pandas df): Pandas dataframe to save to file
         filename (str): Path to write the dataframe to
         write_index (bool, optional): Write row headers if True. Defaults to None.
+        output_format (str, optional): "tsv", "parquet" or "arrow", see table_utils. Defaults to "tsv".
+        dictionary_columns (tuple, optional): Columns with repeated values, dictionary encoded in arrow tables. Defaults to ().
     """
-    logging.info(f"Writing dataframe to file {filename}")
-    dataframe.to_csv(filename, header=True, index=write_index, sep="\t", mode="w")
+    table_utils.write_table(
+        dataframe, filename, output_format, write_index, dictionary_columns
+    )
 
 
-def calculate_pairwise_hamming_distance(unique_umi_counts):
+def calculate_pairwise_hamming_distance(unique_umi_counts, squared_matrix=True):
     """Function to calculate pairwise hamming distance between UMI sequences
 
+    Distances are computed with numpy, block by block (see hamming_utils), and are
+    returned as the smallest unsigned integer dtype that holds them.
+
     Args:
         unique_umi_counts (Counter): Counter object that contains UMI sequences and counts
+        squared_matrix (bool, optional): Also build the full matrix. Defaults to True.
 
     Returns:
         pdist_distance_matrix: condensed hamming distance matrix
-        squared_distance_matrix: full hamming distance matrix (values across both sides of the diagnol)
+        squared_distance_matrix: full hamming distance matrix (values across both sides of the diagnol), None if not built
     """
     logging.info("Calculating pairwise hamming distance")
 
-    # Convert to array
-    transformed_umi_array = np.array(sorted(unique_umi_counts.keys())).reshape(-1, 1)
+    sorted_umis = sorted(unique_umi_counts.keys())
 
-    # Calculate Distance matrix (condensed) using pdist from scipy
-    # Hamming takes care of sequence length
-    pdist_distance_matrix = spatial.distance.pdist(
-        transformed_umi_array, lambda x, y: hamming(x[0], y[0])
-    )
+    # Calculate Distance matrix (condensed), in the same layout as pdist from scipy
+    pdist_distance_matrix = hamming_utils.pairwise_hamming_distance(sorted_umis)
+    if not squared_matrix:
+        return pdist_distance_matrix, None
 
-    # Convert it to full matrix
+    # Convert it to full matrix, with row names and column names
     squared_distance_matrix = pd.DataFrame(
-        spatial.distance.squareform(pdist_distance_matrix)
+        spatial.distance.squareform(pdist_distance_matrix),
+        index=sorted_umis,
+        columns=sorted_umis,
     )
 
-    # Apply row names and column names
-    squared_distance_matrix.columns = pd.unique(sorted(unique_umi_counts.keys()))
-    squared_distance_matrix.index = pd.unique(sorted(unique_umi_counts.keys()))
-
     return pdist_distance_matrix, squared_distance_matrix
 
 
-def get_unique_umi_counts(umi_dataframe):
+def calculate_sparse_hamming_distance(unique_umi_counts, max_distance):
+    """Function to list the pairs of UMI sequences within a hamming distance, as an edge list
+
+    Only the pairs within max_distance are kept, so memory and output size grow with the
+    number of similar pairs instead of n^2. Pairs come from the neighbor index in
+    hamming_utils.find_similar_pairs.
+
+    Args:
+        unique_umi_counts (Counter): Counter object that contains UMI sequences and counts
+        max_distance (int): Largest hamming distance of a listed pair
+
+    Returns:
+        pandas dataframe: UMI_1, UMI_2 (UMI_1 < UMI_2) and Hamming_Distance of each pair
+    """
+    logging.info(f"Finding UMI pairs within hamming distance {max_distance}")
+
+    sorted_umis = np.array(sorted(unique_umi_counts.keys()), dtype=object)
+    rows, columns, distances = hamming_utils.find_similar_pairs(
+        list(sorted_umis), max_distance
+    )
+    return pd.DataFrame(
+        {
+            "UMI_1": sorted_umis[rows],
+            "UMI_2": sorted_umis[columns],
+            "Hamming_Distance": distances,
+        }
+    )
+
+
+def get_unique_umi_counts(umi_dataframe, umi_encoding="string"):
     """Function applies Counter function to list of all UMIs found in the dataframe.
 
     Args:
         umi_dataframe (df): Pandas dataframe containing sequence header and UMI
+        umi_encoding (str, optional): UMI representation, see create_umi_counter. Defaults to "string".
 
     Returns:
-        Counter: Counter dict containing UMI sequences and their counts in the FASTQ file
+        Counter or EncodedUmiCounts: Counter dict containing UMI sequences and their counts in the FASTQ file
     """
     logging.info("Obtaining unique UMI count")
-    return Counter(umi_dataframe.UMI.tolist())
+    if umi_encoding == "string":
+        return Counter(umi_dataframe.UMI.tolist())
+
+    unique_umi_counts = create_umi_counter(umi_encoding)
+    for umi in umi_dataframe.UMI.tolist():
+        unique_umi_counts.add(umi)
+    return unique_umi_counts
 
 
 def calculate_total_umi_bases_sequenced(unique_umi_counts):
@@ -124,55 +743,61 @@ def calculate_total_umi_bases_sequenced(unique_umi_counts):
     return total_umi_bases
 
 
-def find_similar_umis(hamming_distance_matrix, distance_value):
+def find_similar_umis(umis, distance_value):
     """Function to find UMI sequences within a hamming distance value specified.
 
+    Similar pairs are found with a neighbor index (hamming_utils.find_similar_pairs),
+    so no distance matrix is needed.
+
     Args:
-        hamming_distance_matrix (pandas dataframe): Full pandas dataframe containing hamming distance values
+        umis (iterable): UMI sequences, e.g. a Counter of UMI's or the hamming distance matrix (its columns are UMI's)
         distance_value (int): Find sequences within this hamming distance value
 
     Returns:
         deduplicated_similar_umis: a list of lists containing similar umi's within the hamming distance threshold
     """
-    all_similar_umis = defaultdict(list)
-
-    for columns in hamming_distance_matrix.columns:
-        for rows in hamming_distance_matrix.index:
-            hamming_distance = hamming_distance_matrix[columns][rows]
-            if hamming_distance != 0 and hamming_distance <= distance_value:
-
-                # Explore alternatives, avoid unnecssary looping everytime.
-                if columns not in all_similar_umis[columns]:
-                    all_similar_umis[columns].append(columns)
+    sorted_umis = sorted(umis)
+    rows, columns, _ = hamming_utils.find_similar_pairs(sorted_umis, distance_value)
 
-                # Explore alternatives, avoid unnecssary looping everytime.
-                if rows not in all_similar_umis[columns]:
-                    all_similar_umis[columns].append(rows)
-
-                # Explore alternatives, avoid unnecssary sorting everytime.
-                all_similar_umis[columns] = sorted(all_similar_umis[columns])
+    similar_umi_indexes = defaultdict(list)
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        similar_umi_indexes[row].append(column)
+        similar_umi_indexes[column].append(row)
 
+    # Each UMI with similar UMI's forms a list with them, lists are kept in UMI order
     deduplicated_similar_umis = []
-
-    for similar_umis in all_similar_umis.values():
-        if sorted(similar_umis) not in deduplicated_similar_umis:
-            deduplicated_similar_umis.append(sorted(similar_umis))
+    seen_similar_umis = set()
+    for index in sorted(similar_umi_indexes):
+        similar_umis = [
+            sorted_umis[similar_index]
+            for similar_index in sorted([index] + similar_umi_indexes[index])
+        ]
+        if tuple(similar_umis) not in seen_similar_umis:
+            seen_similar_umis.add(tuple(similar_umis))
+            deduplicated_similar_umis.append(similar_umis)
 
     return deduplicated_similar_umis
 
 
-def collapse_umis_find_error_bases(unique_umi_counts, similar_umis_list_of_lists):
+def collapse_umis_find_error_bases(
+    unique_umi_counts, similar_umis_list_of_lists, umi_weights=None
+):
     """Function to calculate UMI error bases in the fastq file, using information from find_similar_umis
 
+    The UMI with the highest count of each list is taken as correct, or with umi_weights
+    the UMI with the highest quality weight (see quality_utils).
+
     Args:
         unique_umi_counts (Counter): Counter object that contains UMI sequences and counts
         similar_umis_list_of_lists (list): a list of lists containing similar umi's within the hamming distance threshold
+        umi_weights (dict, optional): Quality weight of each UMI, used instead of counts to pick the correct UMI. Defaults to None.
 
     Returns:
         total_number_sequencing_errors: Total number of UMI bases that were incorrectly called.
     """
 
     total_number_sequencing_errors = 0
+    correct_umi_counts = unique_umi_counts if umi_weights is None else umi_weights
 
     for umi_list in similar_umis_list_of_lists:
 
@@ -180,8 +805,8 @@ def collapse_umis_find_error_bases(unique_umi_counts, similar_umis_list_of_lists
         correct_index_count = 0
 
         for each_umi in umi_list:
-            if unique_umi_counts[each_umi] > correct_index_count:
-                correct_index_count = unique_umi_counts[each_umi]
+            if correct_umi_counts[each_umi] > correct_index_count:
+                correct_index_count = correct_umi_counts[each_umi]
                 correct_index = each_umi
 
         for each_umi in umi_list: